@@ -1,8 +1,24 @@
+import asyncio
+import contextlib
 import getpass
-from typing import Dict, List, Any, Optional, Iterable, Tuple
+import hashlib
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Optional, Iterable, Iterator, Tuple, Callable, AsyncIterable, AsyncIterator, Union
 import elasticsearch
 import elasticsearch.helpers
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from tqdm.notebook import tqdm
 import eland as ed
 
@@ -12,6 +28,43 @@ warnings.filterwarnings("ignore")
 from credentials import *
 
 
+logger = logging.getLogger(__name__)
+
+# statuses for which a failed request is worth retrying
+_RETRY_STATUSES = (404, 429, 500, 502, 503, 504)
+
+# clients shared between CogStack instances, keyed by a hash of their hosts, credentials and settings
+_SHARED_CLIENTS: Dict[str, elasticsearch.Elasticsearch] = {}
+_SHARED_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_shared_client(hosts: List, client_kwargs: Dict[str, Any]) -> elasticsearch.Elasticsearch:
+    """
+    Get the shared client for the hosts and client settings (including credentials), creating it if needed.
+
+    Args:
+        hosts (List[str]): A list of Elasticsearch host URLs.
+        client_kwargs (Dict[str, Any]): The keyword arguments for the client.
+
+    Returns:
+        elasticsearch.Elasticsearch: The shared client.
+    """
+    key = hashlib.sha256(json.dumps({'hosts': hosts, 'client_kwargs': client_kwargs},
+                                    sort_keys=True, default=str).encode()).hexdigest()
+    with _SHARED_CLIENTS_LOCK:
+        if key not in _SHARED_CLIENTS:
+            _SHARED_CLIENTS[key] = elasticsearch.Elasticsearch(hosts=hosts, **client_kwargs)
+        return _SHARED_CLIENTS[key]
+
+
+def close_shared_clients() -> None:
+    """Close the clients shared between CogStack instances, and their connections."""
+    with _SHARED_CLIENTS_LOCK:
+        for client in _SHARED_CLIENTS.values():
+            client.close()
+        _SHARED_CLIENTS.clear()
+
+
 class CogStack(object):
     """
     A class for interacting with Elasticsearch.
@@ -23,33 +76,75 @@ class CogStack(object):
         api (bool, optional): A boolean value indicating whether to use API keys or basic authentication to connect to Elasticsearch. Defaults to False (i.e., use basic authentication). Elasticsearch 7.17.
         api_key (str, optional): The API key to use when connecting to Elasticsearch.
             When provided along with `api=True`, this takes precedence over username/password. Only available when using Elasticsearch 8.17.
+        connections_per_node (int, optional): The size of the connection pool to each node. Should be at least
+            the number of concurrent requests (e.g the number of slices). Defaults to 10.
+        http_compress (bool, optional): Whether to gzip the requests and responses. Defaults to False.
+        sniff (bool, optional): Whether to discover the other nodes of the cluster on start and on node failure.
+            Should not be used when the cluster is behind a proxy or load balancer. Defaults to False.
+        reuse_client (bool, optional): Whether to share the client (and its connection pool) with other
+            CogStack instances created with the same hosts, credentials and settings. Defaults to True.
     """
     def __init__(self, hosts: List, username: Optional[str] = None, password: Optional[str] = None,
-                 api: bool = False, timeout: Optional[int]=60, api_key: Optional[str] = None):
+                 api: bool = False, timeout: Optional[int]=60, api_key: Optional[str] = None,
+                 connections_per_node: int = 10, http_compress: bool = False, sniff: bool = False,
+                 reuse_client: bool = True):
 
-        if api_key and api:
-            self.elastic = elasticsearch.Elasticsearch(hosts=hosts,
-                                                       api_key=api_key,
-                                                       verify_certs=False,
-                                                       timeout=timeout)
-        
-        
-        elif api:
-            api_username, api_password = self._check_auth_details(username, password)
-            self.elastic = elasticsearch.Elasticsearch(hosts=hosts,
-                                                       api_key=(api_username, api_password),
-                                                       verify_certs=False,
-                                                       timeout=timeout)
-            
+        client_kwargs: Dict[str, Any] = dict(verify_certs=False,
+                                             request_timeout=timeout,
+                                             connections_per_node=connections_per_node,
+                                             http_compress=http_compress,
+                                             sniff_on_start=sniff,
+                                             sniff_on_node_failure=sniff,
+                                             **self._get_auth_details(username, password, api, api_key))
+        self.hosts = hosts
+        self._cluster_id: Optional[str] = None
+        if reuse_client:
+            self.elastic = _get_shared_client(hosts, client_kwargs)
         else:
-            username, password = self._check_auth_details(username, password)
-            self.elastic = elasticsearch.Elasticsearch(hosts=hosts,
-                                                       basic_auth=(username, password),
-                                                       verify_certs=False,
-                                                       timeout=timeout)
+            self.elastic = elasticsearch.Elasticsearch(hosts=hosts, **client_kwargs)
+
+    def get_cluster_id(self) -> str:
+        """
+        Get an identifier of the Elasticsearch cluster, e.g to tell cached results of different clusters apart.
 
+        This is the `cluster_uuid` of the cluster, or the hosts if it can not be retrieved
+        (e.g without the `monitor` cluster privilege).
 
-    def _check_auth_details(self, username=None, password=None) -> Tuple[str, str]:
+        Returns:
+            str: The cluster identifier.
+    """
+        if self._cluster_id is None:
+            try:
+                self._cluster_id = str(self.elastic.info()['cluster_uuid'])
+            except (elasticsearch.ApiError, elasticsearch.TransportError, KeyError):
+                self._cluster_id = json.dumps(sorted(map(str, self.hosts)))
+        return self._cluster_id
+
+    @staticmethod
+    def _get_auth_details(username: Optional[str] = None, password: Optional[str] = None,
+                          api: bool = False, api_key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Get the authentication arguments for the Elasticsearch client, prompting for missing details if needed.
+
+        Args:
+            username (str, optional): The username. If not provided (and needed), the user will be prompted to enter a username.
+            password (str, optional): The password. If not provided (and needed), the user will be prompted to enter a password.
+            api (bool, optional): Whether to use API keys or basic authentication. Defaults to False.
+            api_key (str, optional): The encoded API key. Only used along with `api=True`.
+
+        Returns:
+            Dict[str, Any]: The keyword arguments to authenticate the Elasticsearch client with.
+        """
+        if api_key and api:
+            return {'api_key': api_key}
+        elif api:
+            api_username, api_password = CogStack._check_auth_details(username, password)
+            return {'api_key': (api_username, api_password)}
+        username, password = CogStack._check_auth_details(username, password)
+        return {'basic_auth': (username, password)}
+
+    @staticmethod
+    def _check_auth_details(username=None, password=None) -> Tuple[str, str]:
         """
         Prompt the user for a username and password if the values are not provided as function arguments.
         
@@ -66,64 +161,821 @@ class CogStack(object):
             password = getpass.getpass("Password: ")
         return username, password
 
-    def get_docs_generator(self, index: List, query: Dict, es_gen_size: int=800, request_timeout: Optional[int] = 300):
+    def get_docs_generator(self, index: List, query: Dict, es_gen_size: Union[int, 'PageSizeController'] = 800,
+                           request_timeout: Optional[int] = 300,
+                           slices: Optional[int] = None, max_buffered_pages: int = 10, show_progress: bool = False,
+                           engine: str = "scroll"):
         """
         Retrieve a generator object that can be used to iterate through documents in an Elasticsearch index.
+
+        If `slices` is greater than 1, the scroll is split into that many sliced scrolls which are
+        retrieved concurrently on a thread pool and merged into a single generator. The order of the
+        documents is then not deterministic. The number of slices should not exceed the number of
+        shards of the index.
+
+        With `engine="pit"` the documents are paged through with a point in time and `search_after`
+        instead of the scroll API (see `search_after_generator`). The page size can then also be
+        adapted to the response times and sizes by passing a `PageSizeController` as `es_gen_size`.
         
         Args:
             index (List[str]): A list of Elasticsearch index names to search.
             query (Dict): A dictionary containing the search query parameters.
-            es_gen_size (int, optional): The number of documents to retrieve per batch. Defaults to 800.
+            es_gen_size (Union[int, PageSizeController], optional): The number of documents to retrieve per batch,
+                or a controller adapting it (only with the "pit" engine). Defaults to 800.
             request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+            slices (int, optional): The number of sliced scrolls to run concurrently. Defaults to None (i.e a single scroll).
+            max_buffered_pages (int, optional): The maximum number of retrieved batches held in memory
+                while waiting to be consumed. Only used with `slices`. Defaults to 10.
+            show_progress (bool, optional): Whether to show the progress of each slice. Only used with `slices`. Defaults to False.
+            engine (str, optional): The retrieval engine to use, either "scroll" or "pit". Defaults to "scroll".
+
+        Raises:
+            ValueError: If an unknown engine is specified, or a `PageSizeController` is used with the scroll engine.
 
         Returns:
             generator: A generator object that can be used to iterate through the documents in the specified Elasticsearch index.
     """
+        _check_engine(engine)
+        _check_page_size(es_gen_size, engine)
+        if slices is not None and slices > 1:
+            return self._sliced_docs_generator(index=index, query=query, slices=slices,
+                                               es_gen_size=es_gen_size, request_timeout=request_timeout,
+                                               max_buffered_pages=max_buffered_pages,
+                                               show_progress=show_progress, engine=engine)
+        if engine == "pit":
+            return self.search_after_generator(index=index, query=query, es_gen_size=es_gen_size,
+                                               request_timeout=request_timeout)
         docs_generator = elasticsearch.helpers.scan(self.elastic,
                                                     query=query,
                                                     index=index,
-                                                    size=es_gen_size,
+                                                    size=int(es_gen_size),
                                                     request_timeout=request_timeout)
         return docs_generator
 
-    def cogstack2df(self, query: Dict, index: str, column_headers=None, es_gen_size: int=800, request_timeout: int=300,
-                    show_progress: bool = True):
+    def search_after_generator(self, index: List, query: Dict, es_gen_size: Union[int, 'PageSizeController'] = 800,
+                               request_timeout: Optional[int] = 300, keep_alive: str = "5m",
+                               sort: Optional[List] = None, search_after: Optional[List] = None,
+                               max_retries: int = 3):
+        """
+        Retrieve a generator object that pages through documents with a point in time (PIT) and `search_after`.
+
+        Unlike the scroll API, no search context is kept alive between pages other than the point in time,
+        whose keep alive is renewed with every page. Each yielded hit has a `sort` key holding its sort values.
+        The sort values of the last consumed hit can be passed as `search_after` to resume from that document.
+
+        Failed requests (connection errors, timeouts, 429 and 5xx responses) are retried with an exponential
+        backoff from the last retrieved sort values. If the point in time has expired, a new one is opened.
+        This is only possible if `sort` is provided, since the default `_shard_doc` sort is only meaningful
+        within the same point in time.
+
+        If a `PageSizeController` is passed as `es_gen_size`, the size of every page is taken from it and
+        it is updated with the response time and size of every page (and shrinks the page size on timeouts).
+
+        Args:
+            index (List[str]): A list of Elasticsearch index names to search.
+            query (Dict): A dictionary containing the search query parameters.
+            es_gen_size (Union[int, PageSizeController], optional): The number of documents to retrieve per batch,
+                or a controller adapting it. Defaults to 800.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+            keep_alive (str, optional): How long to keep the point in time alive between pages. Defaults to "5m".
+            sort (List, optional): The sort to page through. This should be on stable fields that uniquely
+                identify a document in order to be able to resume with a new point in time.
+                Defaults to None (i.e `_shard_doc` order).
+            search_after (List, optional): The sort values of the document to resume after. Defaults to None.
+            max_retries (int, optional): The number of times a failed request is retried. Defaults to 3.
+
+        Returns:
+            generator: A generator object that can be used to iterate through the documents in the specified Elasticsearch index.
+    """
+        for page in self._search_after_pages(index=index, query=query, es_gen_size=es_gen_size,
+                                             request_timeout=request_timeout, keep_alive=keep_alive,
+                                             sort=sort, search_after=search_after, max_retries=max_retries):
+            yield from page
+
+    def _search_after_pages(self, index: List, query: Dict, es_gen_size: Union[int, 'PageSizeController'],
+                            request_timeout: Optional[int],
+                            keep_alive: str = "5m", sort: Optional[List] = None,
+                            search_after: Optional[List] = None, slice_id: Optional[int] = None,
+                            slices: Optional[int] = None, max_retries: int = 3,
+                            on_response: Optional[Callable[[Any], None]] = None) -> Iterator[List[Dict]]:
+        """
+        Page through a point in time with `search_after`, yielding the hits one batch at a time.
+
+        Args:
+            index (List[str]): A list of Elasticsearch index names to search.
+            query (Dict): A dictionary containing the search query parameters.
+            es_gen_size (Union[int, PageSizeController]): The number of documents to retrieve per batch,
+                or a controller adapting it.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out.
+            keep_alive (str, optional): How long to keep the point in time alive between pages. Defaults to "5m".
+            sort (List, optional): The sort to page through. Defaults to None (i.e `_shard_doc` order).
+            search_after (List, optional): The sort values of the document to resume after. Defaults to None.
+            slice_id (int, optional): The ID of the slice to retrieve. Defaults to None.
+            slices (int, optional): The total number of slices. Defaults to None.
+            max_retries (int, optional): The number of times a failed request is retried. Defaults to 3.
+            on_response (Callable[[Any], None], optional): Called with every search response. Defaults to None.
+
+        Raises:
+            elasticsearch.ApiError: If a request fails with a non-retriable status or the retries are exhausted.
+            elasticsearch.TransportError: If the connection keeps failing after the retries are exhausted.
+
+        Yields:
+            List[Dict]: The hits of each batch.
+        """
+        controller = es_gen_size if isinstance(es_gen_size, PageSizeController) else None
+        search_kwargs = dict(query)
+        search_kwargs['size'] = int(es_gen_size)
+        search_kwargs['sort'] = sort or query.get('sort') or [{"_shard_doc": "asc"}]
+        search_kwargs.setdefault('track_total_hits', False)
+        if slices is not None and slice_id is not None:
+            search_kwargs['slice'] = {"id": slice_id, "max": slices}
+        client = self.elastic.options(request_timeout=request_timeout)
+        pit_id = client.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+        retries = 0
+        try:
+            while True:
+                search_kwargs['pit'] = {"id": pit_id, "keep_alive": keep_alive}
+                if search_after is not None:
+                    search_kwargs['search_after'] = search_after
+                if controller is not None:
+                    search_kwargs['size'] = controller.size
+                start_time = time.perf_counter()
+                try:
+                    resp = client.search(**search_kwargs)
+                except (elasticsearch.ApiError, elasticsearch.TransportError) as e:
+                    if controller is not None and isinstance(e, elasticsearch.ConnectionTimeout):
+                        controller.shrink()
+                    status = getattr(e, 'status_code', None)
+                    if (status is not None and status not in _RETRY_STATUSES) or retries >= max_retries:
+                        raise
+                    if status == 404:
+                        # the point in time has expired
+                        if search_after is not None and not (sort or query.get('sort')):
+                            raise
+                        pit_id = client.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+                    retries += 1
+                    time.sleep(min(2 ** retries, 60))
+                    continue
+                retries = 0
+                if on_response is not None:
+                    on_response(resp)
+                pit_id = resp.get('pit_id', pit_id)
+                hits = resp['hits']['hits']
+                if controller is not None:
+                    controller.update(len(hits), time.perf_counter() - start_time, _get_response_size(resp))
+                if not hits:
+                    return
+                yield hits
+                search_after = hits[-1]['sort']
+        finally:
+            client.options(ignore_status=404).close_point_in_time(id=pit_id)
+
+    def _scroll_pages(self, index: List, query: Dict, es_gen_size: int, request_timeout: Optional[int],
+                      scroll: str = "5m", on_response: Optional[Callable[[Any], None]] = None) -> Iterator[List[Dict]]:
+        """
+        Scroll through the documents matching a query, yielding the hits one batch at a time.
+
+        This does the same as `elasticsearch.helpers.scan`, but gives access to the raw responses.
+        As with `scan`, the hits are retrieved in `_doc` order (without scoring them) unless the query has a sort.
+
+        Args:
+            index (List[str]): A list of Elasticsearch index names to search.
+            query (Dict): A dictionary containing the search query parameters.
+            es_gen_size (int): The number of documents to retrieve per batch.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out.
+            scroll (str, optional): How long to keep the scroll context alive between batches. Defaults to "5m".
+            on_response (Callable[[Any], None], optional): Called with every search and scroll response. Defaults to None.
+
+        Raises:
+            elasticsearch.helpers.ScanError: If the scroll only succeeded on some of the shards.
+
+        Yields:
+            List[Dict]: The hits of each batch.
+        """
+        client = self.elastic.options(request_timeout=request_timeout)
+        search_kwargs = dict(query, scroll=scroll, size=es_gen_size)
+        # the cheapest order to scroll in, as in scan(preserve_order=False)
+        search_kwargs.setdefault('sort', '_doc')
+        resp = client.search(index=index, **search_kwargs)
+        scroll_id = resp.get('_scroll_id')
+        try:
+            while scroll_id and resp['hits']['hits']:
+                if on_response is not None:
+                    on_response(resp)
+                shards = resp['_shards']
+                if shards.get('successful', 0) + shards.get('skipped', 0) < shards.get('total', 0):
+                    raise elasticsearch.helpers.ScanError(scroll_id, f"Scroll request has only succeeded on "
+                                                                     f"{shards.get('successful', 0)} shards out of "
+                                                                     f"{shards.get('total', 0)}.")
+                yield resp['hits']['hits']
+                resp = client.scroll(scroll_id=scroll_id, scroll=scroll)
+                scroll_id = resp.get('_scroll_id')
+        finally:
+            if scroll_id:
+                client.options(ignore_status=404).clear_scroll(scroll_id=scroll_id)
+
+    def _scan_slice(self, index: List, query: Dict, slice_id: int, slices: int,
+                    es_gen_size: Union[int, 'PageSizeController'], request_timeout: Optional[int],
+                    engine: str = "scroll") -> Iterator[List[Dict]]:
+        """
+        Scroll through a single slice of a sliced scroll, yielding the hits one batch at a time.
+
+        Args:
+            index (List[str]): A list of Elasticsearch index names to search.
+            query (Dict): A dictionary containing the search query parameters.
+            slice_id (int): The ID of the slice to retrieve.
+            slices (int): The total number of slices.
+            es_gen_size (Union[int, PageSizeController]): The number of documents to retrieve per batch,
+                or a controller adapting it (only with the "pit" engine).
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out.
+            engine (str, optional): The retrieval engine to use, either "scroll" or "pit". Defaults to "scroll".
+
+        Yields:
+            List[Dict]: The hits of each batch.
+        """
+        if engine == "pit":
+            yield from self._search_after_pages(index=index, query=query, es_gen_size=es_gen_size,
+                                                request_timeout=request_timeout,
+                                                slice_id=slice_id, slices=slices)
+            return
+        sliced_query = dict(query, slice={"id": slice_id, "max": slices})
+        docs_generator = elasticsearch.helpers.scan(self.elastic,
+                                                    query=sliced_query,
+                                                    index=index,
+                                                    size=int(es_gen_size),
+                                                    request_timeout=request_timeout)
+        try:
+            page = []
+            for hit in docs_generator:
+                page.append(hit)
+                if len(page) >= int(es_gen_size):
+                    yield page
+                    page = []
+            if page:
+                yield page
+        finally:
+            # clears the scroll context if we stop early
+            docs_generator.close()  # type: ignore
+
+    def _sliced_docs_generator(self, index: List, query: Dict, slices: int,
+                               es_gen_size: Union[int, 'PageSizeController'],
+                               request_timeout: Optional[int], max_buffered_pages: int,
+                               show_progress: bool, engine: str = "scroll") -> Iterator[Dict]:
+        """
+        Retrieve the slices of a sliced scroll concurrently and merge them into a single generator.
+
+        Args:
+            index (List[str]): A list of Elasticsearch index names to search.
+            query (Dict): A dictionary containing the search query parameters.
+            slices (int): The number of slices.
+            es_gen_size (Union[int, PageSizeController]): The number of documents to retrieve per batch,
+                or a controller adapting it (only with the "pit" engine).
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out.
+            max_buffered_pages (int): The maximum number of batches waiting to be consumed.
+            show_progress (bool): Whether to show the progress of each slice.
+            engine (str, optional): The retrieval engine to use, either "scroll" or "pit". Defaults to "scroll".
+
+        Yields:
+            Dict: The retrieved documents.
+        """
+        def _get_pages(slice_id: int) -> Iterator[List[Dict]]:
+            return self._scan_slice(index, query, slice_id, slices, es_gen_size, request_timeout, engine=engine)
+
+        for _, page in self._sliced_pages(list(range(slices)), _get_pages, max_buffered_pages, show_progress):
+            if page is not None:
+                yield from page
+
+    def _sliced_pages(self, slice_ids: List[int], get_pages: Callable[[int], Iterable[List[Dict]]],
+                      max_buffered_pages: int, show_progress: bool) -> Iterator[Tuple[int, Optional[List[Dict]]]]:
+        """
+        Retrieve the batches of multiple slices concurrently and merge them into a single generator.
+
+        Each slice is retrieved on its own thread and its batches are put on a bounded queue.
+        When the queue is full, the threads wait, so at most `max_buffered_pages` batches are held in memory.
+
+        Args:
+            slice_ids (List[int]): The IDs of the slices to retrieve.
+            get_pages (Callable[[int], Iterable[List[Dict]]]): Gets the batches of hits for a slice ID.
+            max_buffered_pages (int): The maximum number of batches waiting to be consumed.
+            show_progress (bool): Whether to show the progress of each slice.
+
+        Yields:
+            Tuple[int, Optional[List[Dict]]]: The slice ID and a batch of its hits, or None once the slice is done.
+        """
+        pages: queue.Queue = queue.Queue(maxsize=max(max_buffered_pages, 1))
+        stop = threading.Event()
+
+        def _put(item: Tuple[int, Any]) -> bool:
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def _run_slice(slice_id: int) -> None:
+            try:
+                for page in get_pages(slice_id):
+                    if not _put((slice_id, page)):
+                        return
+            except Exception as e:
+                _put((slice_id, e))
+            finally:
+                _put((slice_id, None))
+
+        progress_bars = {slice_id: tqdm(desc=f"Slice {slice_id} retrieved...", position=nr,
+                                        disable=not show_progress)
+                         for nr, slice_id in enumerate(slice_ids)}
+        with ThreadPoolExecutor(max_workers=max(len(slice_ids), 1)) as executor:
+            for slice_id in slice_ids:
+                executor.submit(_run_slice, slice_id)
+            try:
+                remaining = len(slice_ids)
+                while remaining:
+                    slice_id, page = pages.get()
+                    if page is None:
+                        remaining -= 1
+                        progress_bars[slice_id].close()
+                    elif isinstance(page, Exception):
+                        raise page
+                    else:
+                        progress_bars[slice_id].update(len(page))
+                    yield slice_id, page
+            finally:
+                # let the remaining threads finish up
+                stop.set()
+                for progress_bar in progress_bars.values():
+                    progress_bar.close()
+
+    def resumable_docs_generator(self, index: List, query: Dict, checkpoint_file: str, sort: List,
+                                 es_gen_size: Union[int, 'PageSizeController'] = 800,
+                                 request_timeout: Optional[int] = 300, checkpoint_interval: int = 10000, slices: Optional[int] = None,
+                                 max_buffered_pages: int = 10, show_progress: bool = False,
+                                 keep_alive: str = "5m"):
+        """
+        Retrieve a generator object that checkpoints its progress so an interrupted retrieval can be resumed.
+
+        The documents are paged through with a point in time and `search_after` (see `search_after_generator`).
+        For every slice, the sort values of the last consumed batch and the number of emitted documents are
+        written to `checkpoint_file` every `checkpoint_interval` documents. Running again with the same
+        index, query, sort and slices continues from the checkpoint. Since checkpoints are only taken
+        between batches, documents of a partially consumed batch are emitted again on restart.
+        The checkpoint is also written when the retrieval is stopped early or fails, and the file
+        is removed once all the documents have been retrieved.
+
+        Args:
+            index (List[str]): A list of Elasticsearch index names to search.
+            query (Dict): A dictionary containing the search query parameters.
+            checkpoint_file (str): The path of the file to keep the checkpoint in.
+            sort (List): The sort to page through. This needs to be on stable fields that uniquely
+                identify a document since the retrieval is resumed with a new point in time.
+            es_gen_size (Union[int, PageSizeController], optional): The number of documents to retrieve per batch,
+                or a controller adapting it. Defaults to 800.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+            checkpoint_interval (int, optional): The number of emitted documents between checkpoints. Defaults to 10000.
+            slices (int, optional): The number of slices to retrieve concurrently. Defaults to None (i.e no slicing).
+                A single slice is the same as no slicing.
+            max_buffered_pages (int, optional): The maximum number of retrieved batches held in memory
+                while waiting to be consumed. Only used with `slices`. Defaults to 10.
+            show_progress (bool, optional): Whether to show the progress of each slice. Defaults to False.
+            keep_alive (str, optional): How long to keep the point in time alive between pages. Defaults to "5m".
+
+        Raises:
+            ValueError: If the checkpoint file belongs to a different retrieval.
+
+        Returns:
+            generator: A generator object that can be used to iterate through the documents in the specified Elasticsearch index.
+    """
+        if slices is not None and slices <= 1:
+            # Elasticsearch needs the max of a slice to be greater than 1
+            slices = None
+        checkpoint = _RetrievalCheckpoint(checkpoint_file, index=index, query=query, sort=sort, slices=slices)
+
+        def _get_pages(slice_id: int) -> Iterator[List[Dict]]:
+            return self._search_after_pages(index=index, query=query, es_gen_size=es_gen_size,
+                                            request_timeout=request_timeout, keep_alive=keep_alive,
+                                            sort=sort, search_after=checkpoint.search_after(slice_id),
+                                            slice_id=slice_id if slices else None, slices=slices)
+
+        last_saved = checkpoint.emitted
+        try:
+            for slice_id, page in self._sliced_pages(checkpoint.remaining_slices(), _get_pages,
+                                                     max_buffered_pages, show_progress):
+                if page is None:
+                    checkpoint.slice_done(slice_id)
+                    checkpoint.save()
+                    continue
+                yield from page
+                checkpoint.page_done(slice_id, page)
+                if checkpoint.emitted - last_saved >= checkpoint_interval:
+                    checkpoint.save()
+                    last_saved = checkpoint.emitted
+        except BaseException:
+            # stopped early or failed, keep the progress so far
+            checkpoint.save()
+            raise
+        checkpoint.remove()
+
+    def cogstack2df(self, query: Dict, index: str, column_headers=None,
+                    es_gen_size: Union[int, 'PageSizeController'] = 800, request_timeout: int = 300,
+                    show_progress: bool = True, columnar: bool = False, chunk_size: int = 100000,
+                    memory_budget_mb: Optional[float] = None, spill_dir: Optional[str] = None,
+                    engine: str = "scroll", count: bool = False, cache: Optional['ResultCache'] = None):
         """
         Retrieve documents from an Elasticsearch index and convert them to a Pandas DataFrame.
+
+        The total shown in the progress is taken from the first scroll response rather than a separate count request.
+        The point in time engine does not track the total number of hits, so there is no total shown unless `count` is set.
+        The progress also shows the throughput in documents and MB (of response payload) per second.
+
+        With `columnar=True` the hits are accumulated into per-column buffers which are converted into
+        DataFrame chunks every `chunk_size` hits, instead of keeping a dict per hit until the end.
+        If `memory_budget_mb` is also set, the chunks are spilled to Parquet files on disk whenever
+        the chunks held in memory exceed the budget and are only read back when building the final DataFrame.
         
         Args:
             query (Dict): A dictionary containing the search query parameters.
             index (str): The name of the Elasticsearch index to search.
             column_headers (List[str], optional): A list of column headers to use for the DataFrame. If not provided, the DataFrame will have default column names.
-            es_gen_size (int, optional): The number of documents to retrieve per batch. Defaults to 800.
+            es_gen_size (Union[int, PageSizeController], optional): The number of documents to retrieve per batch,
+                or a controller adapting it (only with the "pit" engine). Defaults to 800.
             request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
             show_progress (bool, optional): Whether to show the progress in console. Defaults to true.
+            columnar (bool, optional): Whether to use the columnar accumulation. Defaults to False.
+            chunk_size (int, optional): The number of hits per DataFrame chunk. Only used with `columnar`. Defaults to 100000.
+            memory_budget_mb (float, optional): The memory (in MB) the chunks are allowed to take before being
+                spilled to disk. Only used with `columnar`. Defaults to None (i.e never spill).
+            spill_dir (str, optional): The directory to spill the chunks to. If not provided, a temporary
+                directory is used and removed afterwards. Only used with `columnar`. Defaults to None.
+            engine (str, optional): The retrieval engine to use, either "scroll" or "pit". Defaults to "scroll".
+            count (bool, optional): Whether to send a separate count request for the progress total. Defaults to False.
+            cache (ResultCache, optional): The cache to look the results up in before retrieving them,
+                and to store them in afterwards. Defaults to None (i.e no caching).
+
+        Raises:
+            ValueError: If an unknown engine is specified, or a `PageSizeController` is used with the scroll engine.
 
         Returns:
             pandas.DataFrame: A DataFrame containing the retrieved documents.
     """
-        docs_generator = elasticsearch.helpers.scan(self.elastic,
-                                                    query=query,
-                                                    index=index,
-                                                    size=es_gen_size,
-                                                    request_timeout=request_timeout)
-        temp_results = []
-        results = self.elastic.count(index=index, query=query['query'], request_timeout=300)  # type: ignore
-        for hit in tqdm(docs_generator, total=results['count'], desc="CogStack retrieved...", disable=not show_progress):
-            row = dict()
-            row['_index'] = hit['_index']
-            row['_id'] = hit['_id']
-            row['_score'] = hit['_score']
-            row.update(hit['_source'])
-            temp_results.append(row)
-        if column_headers:
-            df_headers = ['_index', '_id', '_score']
-            df_headers.extend(column_headers)
-            df = pd.DataFrame(temp_results, columns=df_headers)
+        _check_engine(engine)
+        _check_page_size(es_gen_size, engine)
+        if cache is not None:
+            cluster = self.get_cluster_id()
+            cached = cache.get(index, query, column_headers, cluster=cluster)
+            if cached is not None:
+                return cached
+        hits = self._get_hits(query=query, index=index, es_gen_size=es_gen_size, request_timeout=request_timeout,
+                              show_progress=show_progress, engine=engine, count=count)
+        if columnar:
+            buffer = _ColumnarBuffer(column_headers=column_headers, chunk_size=chunk_size,
+                                     memory_budget_mb=memory_budget_mb, spill_dir=spill_dir)
+            for hit in hits:
+                buffer.append(hit)
+            df = buffer.to_df()
         else:
-            df = pd.DataFrame(temp_results)
+            df = _hits_to_df(hits, column_headers)
+        if cache is not None:
+            cache.put(index, query, column_headers, df, cluster=cluster)
         return df
     
+    def multi_search(self, index: Any, queries: Union[List[Dict], Dict[Any, Dict]], column_headers=None,
+                     chunk_size: int = 100, max_workers: int = 4, request_timeout: int = 300,
+                     show_progress: bool = True, strict: bool = True) -> Dict[Any, pd.DataFrame]:
+        """
+        Run many searches in batches through the multi search (`_msearch`) API.
+
+        The queries are split into chunks of `chunk_size` (see `list_chunker`), each sent as a single
+        multi search request, and up to `max_workers` requests are run at the same time. This saves the
+        round trip per query of calling `cogstack2df` for every query.
+
+        Each query only returns its top `size` hits (10 unless set in the query, and at most the
+        `index.max_result_window` of the index), since the multi search API does not scroll.
+        Queries with more hits than that are reported (by the total number of hits of the response)
+        and should use `cogstack2df` instead. Long terms lookups can be split into several queries
+        with `terms_queries`.
+
+        Args:
+            index (Any): The name (or list of names) of the Elasticsearch index to search.
+            queries (Union[List[Dict], Dict[Any, Dict]]): The search queries, either as a list or
+                as a dictionary keyed by e.g the patient ID or concept term the query is for.
+            column_headers (List[str], optional): The `_source` fields to keep. If not provided, all fields are kept.
+            chunk_size (int, optional): The number of queries per multi search request. Defaults to 100.
+            max_workers (int, optional): The maximum number of requests running at the same time. Defaults to 4.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+            show_progress (bool, optional): Whether to show the progress in console. Defaults to true.
+            strict (bool, optional): Whether to raise an error if any of the queries has more hits than it returned,
+                otherwise a warning is logged. Defaults to true.
+
+        Raises:
+            RuntimeError: If any of the queries failed (or, if `strict`, did not return all of its hits).
+
+        Returns:
+            Dict[Any, pandas.DataFrame]: The retrieved documents of each query, keyed by its position in the list
+                (or its key in the dictionary).
+    """
+        if not isinstance(queries, dict):
+            queries = dict(enumerate(queries))
+        client = self.elastic.options(request_timeout=request_timeout)
+
+        def _msearch(keys: List[Any]) -> List[Dict]:
+            searches: List[Dict] = []
+            for key in keys:
+                search = queries[key]
+                if column_headers and '_source' not in search:
+                    # only the fields kept
+                    search = dict(search, _source=column_headers)
+                searches.append({'index': index})
+                searches.append(search)
+            return client.msearch(searches=searches)['responses']
+
+        results: Dict[Any, pd.DataFrame] = {}
+        errors = {}
+        truncated = {}
+        chunks = list_chunker(list(queries), chunk_size)
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            responses = executor.map(_msearch, chunks)
+            for keys, chunk_responses in tqdm(zip(chunks, responses), total=len(chunks), unit="requests",
+                                              desc="CogStack searched...", disable=not show_progress):
+                for key, resp in zip(keys, chunk_responses):
+                    if 'error' in resp:
+                        errors[key] = resp['error']
+                    else:
+                        results[key] = _hits_to_df(resp['hits']['hits'], column_headers)
+                        missing = _get_missing_hits(resp)
+                        if missing is not None:
+                            truncated[key] = missing
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(queries)} queries failed, "
+                               f"e.g query {next(iter(errors))!r}: {next(iter(errors.values()))}")
+        if truncated:
+            key, missing = next(iter(truncated.items()))
+            message = (f"{len(truncated)} of {len(queries)} queries did not return all of their hits, "
+                       f"e.g query {key!r} is missing {missing} hits (queries: {list(truncated)[:10]}). "
+                       "Raise their 'size', split them (see terms_queries) or use cogstack2df instead.")
+            if strict:
+                raise RuntimeError(message)
+            logger.warning(message)
+        return {key: results[key] for key in queries}
+
+    def terms_counts(self, index: Any, field: str, query: Optional[Dict] = None, size: int = 100,
+                     request_timeout: int = 300) -> pd.DataFrame:
+        """
+        Count the documents per value of a field with a terms aggregation.
+
+        Only the `size` most frequent values are returned and the counts may be approximate when the
+        index has multiple shards (see the Elasticsearch terms aggregation). Use `composite_counts` to
+        get exact counts of all the values.
+
+        Args:
+            index (Any): The name (or list of names) of the Elasticsearch index to search.
+            field (str): The field to count the values of (a keyword, numeric or date field).
+            query (Dict, optional): A dictionary containing the search query parameters. Defaults to None (i.e all documents).
+            size (int, optional): The number of values to return. Defaults to 100.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+
+        Returns:
+            pandas.DataFrame: A DataFrame with a `field` column and a `doc_count` column, most frequent first.
+    """
+        aggs = self._aggregate(index, {'counts': {'terms': {'field': field, 'size': size}}}, query, request_timeout)
+        rows = [(bucket['key'], bucket['doc_count']) for bucket in aggs['counts']['buckets']]
+        return pd.DataFrame(rows, columns=[field, 'doc_count'])
+
+    def date_histogram(self, index: Any, field: str, interval: str = "month", query: Optional[Dict] = None,
+                       time_zone: Optional[str] = None, min_doc_count: int = 0,
+                       request_timeout: int = 300) -> pd.DataFrame:
+        """
+        Count the documents per calendar interval of a date field with a date histogram aggregation.
+
+        Args:
+            index (Any): The name (or list of names) of the Elasticsearch index to search.
+            field (str): The date field to bucket the documents by.
+            interval (str, optional): The calendar interval, e.g "day", "week", "month", "quarter" or "year". Defaults to "month".
+            query (Dict, optional): A dictionary containing the search query parameters. Defaults to None (i.e all documents).
+            time_zone (str, optional): The time zone to bucket in, e.g "Europe/London". Defaults to None (i.e UTC).
+            min_doc_count (int, optional): The minimum number of documents for an interval to be returned.
+                Defaults to 0 (i.e empty intervals in between are returned as well).
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+
+        Returns:
+            pandas.DataFrame: A DataFrame with a `field` column holding the start of each interval
+                and a `doc_count` column.
+    """
+        histogram: Dict[str, Any] = {'field': field, 'calendar_interval': interval, 'min_doc_count': min_doc_count}
+        if time_zone is not None:
+            histogram['time_zone'] = time_zone
+        aggs = self._aggregate(index, {'histogram': {'date_histogram': histogram}}, query, request_timeout)
+        rows = [(bucket['key'], bucket['doc_count']) for bucket in aggs['histogram']['buckets']]
+        df = pd.DataFrame(rows, columns=[field, 'doc_count'])
+        df[field] = pd.to_datetime(df[field], unit='ms', utc=True)
+        return df
+
+    def cardinality(self, index: Any, fields: Union[str, List[str]], query: Optional[Dict] = None,
+                    precision_threshold: Optional[int] = None, request_timeout: int = 300) -> pd.DataFrame:
+        """
+        Count the distinct values of one or more fields (e.g the number of patients) with cardinality aggregations.
+
+        The counts are approximate above `precision_threshold` (see the Elasticsearch cardinality aggregation).
+
+        Args:
+            index (Any): The name (or list of names) of the Elasticsearch index to search.
+            fields (Union[str, List[str]]): The field(s) to count the distinct values of.
+            query (Dict, optional): A dictionary containing the search query parameters. Defaults to None (i.e all documents).
+            precision_threshold (int, optional): The count below which the counts are expected to be
+                close to exact (at most 40000). Defaults to None (i.e the Elasticsearch default).
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+
+        Returns:
+            pandas.DataFrame: A DataFrame with a `field` column and a `cardinality` column, a row per field.
+    """
+        if isinstance(fields, str):
+            fields = [fields]
+        aggs_query: Dict[str, Any] = {}
+        for nr, field in enumerate(fields):
+            cardinality: Dict[str, Any] = {'field': field}
+            if precision_threshold is not None:
+                cardinality['precision_threshold'] = precision_threshold
+            aggs_query[f'field_{nr}'] = {'cardinality': cardinality}
+        aggs = self._aggregate(index, aggs_query, query, request_timeout)
+        rows = [(field, aggs[f'field_{nr}']['value']) for nr, field in enumerate(fields)]
+        return pd.DataFrame(rows, columns=['field', 'cardinality'])
+
+    def max_value(self, index: Any, field: str, query: Optional[Dict] = None, request_timeout: int = 300) -> Any:
+        """
+        Get the maximum value of a numeric or date field with a max aggregation.
+
+        Args:
+            index (Any): The name (or list of names) of the Elasticsearch index to search.
+            field (str): The numeric or date field.
+            query (Dict, optional): A dictionary containing the search query parameters. Defaults to None (i.e all documents).
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+
+        Returns:
+            Any: The maximum (formatted as in the index for dates), or None if no document has a value.
+    """
+        aggs = self._aggregate(index, {'max_value': {'max': {'field': field}}}, query, request_timeout)
+        if aggs['max_value']['value'] is None:
+            return None
+        return aggs['max_value'].get('value_as_string', aggs['max_value']['value'])
+
+    def composite_counts(self, index: Any, sources: Union[List[str], Dict[str, Dict]], query: Optional[Dict] = None,
+                         page_size: int = 1000, request_timeout: int = 300,
+                         show_progress: bool = True) -> pd.DataFrame:
+        """
+        Count the documents per combination of values of several fields with a composite aggregation.
+
+        All the combinations are paged through with `after_key`, `page_size` buckets per request,
+        so unlike `terms_counts` the counts are exact and complete.
+
+        Args:
+            index (Any): The name (or list of names) of the Elasticsearch index to search.
+            sources (Union[List[str], Dict[str, Dict]]): The fields to group by, or a dictionary of column
+                name to composite value source (e.g `{'month': {'date_histogram': {'field': 'date',
+                'calendar_interval': 'month'}}}`).
+            query (Dict, optional): A dictionary containing the search query parameters. Defaults to None (i.e all documents).
+            page_size (int, optional): The number of buckets to retrieve per request. Defaults to 1000.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+            show_progress (bool, optional): Whether to show the progress in console. Defaults to true.
+
+        Returns:
+            pandas.DataFrame: A DataFrame with a column per source and a `doc_count` column.
+    """
+        if not isinstance(sources, dict):
+            sources = {field: {'terms': {'field': field}} for field in sources}
+        composite: Dict[str, Any] = {'size': page_size,
+                                     'sources': [{name: source} for name, source in sources.items()]}
+        rows: List[Dict] = []
+        with tqdm(desc="CogStack aggregated...", unit="buckets", disable=not show_progress) as progress_bar:
+            while True:
+                aggs = self._aggregate(index, {'groups': {'composite': composite}}, query, request_timeout)
+                buckets = aggs['groups']['buckets']
+                rows.extend(dict(bucket['key'], doc_count=bucket['doc_count']) for bucket in buckets)
+                progress_bar.update(len(buckets))
+                after_key = aggs['groups'].get('after_key')
+                if not buckets or after_key is None:
+                    break
+                composite = dict(composite, after=after_key)
+        return pd.DataFrame(rows, columns=list(sources) + ['doc_count'])
+
+    def _aggregate(self, index: Any, aggs: Dict, query: Optional[Dict], request_timeout: Optional[int]) -> Dict:
+        client = self.elastic.options(request_timeout=request_timeout)
+        search_kwargs = dict(query or {}, size=0, aggs=aggs, track_total_hits=False)
+        return client.search(index=index, **search_kwargs)['aggregations']
+
+    def _get_hits(self, query: Dict, index: str, es_gen_size: Union[int, 'PageSizeController'],
+                  request_timeout: Optional[int],
+                  show_progress: bool, engine: str, count: bool) -> Iterator[Dict]:
+        progress = _RetrievalProgress()
+        if engine == "pit":
+            pages = self._search_after_pages(index=index, query=query, es_gen_size=es_gen_size,  # type: ignore
+                                             request_timeout=request_timeout, on_response=progress.update)
+        else:
+            pages = self._scroll_pages(index=index, query=query, es_gen_size=es_gen_size,  # type: ignore
+                                       request_timeout=request_timeout, on_response=progress.update)
+        total = None
+        if count:
+            client = self.elastic.options(request_timeout=request_timeout)
+            total = client.count(index=index, query=query['query'])['count']
+        progress_bar = tqdm(total=total, desc="CogStack retrieved...", unit="docs", disable=not show_progress)
+        return progress.iter_hits(pages, progress_bar)
+
+    def cogstack2parquet(self, query: Dict, index: str, output_dir: str, column_headers: Optional[List[str]] = None,
+                         es_gen_size: Union[int, 'PageSizeController'] = 800, request_timeout: int = 300,
+                         show_progress: bool = True,
+                         row_group_size: int = 100000, rows_per_file: int = 1000000,
+                         engine: str = "scroll", count: bool = False):
+        """
+        Retrieve documents from an Elasticsearch index and write them to a partitioned Parquet dataset.
+
+        The hits are streamed into Arrow record batches of `row_group_size` rows, each written as a
+        row group as soon as it is full, so the full result set is never held in memory.
+        A new file (`part-00000.parquet`, `part-00001.parquet`, ...) is started every `rows_per_file` rows
+        and whenever a new field appears in the `_source` of the hits.
+
+        Args:
+            query (Dict): A dictionary containing the search query parameters.
+            index (str): The name of the Elasticsearch index to search.
+            output_dir (str): The directory to write the dataset to.
+            column_headers (List[str], optional): The `_source` fields to keep. If not provided, all fields are kept.
+            es_gen_size (Union[int, PageSizeController], optional): The number of documents to retrieve per batch,
+                or a controller adapting it (only with the "pit" engine). Defaults to 800.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+            show_progress (bool, optional): Whether to show the progress in console. Defaults to true.
+            row_group_size (int, optional): The number of rows per record batch (row group). Defaults to 100000.
+            rows_per_file (int, optional): The maximum number of rows per file. Defaults to 1000000.
+            engine (str, optional): The retrieval engine to use, either "scroll" or "pit". Defaults to "scroll".
+            count (bool, optional): Whether to send a separate count request for the progress total. Defaults to False.
+
+        Raises:
+            ValueError: If an unknown engine is specified, a `PageSizeController` is used with the scroll engine
+                or a field has values of incompatible types.
+
+        Returns:
+            pyarrow.dataset.Dataset: The dataset written.
+    """
+        return self._cogstack2dataset(query=query, index=index, output_dir=output_dir, file_format='parquet',
+                                      column_headers=column_headers, es_gen_size=es_gen_size,
+                                      request_timeout=request_timeout, show_progress=show_progress,
+                                      row_group_size=row_group_size, rows_per_file=rows_per_file,
+                                      engine=engine, count=count)
+
+    def cogstack2arrow(self, query: Dict, index: str, output_dir: str, column_headers: Optional[List[str]] = None,
+                       es_gen_size: Union[int, 'PageSizeController'] = 800, request_timeout: int = 300,
+                       show_progress: bool = True,
+                       row_group_size: int = 100000, rows_per_file: int = 1000000,
+                       engine: str = "scroll", count: bool = False):
+        """
+        Retrieve documents from an Elasticsearch index and write them to a partitioned Arrow IPC dataset.
+
+        This works the same way as `cogstack2parquet`, but the files (`part-00000.arrow`, ...) are written
+        uncompressed in the Arrow IPC format so that they can be read back memory-mapped
+        (e.g `pyarrow.ipc.open_file(pyarrow.memory_map(path))`).
+
+        Args:
+            query (Dict): A dictionary containing the search query parameters.
+            index (str): The name of the Elasticsearch index to search.
+            output_dir (str): The directory to write the dataset to.
+            column_headers (List[str], optional): The `_source` fields to keep. If not provided, all fields are kept.
+            es_gen_size (Union[int, PageSizeController], optional): The number of documents to retrieve per batch,
+                or a controller adapting it (only with the "pit" engine). Defaults to 800.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+            show_progress (bool, optional): Whether to show the progress in console. Defaults to true.
+            row_group_size (int, optional): The number of rows per record batch. Defaults to 100000.
+            rows_per_file (int, optional): The maximum number of rows per file. Defaults to 1000000.
+            engine (str, optional): The retrieval engine to use, either "scroll" or "pit". Defaults to "scroll".
+            count (bool, optional): Whether to send a separate count request for the progress total. Defaults to False.
+
+        Raises:
+            ValueError: If an unknown engine is specified, a `PageSizeController` is used with the scroll engine
+                or a field has values of incompatible types.
+
+        Returns:
+            pyarrow.dataset.Dataset: The dataset written.
+    """
+        return self._cogstack2dataset(query=query, index=index, output_dir=output_dir, file_format='arrow',
+                                      column_headers=column_headers, es_gen_size=es_gen_size,
+                                      request_timeout=request_timeout, show_progress=show_progress,
+                                      row_group_size=row_group_size, rows_per_file=rows_per_file,
+                                      engine=engine, count=count)
+
+    def _cogstack2dataset(self, query: Dict, index: str, output_dir: str, file_format: str,
+                          column_headers: Optional[List[str]], es_gen_size: Union[int, 'PageSizeController'],
+                          request_timeout: int,
+                          show_progress: bool, row_group_size: int, rows_per_file: int, engine: str, count: bool):
+        _check_engine(engine)
+        _check_page_size(es_gen_size, engine)
+        hits = self._get_hits(query=query, index=index, es_gen_size=es_gen_size, request_timeout=request_timeout,
+                              show_progress=show_progress, engine=engine, count=count)
+        writer = _RecordBatchWriter(output_dir=output_dir, file_format=file_format, column_headers=column_headers,
+                                    row_group_size=row_group_size, rows_per_file=rows_per_file)
+        try:
+            for hit in hits:
+                writer.append(hit)
+        finally:
+            writer.close()
+        return writer.to_dataset()
+
     def DataFrame(self, index: str, columns: Optional[List[str]] = None):
         """
         Fast method to return a pandas dataframe from a CogStack search.
@@ -137,6 +989,837 @@ class CogStack(object):
     """
         return ed.DataFrame(es_client=self.elastic, es_index_pattern=index, columns=columns)
 
+    def get_text_generator(self, index: List, text_fields: Union[str, List[str]], query: Optional[Dict] = None,
+                           es_gen_size: int = 5000, request_timeout: Optional[int] = 300,
+                           **kwargs) -> Iterator[Tuple[str, str]]:
+        """
+        Iterate through the texts of the documents in an Elasticsearch index as plain (doc_id, text) tuples.
+
+        Only the text fields are requested from Elasticsearch and no DataFrame rows are built,
+        which makes this a lighter alternative to `DataFrame(...).iterrows()` for training and annotation.
+        If multiple text fields are specified, a tuple is yielded for each non-empty field of each document.
+        Documents without (or with empty) text fields are skipped.
+
+        Args:
+            index (List[str]): A list of Elasticsearch index names to search.
+            text_fields (Union[str, List[str]]): The text field(s) to retrieve. Nested fields can be specified with dots.
+            query (Dict, optional): A dictionary containing the search query parameters. Defaults to None (i.e all documents).
+            es_gen_size (int, optional): The number of documents to retrieve per batch. Defaults to 5000.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+            **kwargs: Additional keyword arguments passed on to `get_docs_generator` (e.g `slices` or `engine`).
+
+        Yields:
+            Tuple[str, str]: The document ID and the text.
+        """
+        if isinstance(text_fields, str):
+            text_fields = [text_fields]
+        query = dict(query or {"query": {"match_all": {}}}, _source=text_fields)
+        for hit in self.get_docs_generator(index=index, query=query, es_gen_size=es_gen_size,
+                                           request_timeout=request_timeout, **kwargs):
+            source = hit.get('_source', {})
+            for field in text_fields:
+                text = _get_field(source, field)
+                if text:
+                    yield hit['_id'], text
+
+    def bulk_index(self, actions: Iterable[Dict], chunk_size: int = 500, thread_count: int = 4,
+                   queue_size: int = 4, max_retries: int = 5, initial_backoff: float = 2,
+                   max_backoff: float = 600, request_timeout: Optional[int] = 300,
+                   show_progress: bool = True) -> Dict[str, Any]:
+        """
+        Write documents to Elasticsearch in bulk using multiple threads.
+
+        The actions are sent in chunks of `chunk_size` by `thread_count` threads, with at most
+        `queue_size` chunks waiting to be sent, which bounds the number of requests in flight.
+        Actions rejected with a 429 (too many requests) status are collected and retried
+        with an exponential backoff once the rest have been sent.
+
+        Args:
+            actions (Iterable[Dict]): The bulk actions (e.g {"_index": ..., "_id": ..., "_source": ...}).
+            chunk_size (int, optional): The number of actions per bulk request. Defaults to 500.
+            thread_count (int, optional): The number of threads sending requests. Defaults to 4.
+            queue_size (int, optional): The number of chunks waiting to be sent. Defaults to 4.
+            max_retries (int, optional): The number of times a rejected action is retried. Defaults to 5.
+            initial_backoff (float, optional): The time in seconds to wait before the first retry. Defaults to 2.
+            max_backoff (float, optional): The maximum time in seconds to wait between retries. Defaults to 600.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+            show_progress (bool, optional): Whether to show the progress in console. Defaults to true.
+
+        Returns:
+            Dict[str, Any]: The number of indexed, failed and retried actions, the elapsed time,
+                the throughput (docs_per_sec) and the errors of the failed actions.
+        """
+        client = self.elastic.options(request_timeout=request_timeout)
+        stats: Dict[str, Any] = {'indexed': 0, 'failed': 0, 'retried': 0, 'errors': []}
+        start_time = time.perf_counter()
+        pending: Iterable[Dict] = actions
+        with tqdm(desc="CogStack indexed...", disable=not show_progress) as progress_bar:
+            for attempt in range(max_retries + 1):
+                # parallel_bulk returns results in the order of the actions,
+                # so keep the actions in flight to know which ones to retry
+                in_flight: deque = deque()
+
+                def _track(actions: Iterable[Dict]) -> Iterator[Dict]:
+                    for action in actions:
+                        in_flight.append(action)
+                        yield action
+
+                rejected = []
+                for ok, item in elasticsearch.helpers.parallel_bulk(client, _track(pending),
+                                                                    thread_count=thread_count,
+                                                                    chunk_size=chunk_size,
+                                                                    queue_size=queue_size,
+                                                                    raise_on_error=False,
+                                                                    raise_on_exception=False):
+                    action = in_flight.popleft()
+                    if ok:
+                        stats['indexed'] += 1
+                        progress_bar.update(1)
+                    elif _get_bulk_status(item) == 429 and attempt < max_retries:
+                        rejected.append(action)
+                    else:
+                        stats['failed'] += 1
+                        stats['errors'].append(item)
+                if not rejected:
+                    break
+                stats['retried'] += len(rejected)
+                time.sleep(min(initial_backoff * 2 ** attempt, max_backoff))
+                pending = rejected
+        stats['elapsed'] = time.perf_counter() - start_time
+        stats['docs_per_sec'] = stats['indexed'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        return stats
+
+
+class AsyncCogStack(object):
+    """
+    A class for interacting with Elasticsearch asynchronously.
+
+    This allows the retrieval of documents to overlap with their processing.
+
+    Args:
+        hosts (List[str]): A list of Elasticsearch host URLs.
+        username (str, optional): The username to use when connecting to Elasticsearch. If not provided, the user will be prompted to enter a username.
+        password (str, optional): The password to use when connecting to Elasticsearch. If not provided, the user will be prompted to enter a password.
+        api (bool, optional): A boolean value indicating whether to use API keys or basic authentication to connect to Elasticsearch. Defaults to False (i.e., use basic authentication).
+        timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 60.
+        api_key (str, optional): The API key to use when connecting to Elasticsearch.
+            When provided along with `api=True`, this takes precedence over username/password.
+    """
+    def __init__(self, hosts: List, username: Optional[str] = None, password: Optional[str] = None,
+                 api: bool = False, timeout: Optional[int] = 60, api_key: Optional[str] = None):
+        self.elastic = elasticsearch.AsyncElasticsearch(hosts=hosts,
+                                                        verify_certs=False,
+                                                        request_timeout=timeout,
+                                                        **CogStack._get_auth_details(username, password, api, api_key))
+
+    async def __aenter__(self) -> 'AsyncCogStack':
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """Close the connections of the underlying client."""
+        await self.elastic.close()
+
+    async def count(self, index: List, query: Dict, request_timeout: Optional[int] = 300) -> int:
+        """
+        Count the documents matching a query.
+
+        Args:
+            index (List[str]): A list of Elasticsearch index names to search.
+            query (Dict): A dictionary containing the search query parameters.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+
+        Returns:
+            int: The number of matching documents.
+        """
+        resp = await self.elastic.options(request_timeout=request_timeout).count(index=index, query=query['query'])
+        return resp['count']
+
+    async def get_docs_generator(self, index: List, query: Dict, es_gen_size: int = 800,
+                                 request_timeout: Optional[int] = 300, scroll: str = "5m") -> AsyncIterator[Dict]:
+        """
+        Iterate asynchronously through the documents in an Elasticsearch index.
+
+        The next batch is requested as soon as the current one is received, so it is retrieved
+        while the documents of the current batch are being processed. As with `helpers.scan`, the
+        documents are retrieved in `_doc` order (without scoring them) unless the query has a sort.
+
+        Args:
+            index (List[str]): A list of Elasticsearch index names to search.
+            query (Dict): A dictionary containing the search query parameters.
+            es_gen_size (int, optional): The number of documents to retrieve per batch. Defaults to 800.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+            scroll (str, optional): How long to keep the scroll context alive between batches. Defaults to "5m".
+
+        Yields:
+            Dict: The retrieved documents.
+        """
+        client = self.elastic.options(request_timeout=request_timeout)
+        search_kwargs = dict(query, scroll=scroll, size=es_gen_size)
+        search_kwargs.setdefault('sort', '_doc')
+        resp = await client.search(index=index, **search_kwargs)
+        scroll_id = resp.get('_scroll_id')
+        next_page: Optional[asyncio.Future] = None
+        try:
+            while scroll_id and resp['hits']['hits']:
+                next_page = asyncio.ensure_future(client.scroll(scroll_id=scroll_id, scroll=scroll))
+                for hit in resp['hits']['hits']:
+                    yield hit
+                resp = await next_page
+                next_page = None
+                scroll_id = resp.get('_scroll_id')
+        finally:
+            if next_page is not None:
+                # stopped early, don't leave the prefetch running
+                next_page.cancel()
+                with contextlib.suppress(asyncio.CancelledError, Exception):
+                    await next_page
+            if scroll_id:
+                await client.options(ignore_status=404).clear_scroll(scroll_id=scroll_id)
+
+    async def bulk_index(self, actions: Union[Iterable[Dict], AsyncIterable[Dict]], chunk_size: int = 500,
+                         max_retries: int = 3, initial_backoff: float = 2,
+                         request_timeout: Optional[int] = 300) -> Tuple[int, List[Dict]]:
+        """
+        Write documents to Elasticsearch asynchronously in bulk.
+
+        Chunks rejected with a 429 (too many requests) status are retried with an exponential backoff.
+
+        Args:
+            actions (Union[Iterable[Dict], AsyncIterable[Dict]]): The bulk actions (e.g {"_index": ..., "_id": ..., "_source": ...}).
+            chunk_size (int, optional): The number of actions per bulk request. Defaults to 500.
+            max_retries (int, optional): The number of times a rejected action is retried. Defaults to 3.
+            initial_backoff (float, optional): The time in seconds to wait before the first retry. Defaults to 2.
+            request_timeout (int, optional): The time in seconds to wait for a response from Elasticsearch before timing out. Defaults to 300.
+
+        Returns:
+            Tuple[int, List[Dict]]: The number of successful actions and the errors of the failed ones.
+        """
+        success, errors = await elasticsearch.helpers.async_bulk(self.elastic.options(request_timeout=request_timeout),
+                                                                 actions,
+                                                                 chunk_size=chunk_size,
+                                                                 max_retries=max_retries,
+                                                                 initial_backoff=initial_backoff,
+                                                                 raise_on_error=False)
+        return success, errors  # type: ignore
+
+
+class PageSizeController(object):
+    """
+    Adapts the number of documents retrieved per page to the response latency and payload size.
+
+    After every page, the page size that would have taken `target_latency` seconds and `target_mb` MB
+    (based on the time and size per document of that page) is estimated, and the page size is moved
+    toward the smaller of the two, by at most a factor of `max_step`, within `min_size` and `max_size`.
+    A timed out request shrinks the page size by `max_step`.
+
+    The payload size is taken from the `content-length` header of the responses, so the byte budget is
+    only applied when it's available. A controller can be shared between the slices of a retrieval.
+
+    Args:
+        initial_size (int, optional): The page size to start with. Defaults to 800.
+        min_size (int, optional): The smallest page size. Defaults to 10.
+        max_size (int, optional): The largest page size. Defaults to 10000.
+        target_latency (float, optional): The time in seconds a page should take. Defaults to 2.
+        target_mb (float, optional): The payload size in MB a page should have. Defaults to 20. None means no byte budget.
+        max_step (float, optional): The largest factor the page size is changed by at a time. Defaults to 2.
+    """
+    def __init__(self, initial_size: int = 800, min_size: int = 10, max_size: int = 10000,
+                 target_latency: float = 2, target_mb: Optional[float] = 20, max_step: float = 2):
+        if not 0 < min_size <= max_size:
+            raise ValueError(f"Invalid page size bounds: {min_size} - {max_size}")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.target_bytes = target_mb * 1024 ** 2 if target_mb is not None else None
+        self.max_step = max_step
+        self.size = self._clamp(initial_size)
+        self._lock = threading.Lock()
+
+    def _clamp(self, size: float) -> int:
+        return int(min(max(size, self.min_size), self.max_size))
+
+    def __int__(self) -> int:
+        return self.size
+
+    def update(self, nr_of_hits: int, elapsed: float, nr_of_bytes: int = 0) -> int:
+        """
+        Update the page size with the response of a page.
+
+        Args:
+            nr_of_hits (int): The number of hits in the page.
+            elapsed (float): The time in seconds the request took.
+            nr_of_bytes (int, optional): The payload size of the response. Defaults to 0 (i.e unknown).
+
+        Returns:
+            int: The new page size.
+        """
+        if nr_of_hits == 0 or elapsed <= 0:
+            # an empty (last) page says nothing about the cost per document
+            return self.size
+        target = nr_of_hits * self.target_latency / elapsed
+        if nr_of_bytes and self.target_bytes is not None:
+            target = min(target, nr_of_hits * self.target_bytes / nr_of_bytes)
+        with self._lock:
+            step = min(max(target / self.size, 1 / self.max_step), self.max_step)
+            self.size = self._clamp(self.size * step)
+            return self.size
+
+    def shrink(self) -> int:
+        """
+        Shrink the page size after a timed out request.
+
+        Returns:
+            int: The new page size.
+        """
+        with self._lock:
+            self.size = self._clamp(self.size / self.max_step)
+            return self.size
+
+
+class ResultCache(object):
+    """
+    An on-disk cache of `cogstack2df` results.
+
+    Results are keyed by a hash of the cluster, index, query and column headers, and stored as
+    uncompressed Arrow IPC files so that a cache hit can be loaded memory-mapped.
+    Results older than `ttl` are ignored and removed. Once the cache grows beyond `max_size_mb`,
+    the least recently used results are removed.
+
+    Results that cannot be converted to Arrow (e.g columns of mixed types) are not cached.
+
+    Args:
+        cache_dir (str): The directory to keep the cached results in.
+        ttl (float, optional): The time in seconds a result is valid for. Defaults to one day. None means no expiry.
+        max_size_mb (float, optional): The maximum size of the cache in MB. Defaults to 10240. None means no limit.
+    """
+    def __init__(self, cache_dir: str, ttl: Optional[float] = 24 * 60 * 60, max_size_mb: Optional[float] = 10240):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size_mb * 1024 ** 2 if max_size_mb is not None else None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(index: Any, query: Dict, column_headers: Optional[List[str]] = None,
+                cluster: Optional[str] = None) -> str:
+        return hashlib.sha256(json.dumps({'cluster': cluster, 'index': index, 'query': query,
+                                          'column_headers': column_headers},
+                                         sort_keys=True, default=str).encode()).hexdigest()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.arrow")
+
+    def _is_expired(self, path: str) -> bool:
+        # the modification time is the time the result was cached
+        return self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl
+
+    def get(self, index: Any, query: Dict, column_headers: Optional[List[str]] = None,
+            cluster: Optional[str] = None) -> Optional[pd.DataFrame]:
+        """
+        Get a cached result.
+
+        Args:
+            index (Any): The index (or indices) searched.
+            query (Dict): The search query.
+            column_headers (List[str], optional): The column headers used. Defaults to None.
+            cluster (str, optional): The cluster searched (see `CogStack.get_cluster_id`). Defaults to None.
+
+        Returns:
+            Optional[pandas.DataFrame]: The cached result, or None if it's not cached (or expired).
+        """
+        path = self._get_path(self.get_key(index, query, column_headers, cluster))
+        if not os.path.exists(path):
+            return None
+        if self._is_expired(path):
+            os.remove(path)
+            return None
+        with pa.memory_map(path) as source:
+            df = pa.ipc.open_file(source).read_all().to_pandas()
+        # the access time is used for least recently used eviction
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+        return df
+
+    def put(self, index: Any, query: Dict, column_headers: Optional[List[str]], df: pd.DataFrame,
+            cluster: Optional[str] = None) -> None:
+        """
+        Cache a result, removing the least recently used results if the cache grows too large.
+
+        Args:
+            index (Any): The index (or indices) searched.
+            query (Dict): The search query.
+            column_headers (List[str], optional): The column headers used.
+            df (pandas.DataFrame): The result.
+            cluster (str, optional): The cluster searched (see `CogStack.get_cluster_id`). Defaults to None.
+        """
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            return
+        path = self._get_path(self.get_key(index, query, column_headers, cluster))
+        temp_path = f"{path}.tmp"
+        with pa.OSFile(temp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temp_path, path)
+        self._evict()
+
+    def invalidate(self, index: Any = None, query: Optional[Dict] = None,
+                   column_headers: Optional[List[str]] = None, cluster: Optional[str] = None) -> None:
+        """
+        Remove a cached result, or all of them if no index and query are specified.
+
+        Args:
+            index (Any, optional): The index (or indices) searched. Defaults to None.
+            query (Dict, optional): The search query. Defaults to None.
+            column_headers (List[str], optional): The column headers used. Defaults to None.
+            cluster (str, optional): The cluster searched (see `CogStack.get_cluster_id`). Defaults to None.
+        """
+        if index is None and query is None:
+            paths = self._get_paths()
+        else:
+            paths = [self._get_path(self.get_key(index, query or {}, column_headers, cluster))]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _get_paths(self) -> List[str]:
+        return [os.path.join(self.cache_dir, file_name) for file_name in os.listdir(self.cache_dir)
+                if file_name.endswith('.arrow')]
+
+    def _evict(self) -> None:
+        paths = []
+        for path in self._get_paths():
+            if self._is_expired(path):
+                os.remove(path)
+            else:
+                paths.append(path)
+        if self.max_size is None:
+            return
+        size = sum(os.path.getsize(path) for path in paths)
+        for path in sorted(paths, key=os.path.getatime):
+            if size <= self.max_size:
+                break
+            size -= os.path.getsize(path)
+            os.remove(path)
+
+
+class _RetrievalProgress(object):
+    """
+    Keeps track of the total number of hits and the throughput of a retrieval.
+
+    The total is taken from the first response that reports it and the payload size
+    from the `content-length` header of the responses (when available).
+    """
+    def __init__(self) -> None:
+        self.total: Optional[int] = None
+        self.docs = 0
+        self.bytes = 0
+        self.start_time = time.perf_counter()
+
+    def update(self, resp: Any) -> None:
+        """Take the total and payload size from a search response."""
+        if self.total is None:
+            total = resp['hits'].get('total')
+            if isinstance(total, dict):
+                total = total.get('value')
+            self.total = total
+        self.bytes += _get_response_size(resp)
+
+    def rates(self) -> Dict[str, float]:
+        elapsed = max(time.perf_counter() - self.start_time, 1e-9)
+        return {'docs/s': self.docs / elapsed, 'MB/s': self.bytes / 1024 ** 2 / elapsed}
+
+    def iter_hits(self, pages: Iterable[List[Dict]], progress_bar: Any) -> Iterator[Dict]:
+        """Iterate over the hits of the pages while updating the progress bar."""
+        with progress_bar:
+            for page in pages:
+                self.docs += len(page)
+                if progress_bar.total is None and self.total is not None:
+                    # setting the total does not update the bar of tqdm.notebook
+                    progress_bar.reset(total=self.total)
+                progress_bar.update(len(page))
+                progress_bar.set_postfix({name: f"{rate:.1f}" for name, rate in self.rates().items()})
+                yield from page
+
+
+class _ColumnarBuffer(object):
+    """
+    Accumulates Elasticsearch hits into per-column buffers and converts them into DataFrame chunks.
+
+    The `_index` and `_id` columns are kept as lists of strings and `_score` as a typed array of floats
+    (missing scores become NaN). The `_source` fields are kept as one list per field.
+    Columns that can not be spilled to Parquet (e.g a field holding both strings and numbers)
+    are kept in memory with the rest of their chunk spilled.
+
+    Args:
+        column_headers (List[str], optional): The `_source` fields to keep. If not provided, all fields are kept.
+        chunk_size (int): The number of hits per DataFrame chunk.
+        memory_budget_mb (float, optional): The memory (in MB) the chunks are allowed to take before being spilled to disk.
+        spill_dir (str, optional): The directory to spill the chunks to. If not provided, a temporary directory is used.
+    """
+    def __init__(self, column_headers: Optional[List[str]] = None, chunk_size: int = 100000,
+                 memory_budget_mb: Optional[float] = None, spill_dir: Optional[str] = None):
+        self.column_headers = column_headers
+        self.chunk_size = max(1, chunk_size)
+        self.memory_budget = memory_budget_mb * 1024 ** 2 if memory_budget_mb is not None else None
+        self.spill_dir = spill_dir
+        self._temp_dir: Optional[tempfile.TemporaryDirectory] = None
+        self._chunks: List[pd.DataFrame] = []
+        self._chunks_size = 0
+        # the file of each spilled chunk, its columns and those kept in memory (if any)
+        self._spilled: List[Tuple[str, List[str], Optional[pd.DataFrame]]] = []
+        self._reset()
+
+    def _reset(self) -> None:
+        self._index: List[str] = []
+        self._id: List[str] = []
+        self._score = array('d')
+        self._fields: Dict[str, List[Any]] = {field: [] for field in self.column_headers or []}
+        self._rows = 0
+
+    def append(self, hit: Dict) -> None:
+        self._index.append(hit['_index'])
+        self._id.append(hit['_id'])
+        score = hit.get('_score')
+        self._score.append(float('nan') if score is None else score)
+        source = hit.get('_source', {})
+        for field, values in self._fields.items():
+            values.append(source.get(field))
+        if self.column_headers is None:
+            for field, value in source.items():
+                if field not in self._fields:
+                    # field not seen before in this chunk, pad earlier rows
+                    self._fields[field] = [None] * self._rows + [value]
+        self._rows += 1
+        if self._rows >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Convert the buffered hits into a DataFrame chunk and spill to disk if over the memory budget."""
+        if not self._rows:
+            return
+        columns: Dict[str, Any] = {'_index': self._index, '_id': self._id, '_score': self._score}
+        columns.update(self._fields)
+        chunk = pd.DataFrame(columns)
+        self._reset()
+        self._chunks.append(chunk)
+        self._chunks_size += int(chunk.memory_usage(deep=True).sum())
+        if self.memory_budget is not None and self._chunks_size > self.memory_budget:
+            self._spill()
+
+    def _get_spill_dir(self) -> str:
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            return self.spill_dir
+        if self._temp_dir is None:
+            self._temp_dir = tempfile.TemporaryDirectory()
+        return self._temp_dir.name
+
+    def _spill(self) -> None:
+        spill_dir = self._get_spill_dir()
+        for chunk in self._chunks:
+            file_name = os.path.join(spill_dir, f"chunk_{len(self._spilled):05d}.parquet")
+            kept = None
+            try:
+                chunk.to_parquet(file_name, index=False)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                kept_columns = [column for column in chunk.columns if not _is_arrow_convertible(chunk[column])]
+                chunk.drop(columns=kept_columns).to_parquet(file_name, index=False)
+                kept = chunk[kept_columns].reset_index(drop=True)
+            self._spilled.append((file_name, list(chunk.columns), kept))
+        self._chunks = []
+        self._chunks_size = 0
+
+    def to_df(self) -> pd.DataFrame:
+        """
+        Build the final DataFrame from the spilled and in-memory chunks.
+
+        Returns:
+            pandas.DataFrame: A DataFrame containing all the appended hits.
+        """
+        self.flush()
+        chunks = [_read_spilled_chunk(*spilled) for spilled in self._spilled] + self._chunks
+        self._chunks = []
+        if self._temp_dir is not None:
+            self._temp_dir.cleanup()
+            self._temp_dir = None
+        if not chunks:
+            columns = ['_index', '_id', '_score'] + (self.column_headers or [])
+            return pd.DataFrame(columns=columns)
+        df = pd.concat(chunks, ignore_index=True)
+        if self.column_headers:
+            df = df[['_index', '_id', '_score'] + list(self.column_headers)]
+        return df
+
+
+class _RecordBatchWriter(_ColumnarBuffer):
+    """
+    Accumulates Elasticsearch hits into per-column buffers and writes them to disk as Arrow record batches.
+
+    Every `row_group_size` hits a record batch is written to the current file. A new file is started
+    once the current one holds `rows_per_file` rows or when the schema changes (i.e a new field appears
+    or a field that was only null so far gets values). The type of a field is set by the first
+    non-null values seen and later values are converted to it if that can be done without loss.
+    Integer fields that get floating point values are widened to doubles (which starts a new file).
+
+    Args:
+        output_dir (str): The directory to write the files to.
+        file_format (str): Either "parquet" or "arrow" (uncompressed Arrow IPC).
+        column_headers (List[str], optional): The `_source` fields to keep. If not provided, all fields are kept.
+        row_group_size (int): The number of hits per record batch.
+        rows_per_file (int): The maximum number of rows per file.
+    """
+    def __init__(self, output_dir: str, file_format: str, column_headers: Optional[List[str]] = None,
+                 row_group_size: int = 100000, rows_per_file: int = 1000000):
+        super().__init__(column_headers=column_headers, chunk_size=row_group_size)
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.rows_per_file = max(1, rows_per_file)
+        self._types: Dict[str, pa.DataType] = {}
+        self._writer: Any = None
+        self._schema: Optional[pa.Schema] = None
+        self._file_rows = 0
+        self.files: List[str] = []
+        self.schemas: List[pa.Schema] = []
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _to_array(self, field: str, values: List[Any]) -> pa.Array:
+        field_type = self._types.get(field)
+        try:
+            arr = pa.array(values)
+            if arr.type == pa.null():
+                return arr if field_type is None else arr.cast(field_type)
+            if field_type is None or arr.type == field_type:
+                self._types[field] = arr.type
+                return arr
+            if pa.types.is_integer(field_type) and pa.types.is_floating(arr.type):
+                # e.g 1 and 2.5 in the same field of different documents
+                self._types[field] = pa.float64()
+                return arr.cast(pa.float64())
+            return arr.cast(field_type, safe=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError) as e:
+            raise ValueError(f"The values of field '{field}' can not be converted to {field_type}: {e}")
+
+    def flush(self) -> None:
+        """Write the buffered hits as a record batch."""
+        if not self._rows:
+            return
+        columns: Dict[str, pa.Array] = {'_index': pa.array(self._index, type=pa.string()),
+                                        '_id': pa.array(self._id, type=pa.string()),
+                                        '_score': pa.array(self._score, type=pa.float64())}
+        columns.update({field: self._to_array(field, values) for field, values in self._fields.items()})
+        batch = pa.RecordBatch.from_pydict(columns)
+        self._reset()
+        if self._writer is not None and (self._file_rows >= self.rows_per_file or batch.schema != self._schema):
+            self._close_file()
+        if self._writer is None:
+            self._open_file(batch.schema)
+        self._writer.write_batch(batch)
+        self._file_rows += batch.num_rows
+
+    def _open_file(self, schema: pa.Schema) -> None:
+        file_name = os.path.join(self.output_dir, f"part-{len(self.files):05d}.{self.file_format}")
+        if self.file_format == 'parquet':
+            self._writer = pq.ParquetWriter(file_name, schema)
+        else:
+            self._writer = pa.ipc.new_file(file_name, schema)
+        self._schema = schema
+        self._file_rows = 0
+        self.files.append(file_name)
+        self.schemas.append(schema)
+
+    def _close_file(self) -> None:
+        self._writer.close()
+        self._writer = None
+
+    def close(self) -> None:
+        """Write the remaining hits and close the current file."""
+        self.flush()
+        if self._writer is not None:
+            self._close_file()
+
+    def to_dataset(self):
+        """
+        Open the files written as a single dataset.
+
+        Returns:
+            pyarrow.dataset.Dataset: The dataset, with the schemas of the files unified.
+        """
+        if self.schemas:
+            # fields widened from integers to doubles are read as doubles
+            schema = pa.unify_schemas(self.schemas, promote_options='permissive')
+        else:
+            fields = ['_index', '_id', '_score'] + (self.column_headers or [])
+            schema = pa.schema([(field, pa.float64() if field == '_score' else pa.string()) for field in fields])
+        return ds.dataset(self.files, schema=schema, format='ipc' if self.file_format == 'arrow' else 'parquet')
+
+
+class _RetrievalCheckpoint(object):
+    """
+    The progress of a resumable retrieval, kept in a small JSON file.
+
+    For every slice the sort values of the last consumed batch, the number of emitted documents and
+    whether the slice is done are kept. The file also keeps a hash of the retrieval parameters so
+    that a checkpoint is not applied to a different retrieval.
+
+    Args:
+        file_name (str): The path of the checkpoint file.
+        index (List[str]): The Elasticsearch index names searched.
+        query (Dict): The search query.
+        sort (List): The sort paged through.
+        slices (int, optional): The number of slices.
+
+    Raises:
+        ValueError: If the checkpoint file exists, but belongs to a different retrieval.
+    """
+    def __init__(self, file_name: str, index: List, query: Dict, sort: List, slices: Optional[int] = None):
+        self.file_name = file_name
+        self.retrieval_hash = hashlib.sha1(json.dumps({"index": index, "query": query, "sort": sort,
+                                                       "slices": slices},
+                                                      sort_keys=True, default=str).encode()).hexdigest()
+        self.slices: Dict[str, Dict[str, Any]] = {str(slice_id): {"search_after": None, "emitted": 0, "done": False}
+                                                  for slice_id in range(slices or 1)}
+        if os.path.exists(file_name):
+            with open(file_name) as f:
+                state = json.load(f)
+            if state["retrieval_hash"] != self.retrieval_hash:
+                raise ValueError(f"The checkpoint file '{file_name}' belongs to a different retrieval. "
+                                 "Remove it or use a different checkpoint file.")
+            self.slices = state["slices"]
+
+    @property
+    def emitted(self) -> int:
+        return sum(state["emitted"] for state in self.slices.values())
+
+    def remaining_slices(self) -> List[int]:
+        return [int(slice_id) for slice_id, state in self.slices.items() if not state["done"]]
+
+    def search_after(self, slice_id: int) -> Optional[List]:
+        return self.slices[str(slice_id)]["search_after"]
+
+    def page_done(self, slice_id: int, page: List[Dict]) -> None:
+        state = self.slices[str(slice_id)]
+        state["search_after"] = page[-1]["sort"]
+        state["emitted"] += len(page)
+
+    def slice_done(self, slice_id: int) -> None:
+        self.slices[str(slice_id)]["done"] = True
+
+    def save(self) -> None:
+        """Write the checkpoint to a temporary file first so that it's never left half written."""
+        temp_file_name = f"{self.file_name}.tmp"
+        with open(temp_file_name, 'w') as f:
+            json.dump({"retrieval_hash": self.retrieval_hash, "emitted": self.emitted, "slices": self.slices}, f)
+        os.replace(temp_file_name, self.file_name)
+
+    def remove(self) -> None:
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+
+def _check_engine(engine: str) -> None:
+    if engine not in ("scroll", "pit"):
+        raise ValueError(f"Unknown retrieval engine '{engine}'. Use 'scroll' or 'pit'.")
+
+
+def terms_queries(field: str, values: List[Any], terms_per_query: int = 1000, size: int = 10000,
+                  search_params: Optional[Dict] = None) -> List[Dict]:
+    """
+    Split a terms lookup on a long list of values into several queries (e.g for `CogStack.multi_search`).
+
+    Args:
+        field (str): The field to look the values up in.
+        values (List[Any]): The values to look up.
+        terms_per_query (int, optional): The number of values per query. Defaults to 1000.
+        size (int, optional): The number of hits to return per query. Defaults to 10000.
+        search_params (Dict, optional): Any other search parameters (e.g `_source`) to add to each query. Defaults to None.
+
+    Returns:
+        List[Dict]: The queries, one per chunk of values.
+    """
+    return [dict(search_params or {}, size=size, query={'terms': {field: chunk}})
+            for chunk in list_chunker(values, terms_per_query)]
+
+
+def _get_missing_hits(resp: Dict) -> Optional[str]:
+    """The number of hits a search response left out (e.g "5" or "at least 1"), or None if it has all of them."""
+    hits = resp['hits']
+    total = hits.get('total')
+    if total is None:
+        # not tracked
+        return None
+    value, relation = (total['value'], total.get('relation', 'eq')) if isinstance(total, dict) else (total, 'eq')
+    nr_of_hits = len(hits['hits'])
+    if relation == 'eq':
+        return str(value - nr_of_hits) if value > nr_of_hits else None
+    # a lower bound (i.e more than track_total_hits)
+    return f"at least {max(value - nr_of_hits, 1)}"
+
+
+def _is_arrow_convertible(values: pd.Series) -> bool:
+    try:
+        pa.array(values, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return False
+    return True
+
+
+def _read_spilled_chunk(file_name: str, columns: List[str], kept: Optional[pd.DataFrame]) -> pd.DataFrame:
+    chunk = pd.read_parquet(file_name)
+    if kept is None:
+        return chunk
+    return pd.concat([chunk, kept], axis=1)[columns]
+
+
+def _hits_to_df(hits: Iterable[Dict], column_headers: Optional[List[str]] = None) -> pd.DataFrame:
+    temp_results = []
+    for hit in hits:
+        row = dict()
+        row['_index'] = hit['_index']
+        row['_id'] = hit['_id']
+        row['_score'] = hit['_score']
+        row.update(hit['_source'])
+        temp_results.append(row)
+    if column_headers:
+        df_headers = ['_index', '_id', '_score']
+        df_headers.extend(column_headers)
+        return pd.DataFrame(temp_results, columns=df_headers)
+    return pd.DataFrame(temp_results)
+
+
+def _check_page_size(es_gen_size: Union[int, PageSizeController], engine: str) -> None:
+    if isinstance(es_gen_size, PageSizeController) and engine != "pit":
+        raise ValueError("Adaptive page sizing needs the 'pit' engine, "
+                         "the page size of a scroll is fixed when it is opened")
+
+
+def _get_response_size(resp: Any) -> int:
+    meta = getattr(resp, 'meta', None)
+    if meta is None:
+        return 0
+    return int(meta.headers.get('content-length', 0))
+
+
+def _get_field(source: Dict, field: str) -> Any:
+    """Get a (potentially nested, dot separated) field from a document source, or None if it's missing."""
+    if field in source:
+        return source[field]
+    value: Any = source
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _get_bulk_status(item: Dict) -> Optional[int]:
+    """Get the status of a bulk response item (e.g {"index": {"status": 201, ...}})."""
+    for result in item.values():
+        return result.get('status')
+    return None
+
 
 def list_chunker(user_list: List[Any], n: int) -> List[List[Any]]:
     """
@@ -25,11 +25,12 @@ model_pack_name = ''
 output_modelpack_name = ''  # name of modelpack to save
 
 cs = CogStack(hosts, username=username, password=password, api=True)
-df = cs.DataFrame(index=cogstack_indices, columns=text_columns)  # type: ignore
+# only the text fields are retrieved, one text per field per document
+texts = (text for _, text in cs.get_text_generator(index=cogstack_indices, text_fields=text_columns))
 
 cat = CAT.load_model_pack(model_pack_path+model_pack_name)
 cat.cdb.print_stats()
-cat.train(data_iterator=df[text_columns].iterrows(),
+cat.train(data_iterator=texts,
           nepochs=1,
           fine_tune=True,
           progress_print=10000,
@@ -0,0 +1,551 @@
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Set, Tuple, Any, Optional
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import cProfile
+import heapq
+import io
+import json
+import logging
+import multiprocessing
+import os
+import pstats
+import queue
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None  # type: ignore
+
+from annotation_sinks import AnnotationWriteError
+
+
+logger = logging.getLogger('medcat')
+
+# the model used by the annotation worker processes
+_worker_cat: Any = None
+# the time spent in each spaCy component of the worker process
+_worker_timings: Dict[str, float] = {}
+
+
+class _TimedComponent:
+    """Wraps a spaCy component (or the tokenizer) to add up the time spent in it."""
+
+    def __init__(self, name: str, component, timings: Dict[str, float]):
+        self._name = name
+        self._component = component
+        self._timings = timings
+
+    def __call__(self, *args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return self._component(*args, **kwargs)
+        finally:
+            self._timings[self._name] = self._timings.get(self._name, 0.0) + time.perf_counter() - start_time
+
+    def __getattr__(self, name: str):
+        return getattr(self._component, name)
+
+
+def _time_components(cat, timings: Dict[str, float]) -> None:
+    # this relies on the internals of MedCAT (the spaCy pipeline of the Pipe) and spaCy (the list of components)
+    nlp = getattr(getattr(cat, 'pipe', None), '_nlp', None)
+    if nlp is None or not isinstance(getattr(nlp, '_components', None), list):
+        return
+    nlp.tokenizer = _TimedComponent('tokenizer', nlp.tokenizer, timings)
+    nlp._components = [(name, _TimedComponent(name, component, timings)) for name, component in nlp._components]
+
+
+def _max_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _init_worker(cat, time_components: bool = True) -> None:
+    global _worker_cat
+    _worker_cat = cat
+    if time_components:
+        _time_components(cat, _worker_timings)
+
+
+def _annotate_batch(batch: List[Tuple[Any, str]], only_cui: bool, addl_info: List[str],
+                    profile: bool = False) -> Tuple[List[Tuple[Any, Dict]], Dict[str, Any]]:
+    out = []
+    _worker_timings.clear()
+    profiler = cProfile.Profile() if profile else None
+    start_time = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    for doc_id, text in batch:
+        try:
+            out.append((doc_id, _worker_cat.get_entities(text, only_cui=only_cui, addl_info=addl_info)))
+        except Exception as e:
+            logger.warning("Failed to annotate document %s: %s", doc_id, e)
+    if profiler is not None:
+        profiler.disable()
+    metrics = {'pid': os.getpid(), 'busy': time.perf_counter() - start_time,
+               'entities': sum(len(doc['entities']) for _, doc in out),
+               'components': dict(_worker_timings), 'max_rss_mb': _max_rss_mb()}
+    if profiler is not None:
+        profile_stats = io.StringIO()
+        pstats.Stats(profiler, stream=profile_stats).sort_stats('cumulative').print_stats(30)
+        metrics['profile'] = profile_stats.getvalue()
+    return out, metrics
+
+
+class _Piece(NamedTuple):
+    """The key of a piece of a document that was split into several work items."""
+    doc_id: Any
+    offset: int
+    nr: int
+    nr_of_pieces: int
+
+
+def _split_text(text: str, max_chars: int) -> List[Tuple[int, str]]:
+    # split at the last line break (or else space) before the limit, so words are not cut
+    pieces = []
+    offset = 0
+    while len(text) - offset > max_chars:
+        end = offset + max_chars
+        split = text.rfind('\n', offset + max_chars // 2, end)
+        if split == -1:
+            split = text.rfind(' ', offset + max_chars // 2, end)
+        split = end if split == -1 else split + 1
+        pieces.append((offset, text[offset:split]))
+        offset = split
+    pieces.append((offset, text[offset:]))
+    return pieces
+
+
+def _nr_of_docs(batch: List[Tuple[Any, str]]) -> int:
+    return sum(1 for key, _ in batch if not isinstance(key, _Piece) or key.nr == 0)
+
+
+def length_aware_batches(data: Iterable[Tuple[Any, str]], batch_size_chars: int, window_chars: int,
+                         max_doc_chars: Optional[int] = None) -> Iterator[List[Tuple[Any, str]]]:
+    """Group documents into batches of balanced numbers of characters.
+
+    The documents are read in windows of `window_chars` characters. Each window is packed into
+    (about) `window_chars / batch_size_chars` batches by adding the documents, longest first, to
+    the batch with the fewest characters so far. This keeps the batches balanced when short and
+    very long documents are mixed, so no worker is left with a batch much larger than the others.
+
+    Documents longer than `max_doc_chars` are split into pieces (at line breaks or spaces where
+    possible) which become separate work items, keyed by `_Piece`. Entities spanning the split
+    points are not found.
+
+    Args:
+        data (Iterable[Tuple[Any, str]]): The documents (doc_id, text).
+        batch_size_chars (int): The number of characters per batch.
+        window_chars (int): The number of characters to read ahead and pack at a time.
+        max_doc_chars (int, optional): The length above which documents are split. Defaults to None (i.e `batch_size_chars`).
+
+    Yields:
+        List[Tuple[Any, str]]: The batches of (doc_id or `_Piece`, text).
+    """
+    max_doc_chars = max(1, max_doc_chars or batch_size_chars)
+
+    def _pack(window: List[Tuple[Any, str]], window_size: int) -> Iterator[List[Tuple[Any, str]]]:
+        nr_of_batches = max(1, round(window_size / batch_size_chars))
+        # (number of characters, batch number) of each batch
+        sizes = [(0, nr) for nr in range(nr_of_batches)]
+        batches: List[List[Tuple[Any, str]]] = [[] for _ in range(nr_of_batches)]
+        for key, text in sorted(window, key=lambda item: len(item[1]), reverse=True):
+            size, nr = heapq.heappop(sizes)
+            batches[nr].append((key, text))
+            heapq.heappush(sizes, (size + len(text), nr))
+        return (batch for batch in batches if batch)
+
+    window: List[Tuple[Any, str]] = []
+    window_size = 0
+    for doc_id, text in data:
+        if len(text) > max_doc_chars:
+            pieces = _split_text(text, max_doc_chars)
+            items = [(_Piece(doc_id, offset, nr, len(pieces)), piece) for nr, (offset, piece) in enumerate(pieces)]
+        else:
+            items = [(doc_id, text)]
+        for item in items:
+            window.append(item)
+            window_size += len(item[1])
+        if window_size >= window_chars:
+            yield from _pack(window, window_size)
+            window, window_size = [], 0
+    if window:
+        yield from _pack(window, window_size)
+
+
+def _merge_pieces(pieces: List[Tuple[_Piece, Dict]]) -> Dict:
+    # shift the entities of each piece to their place in the whole document
+    entities: Dict[int, Any] = {}
+    for piece, doc in sorted(pieces, key=lambda item: item[0].offset):
+        for entity in doc['entities'].values():
+            if isinstance(entity, dict):
+                entity = dict(entity, start=entity['start'] + piece.offset, end=entity['end'] + piece.offset)
+                if 'id' in entity:
+                    entity['id'] = len(entities)
+            entities[len(entities)] = entity
+    return {'entities': entities, 'tokens': []}
+
+
+class _RetrievalError:
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class PipelineStats:
+    """Keeps track of the throughput of each stage of an `AnnotationPipeline` and its queue depths.
+
+    The stages are `retrieve` (reading the documents), `annotate` (the worker processes) and
+    `write` (the sink). For each stage the number of documents and characters it has handled
+    and the time spent in it are kept. For the annotation, the time spent in it as measured
+    by the workers themselves (and per spaCy component), the number of entities and the memory
+    high-water mark of each worker are kept as well.
+
+    Args:
+        nproc (int): The number of worker processes, for the worker utilisation. Defaults to 1.
+    """
+
+    STAGES = ('retrieve', 'annotate', 'write')
+
+    def __init__(self, nproc: int = 1) -> None:
+        self.nproc = nproc
+        self.start_time = time.perf_counter()
+        self.docs = {stage: 0 for stage in self.STAGES}
+        self.chars = {stage: 0 for stage in self.STAGES}
+        self.busy = {stage: 0.0 for stage in self.STAGES}
+        self.entities = 0
+        self.worker_busy = 0.0
+        self.components: Dict[str, float] = {}
+        self.worker_max_rss_mb: Dict[int, float] = {}
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.in_flight = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, docs: int, chars: int, busy: float = 0.0) -> None:
+        with self._lock:
+            self.docs[stage] += docs
+            self.chars[stage] += chars
+            self.busy[stage] += busy
+
+    def add_worker_metrics(self, metrics: Dict[str, Any]) -> None:
+        """Add the metrics a worker measured for a batch."""
+        with self._lock:
+            self.entities += metrics['entities']
+            self.worker_busy += metrics['busy']
+            for name, seconds in metrics['components'].items():
+                self.components[name] = self.components.get(name, 0.0) + seconds
+            if metrics['max_rss_mb'] is not None:
+                self.worker_max_rss_mb[metrics['pid']] = metrics['max_rss_mb']
+
+    def set_depths(self, queue_depth: int, in_flight: int) -> None:
+        self.queue_depth = queue_depth
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        self.in_flight = in_flight
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Get a snapshot of the stats.
+
+        Returns:
+            Dict[str, Any]: The elapsed time, the docs, chars, docs/s and chars/s of each stage,
+                the entities (and entities/s), the worker utilisation, the time spent per spaCy component,
+                the memory high-water marks (in MB) and the queue depths.
+        """
+        elapsed = max(time.perf_counter() - self.start_time, 1e-9)
+        with self._lock:
+            stages = {stage: {'docs': self.docs[stage], 'chars': self.chars[stage], 'busy': self.busy[stage],
+                              'docs/s': self.docs[stage] / elapsed, 'chars/s': self.chars[stage] / elapsed}
+                      for stage in self.STAGES}
+            worker_max_rss_mb = max(self.worker_max_rss_mb.values(), default=None)
+            return {'elapsed': elapsed, 'stages': stages, 'entities': self.entities,
+                    'entities/s': self.entities / elapsed,
+                    'worker_utilisation': self.worker_busy / (self.nproc * elapsed),
+                    'components': dict(self.components),
+                    'max_rss_mb': {'main': _max_rss_mb(), 'worker': worker_max_rss_mb},
+                    'queue_depth': self.queue_depth, 'max_queue_depth': self.max_queue_depth,
+                    'in_flight': self.in_flight, 'failed': self.failed}
+
+    def report(self) -> str:
+        """Summarise the stats.
+
+        Returns:
+            str: The summary.
+        """
+        stats = self.as_dict()
+        stages = ", ".join(f"{stage} {values['docs']} docs ({values['docs/s']:.1f} docs/s)"
+                           for stage, values in stats['stages'].items())
+        return (f"Pipeline after {stats['elapsed']:.0f}s: {stages}; {stats['entities/s']:.1f} entities/s, "
+                f"workers {100 * stats['worker_utilisation']:.0f}% busy; queue depth {stats['queue_depth']} "
+                f"(max {stats['max_queue_depth']}), {stats['in_flight']} batches annotating, "
+                f"{stats['failed']} docs failed")
+
+
+class AnnotationPipeline:
+    """Annotates documents with retrieval, annotation and writing running at the same time.
+
+    A retrieval thread reads the documents, groups them into balanced batches of about `batch_size_chars`
+    characters (see `length_aware_batches`) and puts them on a bounded queue of `prefetch_batches` batches.
+    The batches are annotated by a pool of `nproc` worker processes, with at most `max_in_flight`
+    batches submitted at a time. Once `chunk_size_chars` characters have been annotated, the
+    annotations are written to the sink. When the workers fall behind, the queue fills up and the
+    retrieval waits (and vice versa), so only a bounded number of documents is held in memory.
+
+    If a `ledger` (e.g `CompletionLedger`) is given, the documents it has recorded as completed are
+    skipped and the documents of every write are recorded in it once the sink has written them
+    (along with the part number returned by the sink's `write`, if any). Documents whose annotations
+    the sink failed to write (see `AnnotationWriteError`) are counted as failed and not recorded,
+    so that they are annotated again on restart.
+
+    The worker processes are forked with the model where possible (i.e not on Windows),
+    otherwise the model is pickled to each of them. They are started before the retrieval thread,
+    so that they are not forked from a multi-threaded process.
+
+    As in `CAT.multiprocessing_batch_char_size`, the neural network components of the model (MetaCAT and
+    transformer NER) are not run by the workers with `separate_nn_components`, since torch does not work
+    well in forked processes. They are run in the main process on the annotations of every write instead,
+    where they can batch many documents at once (and use the GPU).
+
+    The stats (see `PipelineStats`) are logged every `report_interval` seconds and, if `metrics_path`
+    is given, appended to it as JSON lines (`"event": "stats"`). With `profile_every`, every so many
+    batches is annotated under cProfile and the top of its profile is appended as a `"profile"` event.
+
+    Args:
+        cat (CAT): The model to annotate with.
+        sink: The sink to write the annotations to (e.g `ElasticAnnotationSink` or `PickleAnnotationSink`).
+        nproc (int): The number of worker processes. Defaults to 8.
+        batch_size_chars (int): The number of characters per batch sent to a worker. Defaults to 500000.
+        chunk_size_chars (int): The number of characters to annotate before writing to the sink. Defaults to 10000000.
+        prefetch_batches (int, optional): The maximum number of retrieved batches waiting to be annotated.
+            Defaults to None (i.e `2 * nproc`).
+        max_in_flight (int, optional): The maximum number of batches submitted to the workers.
+            Defaults to None (i.e `2 * nproc`).
+        only_cui (bool): Whether to only return the CUIs rather than the full annotations. Defaults to False.
+        addl_info (List[str]): The additional information to add to the annotations. Defaults to [].
+        report_interval (float): The time in seconds between logging the stats. Defaults to 60.
+        ledger (optional): The ledger to skip and record the completed documents with. Defaults to None.
+        window_chars (int, optional): The number of characters read ahead to pack into balanced batches.
+            Defaults to None (i.e `nproc * batch_size_chars`, a batch per worker).
+        max_doc_chars (int, optional): The length above which documents are split into separate work items.
+            Defaults to None (i.e `batch_size_chars`).
+        metrics_path (str, optional): The JSON lines file to append the metrics to. Defaults to None.
+        profile_every (int, optional): Profile one in this many batches. Defaults to None (i.e no profiling).
+        time_components (bool): Whether to time the spaCy components of the model (the tokenizer, NER, linking, ...)
+            in the workers. Defaults to True.
+        separate_nn_components (bool): Whether to run the neural network components in the main process
+            rather than in the workers. Defaults to True.
+    """
+
+    def __init__(self, cat, sink, nproc: int = 8, batch_size_chars: int = 500000,
+                 chunk_size_chars: int = 10000000, prefetch_batches: Optional[int] = None,
+                 max_in_flight: Optional[int] = None, only_cui: bool = False,
+                 addl_info: Optional[List[str]] = None, report_interval: float = 60, ledger=None,
+                 window_chars: Optional[int] = None, max_doc_chars: Optional[int] = None,
+                 metrics_path: Optional[str] = None, profile_every: Optional[int] = None,
+                 time_components: bool = True, separate_nn_components: bool = True):
+        self.cat = cat
+        self.sink = sink
+        self.nproc = max(1, nproc)
+        self.batch_size_chars = batch_size_chars
+        self.chunk_size_chars = chunk_size_chars
+        self.prefetch_batches = prefetch_batches or 2 * self.nproc
+        self.max_in_flight = max_in_flight or 2 * self.nproc
+        self.only_cui = only_cui
+        self.addl_info = addl_info or []
+        self.report_interval = report_interval
+        self.ledger = ledger
+        self.window_chars = window_chars or self.nproc * batch_size_chars
+        self.max_doc_chars = max_doc_chars
+        self.metrics_path = metrics_path
+        self.profile_every = profile_every
+        self.time_components = time_components
+        self.separate_nn_components = separate_nn_components
+        self.stats = PipelineStats(self.nproc)
+
+    def _log_metrics(self, event: str, **values: Any) -> None:
+        if self.metrics_path is None:
+            return
+        with open(self.metrics_path, 'a') as f:
+            f.write(json.dumps(dict(values, event=event, time=time.time()), default=str) + '\n')
+
+    def _report(self) -> None:
+        logger.info(self.stats.report())
+        self._log_metrics('stats', **self.stats.as_dict())
+
+    def _batches(self, data: Iterable[Tuple[str, str]]) -> Iterator[List[Tuple[Any, str]]]:
+        return length_aware_batches(data, self.batch_size_chars, self.window_chars, self.max_doc_chars)
+
+    def _retrieve(self, data: Iterable[Tuple[str, str]], batches: queue.Queue, stop: threading.Event) -> None:
+        def _put(item: Any) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            start_time = time.perf_counter()
+            for batch in self._batches(data):
+                self.stats.add('retrieve', _nr_of_docs(batch), sum(len(text) for _, text in batch),
+                               time.perf_counter() - start_time)
+                if not _put(batch):
+                    return
+                start_time = time.perf_counter()
+            _put(None)
+        except BaseException as e:
+            _put(_RetrievalError(e))
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        return ProcessPoolExecutor(max_workers=self.nproc, mp_context=context,
+                                   initializer=_init_worker, initargs=(self.cat, self.time_components))
+
+    def _start_workers(self, executor: ProcessPoolExecutor) -> None:
+        # the workers are started on the first submit, which waits for them
+        executor.submit(os.getpid).result()
+
+    def _separate_nn_components(self) -> List[Tuple[str, Any]]:
+        # this relies on the internals of MedCAT, as `CAT.multiprocessing_batch_char_size` does
+        if self.only_cui or not hasattr(self.cat, '_separate_nn_components'):
+            return []
+        if not self.separate_nn_components:
+            if getattr(self.cat, '_meta_cats', None):
+                # torch using multiple threads in every worker is slower, for CPU runs
+                import torch
+                torch.set_num_threads(1)
+            return []
+        # disabled in the model the workers are forked with
+        return self.cat._separate_nn_components()
+
+    def _run_nn_components(self, docs: Dict[str, Dict], texts: Dict[Any, str],
+                           nn_components: List[Tuple[str, Any]]) -> None:
+        try:
+            self.cat._run_nn_components(docs, nn_components, id2text={doc_id: texts[doc_id] for doc_id in docs})
+        except Exception as e:
+            logger.warning(e, exc_info=True, stack_info=True)
+
+    def run(self, data: Iterable[Tuple[str, str]]) -> Dict[str, Any]:
+        """Annotate the documents and write their annotations to the sink.
+
+        Args:
+            data (Iterable[Tuple[str, str]]): The documents (doc_id, text), e.g from `CogStack.get_text_generator`.
+
+        Raises:
+            Exception: Any exception raised while retrieving the documents or writing to the sink.
+
+        Returns:
+            Dict[str, Any]: The final stats (see `PipelineStats.as_dict`).
+        """
+        if self.ledger is not None:
+            data = self.ledger.filter(data)
+        batches: queue.Queue = queue.Queue(maxsize=self.prefetch_batches)
+        stop = threading.Event()
+        retriever = threading.Thread(target=self._retrieve, args=(data, batches, stop), daemon=True)
+        nn_components = self._separate_nn_components()
+        executor = self._get_executor()
+        in_flight: deque = deque()
+        docs: Dict[str, Dict] = {}
+        # the texts of the annotated documents (and pieces), for the neural network components
+        texts: Dict[Any, str] = {}
+        # the annotated pieces of split documents, until all their pieces are annotated
+        pieces: Dict[Any, List[Tuple[_Piece, Dict]]] = {}
+        chars = 0
+        last_report = time.perf_counter()
+
+        def _collect(future: Future, batch: List[Tuple[Any, str]], submit_time: float) -> None:
+            nonlocal chars
+            annotated, metrics = future.result()
+            batch_chars = sum(len(text) for _, text in batch)
+            self.stats.add('annotate', _nr_of_docs(annotated), batch_chars, time.perf_counter() - submit_time)
+            self.stats.add_worker_metrics(metrics)
+            self.stats.failed += len(batch) - len(annotated)
+            if 'profile' in metrics:
+                self._log_metrics('profile', pid=metrics['pid'], docs=len(batch), chars=batch_chars,
+                                  busy=metrics['busy'], profile=metrics['profile'])
+            batch_texts = dict(batch) if nn_components else None
+            for key, doc in annotated:
+                if batch_texts is not None:
+                    texts[key] = batch_texts[key]
+                if isinstance(key, _Piece):
+                    doc_pieces = pieces.setdefault(key.doc_id, [])
+                    doc_pieces.append((key, doc))
+                    if len(doc_pieces) == key.nr_of_pieces:
+                        doc_pieces = pieces.pop(key.doc_id)
+                        docs[key.doc_id] = _merge_pieces(doc_pieces)
+                        if batch_texts is not None:
+                            texts[key.doc_id] = "".join(texts.pop(piece) for piece, _ in
+                                                        sorted(doc_pieces, key=lambda item: item[0].offset))
+                else:
+                    docs[key] = doc
+            chars += batch_chars
+
+        def _write() -> None:
+            nonlocal docs, chars
+            if nn_components:
+                self._run_nn_components(docs, texts, nn_components)
+                for doc_id in docs:
+                    del texts[doc_id]
+            start_time = time.perf_counter()
+            try:
+                part = self.sink.write(docs)
+                failed: Set[str] = set()
+            except AnnotationWriteError as e:
+                part, failed = None, e.doc_ids
+                self.stats.failed += len(failed)
+                logger.warning("%s, they are not recorded as completed", e)
+            if self.ledger is not None:
+                self.ledger.mark_done((doc_id for doc_id in docs if str(doc_id) not in failed), part)
+            self.stats.add('write', len(docs), chars, time.perf_counter() - start_time)
+            docs, chars = {}, 0
+
+        nr_of_batches = 0
+        try:
+            self._start_workers(executor)
+            retriever.start()
+            done = False
+            while not done or in_flight:
+                if not done and len(in_flight) < self.max_in_flight:
+                    item = batches.get()
+                    if isinstance(item, _RetrievalError):
+                        raise item.error
+                    if item is None:
+                        done = True
+                    else:
+                        profile = self.profile_every is not None and nr_of_batches % self.profile_every == 0
+                        future = executor.submit(_annotate_batch, item, self.only_cui, self.addl_info, profile)
+                        in_flight.append((future, item, time.perf_counter()))
+                        nr_of_batches += 1
+                    # only wait for the annotations once the workers are busy
+                    if not done and len(in_flight) < self.max_in_flight and not in_flight[0][0].done():
+                        continue
+                if in_flight:
+                    _collect(*in_flight.popleft())
+                self.stats.set_depths(batches.qsize(), len(in_flight))
+                if chars >= self.chunk_size_chars:
+                    _write()
+                if time.perf_counter() - last_report >= self.report_interval:
+                    self._report()
+                    last_report = time.perf_counter()
+            if docs:
+                _write()
+            if pieces:
+                logger.warning("%d split documents are missing pieces that failed to annotate", len(pieces))
+        finally:
+            stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            if retriever.is_alive():
+                retriever.join()
+            for name, _ in nn_components:
+                self.cat.pipe.spacy_nlp.enable_pipe(name)
+        self.stats.set_depths(0, 0)
+        self._report()
+        return self.stats.as_dict()
@@ -0,0 +1,334 @@
+from typing import Dict, Iterator, List, Set, Any, Optional
+import logging
+import os
+import pickle
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cogstack import list_chunker
+
+
+logger = logging.getLogger('medcat')
+
+
+def annotation_actions(docs: Dict[str, Dict], index: str) -> Iterator[Dict]:
+    """Convert annotated documents into bulk index actions, one per entity.
+
+    The ID of each action is based on the document ID and the entity ID so that
+    writing the same annotations again overwrites them instead of duplicating them.
+
+    Args:
+        docs (Dict[str, Dict]): The annotated documents ({doc_id: {'entities': {ent_id: entity}}}).
+        index (str): The index to write the annotations to.
+
+    Yields:
+        Dict: The bulk index action for each entity.
+    """
+    for doc_id, doc in docs.items():
+        for ent_id, entity in doc['entities'].items():
+            if not isinstance(entity, dict):
+                # only_cui=True annotations
+                entity = {'cui': entity}
+            source = dict(entity, doc_id=doc_id)
+            yield {'_index': index, '_id': f"{doc_id}_{ent_id}", '_source': source}
+
+
+class AnnotationWriteError(Exception):
+    """Raised when the annotations of some documents of a write could not be written.
+
+    The annotations of the other documents of the write were written.
+
+    Args:
+        doc_ids (Set[str]): The IDs of the documents (some of) whose annotations were not written.
+        errors (List[Dict]): The errors of the annotations that were not written.
+    """
+
+    def __init__(self, doc_ids: Set[str], errors: List[Dict]):
+        super().__init__(f"Failed to write the annotations of {len(doc_ids)} documents")
+        self.doc_ids = doc_ids
+        self.errors = errors
+
+
+def _failed_doc_ids(docs: Dict[str, Dict], errors: List[Dict]) -> Set[str]:
+    doc_ids: Set[str] = set()
+    for error in errors:
+        info: Dict = next(iter(error.values()), {})
+        if '_id' not in info:
+            # the failed annotation can not be traced back to its document
+            return set(map(str, docs))
+        # see annotation_actions
+        doc_ids.add(str(info['_id']).rsplit('_', 1)[0])
+    return doc_ids
+
+
+class ElasticAnnotationSink:
+    """Writes annotated documents into an Elasticsearch index in bulk.
+
+    Args:
+        cs (CogStack): The CogStack instance to write with.
+        index (str): The index to write the annotations to.
+        chunk_size (int): The number of entities per bulk request. Defaults to 500.
+        thread_count (int): The number of threads sending requests. Defaults to 4.
+        queue_size (int): The number of chunks waiting to be sent. Defaults to 4.
+        max_retries (int): The number of times an entity rejected with a 429 status is retried. Defaults to 5.
+        initial_backoff (float): The time in seconds to wait before the first retry. Defaults to 2.
+        replace_existing (bool): Whether to delete the existing annotations of the documents before writing
+            theirs (e.g when documents are annotated again). Defaults to False.
+        doc_id_field (str): The (keyword) field to find the existing annotations of a document by.
+            Defaults to 'doc_id.keyword' (as in the default dynamic mapping).
+        max_terms_count (int): The maximum number of document IDs per delete request, as Elasticsearch limits
+            terms queries to `index.max_terms_count` terms. Defaults to 65536 (the default of that setting).
+    """
+
+    def __init__(self, cs, index: str, chunk_size: int = 500, thread_count: int = 4,
+                 queue_size: int = 4, max_retries: int = 5, initial_backoff: float = 2,
+                 replace_existing: bool = False, doc_id_field: str = 'doc_id.keyword',
+                 max_terms_count: int = 65536):
+        self.cs = cs
+        self.index = index
+        self.chunk_size = chunk_size
+        self.thread_count = thread_count
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.replace_existing = replace_existing
+        self.doc_id_field = doc_id_field
+        self.max_terms_count = max_terms_count
+        self.totals: Dict[str, Any] = {'docs': 0, 'indexed': 0, 'failed': 0, 'retried': 0, 'elapsed': 0.0}
+
+    def write(self, docs: Dict[str, Dict]) -> None:
+        """Write the annotations of a batch of documents.
+
+        Args:
+            docs (Dict[str, Dict]): The annotated documents ({doc_id: {'entities': {ent_id: entity}}}).
+
+        Raises:
+            AnnotationWriteError: If some of the annotations were not written (e.g rejected by the cluster).
+        """
+        if self.replace_existing and docs:
+            # otherwise annotations a document no longer has would be kept
+            for doc_ids in list_chunker(list(docs), self.max_terms_count):
+                self.cs.elastic.delete_by_query(index=self.index, query={'terms': {self.doc_id_field: doc_ids}},
+                                                conflicts='proceed', refresh=True)
+        stats = self.cs.bulk_index(annotation_actions(docs, self.index),
+                                   chunk_size=self.chunk_size,
+                                   thread_count=self.thread_count,
+                                   queue_size=self.queue_size,
+                                   max_retries=self.max_retries,
+                                   initial_backoff=self.initial_backoff,
+                                   show_progress=False)
+        self.totals['docs'] += len(docs)
+        for key in ('indexed', 'failed', 'retried', 'elapsed'):
+            self.totals[key] += stats[key]
+        for error in stats['errors'][:10]:
+            logger.warning("Failed to write annotation: %s", error)
+        logger.info(self.report())
+        if stats['errors']:
+            raise AnnotationWriteError(_failed_doc_ids(docs, stats['errors']), stats['errors'])
+
+    def report(self) -> str:
+        """Summarise the throughput of the annotations written so far.
+
+        Returns:
+            str: The summary.
+        """
+        elapsed = self.totals['elapsed']
+        rate = self.totals['indexed'] / elapsed if elapsed else 0.0
+        return (f"Wrote {self.totals['indexed']} annotations of {self.totals['docs']} documents "
+                f"to '{self.index}' in {elapsed:.1f}s ({rate:.1f} annotations/s); "
+                f"{self.totals['retried']} retried, {self.totals['failed']} failed")
+
+
+class PickleAnnotationSink:
+    """Saves annotated documents to disk the same way `CAT.multiprocessing_batch_char_size` does.
+
+    Each write is saved as the next `part_N.pickle` and the IDs annotated so far are kept in
+    `annotated_ids.pickle`, so the output can be read (and continued) like that of MedCAT.
+
+    Args:
+        save_dir_path (str): The directory to save the parts to.
+    """
+
+    def __init__(self, save_dir_path: str):
+        self.save_dir_path = save_dir_path
+        self.annotated_ids_path = os.path.join(save_dir_path, 'annotated_ids.pickle')
+        self.annotated_ids: List[str] = []
+        self.part_counter = 0
+        if os.path.exists(self.annotated_ids_path):
+            with open(self.annotated_ids_path, 'rb') as f:
+                self.annotated_ids, self.part_counter = pickle.load(f)
+        self.totals: Dict[str, Any] = {'docs': 0, 'parts': 0}
+
+    def write(self, docs: Dict[str, Dict]) -> int:
+        """Save the annotations of a batch of documents as the next part.
+
+        Args:
+            docs (Dict[str, Dict]): The annotated documents ({doc_id: {'entities': {ent_id: entity}}}).
+
+        Returns:
+            int: The number of the part saved.
+        """
+        path = os.path.join(self.save_dir_path, f'part_{self.part_counter}.pickle')
+        with open(path, 'wb') as f:
+            pickle.dump(docs, f)
+        self.part_counter += 1
+        self.annotated_ids.extend(docs)
+        with open(self.annotated_ids_path, 'wb') as f:
+            pickle.dump((self.annotated_ids, self.part_counter), f)
+        self.totals['docs'] += len(docs)
+        self.totals['parts'] += 1
+        logger.info("Saved part: %s, to: %s", self.part_counter - 1, path)
+        return self.part_counter - 1
+
+    def report(self) -> str:
+        """Summarise the annotations saved so far.
+
+        Returns:
+            str: The summary.
+        """
+        return (f"Saved the annotations of {self.totals['docs']} documents "
+                f"in {self.totals['parts']} parts to '{self.save_dir_path}'")
+
+
+# the subdirectory of the Parquet dataset, so that other files in the output folder
+# (e.g the completion ledger) are not read as part of it
+PARQUET_DATASET_DIR = 'annotations'
+
+
+class ParquetAnnotationSink:
+    """Saves annotated documents as a Parquet dataset with one row per entity.
+
+    The dataset is saved in the `annotations` subdirectory of `save_dir_path` (`dataset_path`).
+    Each write is saved as the next part (`part=N/annotations.parquet`, i.e partitioned by part).
+    The columns are `doc_id`, `cui`, `start`, `end`, `acc`, `context_similarity` and a `meta_<task>`
+    column with the value of each meta-annotation task. The CUIs and meta-annotation values are
+    dictionary-encoded. The dataset can be read (only the needed columns) with e.g
+    `pandas.read_parquet(sink.dataset_path, columns=['doc_id', 'cui'])`, which adds the `part` column.
+    Documents annotated again are saved in new parts, see `load_parquet_annotations` to only
+    keep their latest annotations.
+
+    Args:
+        save_dir_path (str): The directory to save the dataset in.
+        meta_tasks (List[str], optional): The meta-annotation tasks to keep. Defaults to None
+            (i.e the tasks of the first write, so that all the parts have the same columns).
+    """
+
+    def __init__(self, save_dir_path: str, meta_tasks: Optional[List[str]] = None):
+        self.save_dir_path = save_dir_path
+        self.dataset_path = os.path.join(save_dir_path, PARQUET_DATASET_DIR)
+        self.meta_tasks = meta_tasks
+        os.makedirs(self.dataset_path, exist_ok=True)
+        parts = [int(dir_name[len('part='):]) for dir_name in os.listdir(self.dataset_path)
+                 if dir_name.startswith('part=')]
+        self.part_counter = max(parts) + 1 if parts else 0
+        self.totals: Dict[str, Any] = {'docs': 0, 'entities': 0, 'parts': 0}
+
+    def _get_meta_tasks(self, docs: Dict[str, Dict]) -> List[str]:
+        tasks = set()
+        for doc in docs.values():
+            for entity in doc['entities'].values():
+                if isinstance(entity, dict):
+                    tasks.update(entity.get('meta_anns', {}))
+        return sorted(tasks)
+
+    def _to_table(self, docs: Dict[str, Dict]) -> pa.Table:
+        if self.meta_tasks is None:
+            self.meta_tasks = self._get_meta_tasks(docs)
+        columns: Dict[str, List[Any]] = {name: [] for name in ('doc_id', 'cui', 'start', 'end', 'acc',
+                                                               'context_similarity')}
+        meta_columns: Dict[str, List[Any]] = {task: [] for task in self.meta_tasks}
+        for doc_id, doc in docs.items():
+            for entity in doc['entities'].values():
+                if not isinstance(entity, dict):
+                    # only_cui=True annotations
+                    entity = {'cui': entity}
+                columns['doc_id'].append(str(doc_id))
+                for name in ('cui', 'start', 'end', 'acc', 'context_similarity'):
+                    columns[name].append(entity.get(name))
+                meta_anns = entity.get('meta_anns', {})
+                for task, values in meta_columns.items():
+                    values.append(meta_anns.get(task, {}).get('value'))
+        arrays = {'doc_id': pa.array(columns['doc_id'], type=pa.string()),
+                  'cui': pa.array(columns['cui'], type=pa.string()).dictionary_encode(),
+                  'start': pa.array(columns['start'], type=pa.int64()),
+                  'end': pa.array(columns['end'], type=pa.int64()),
+                  'acc': pa.array(columns['acc'], type=pa.float64()),
+                  'context_similarity': pa.array(columns['context_similarity'], type=pa.float64())}
+        for task, values in meta_columns.items():
+            arrays[f'meta_{task}'] = pa.array(values, type=pa.string()).dictionary_encode()
+        return pa.table(arrays)
+
+    def write(self, docs: Dict[str, Dict]) -> int:
+        """Save the entities of a batch of documents as the next part.
+
+        Args:
+            docs (Dict[str, Dict]): The annotated documents ({doc_id: {'entities': {ent_id: entity}}}).
+
+        Returns:
+            int: The number of the part saved.
+        """
+        table = self._to_table(docs)
+        part_dir = os.path.join(self.dataset_path, f'part={self.part_counter}')
+        os.makedirs(part_dir, exist_ok=True)
+        path = os.path.join(part_dir, 'annotations.parquet')
+        pq.write_table(table, path)
+        self.part_counter += 1
+        self.totals['docs'] += len(docs)
+        self.totals['entities'] += table.num_rows
+        self.totals['parts'] += 1
+        logger.info("Saved part: %s, to: %s", self.part_counter - 1, path)
+        return self.part_counter - 1
+
+    def report(self) -> str:
+        """Summarise the annotations saved so far.
+
+        Returns:
+            str: The summary.
+        """
+        return (f"Saved {self.totals['entities']} entities of {self.totals['docs']} documents "
+                f"in {self.totals['parts']} parts to '{self.dataset_path}'")
+
+
+def load_parquet_annotations(save_dir_path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Load the entities saved by `ParquetAnnotationSink`, keeping only the latest part of each document.
+
+    Documents annotated again (e.g by incremental runs) have rows in several parts, of which only
+    those of the latest part are kept. A document that has no entities in its latest part has no
+    rows in it either, so the rows of its earlier part are kept instead.
+
+    Args:
+        save_dir_path (str): The directory the sink saved the dataset in.
+        columns (List[str], optional): The columns to read. Defaults to None (i.e all, including `part`).
+
+    Returns:
+        pd.DataFrame: The entities, one per row.
+    """
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + ['doc_id', 'part']))
+    df = pd.read_parquet(os.path.join(save_dir_path, PARQUET_DATASET_DIR), columns=read_columns)
+    parts = df['part'].astype(int)
+    df = df[parts == parts.groupby(df['doc_id']).transform('max')].reset_index(drop=True)
+    return df if columns is None else df[columns]
+
+
+def load_annotations(save_dir_path: str) -> Dict[str, Dict]:
+    """Load the annotations saved by `PickleAnnotationSink` (or MedCAT) into a single dictionary.
+
+    The parts are loaded in order, so documents annotated again (e.g by incremental runs)
+    have the annotations of their latest part.
+
+    Args:
+        save_dir_path (str): The directory the parts were saved to.
+
+    Returns:
+        Dict[str, Dict]: The annotated documents ({doc_id: {'entities': {ent_id: entity}}}).
+    """
+    part_numbers = sorted(int(file_name[len('part_'):-len('.pickle')]) for file_name in os.listdir(save_dir_path)
+                          if file_name.startswith('part_') and file_name.endswith('.pickle'))
+    docs: Dict[str, Dict] = {}
+    for part_number in part_numbers:
+        with open(os.path.join(save_dir_path, f'part_{part_number}.pickle'), 'rb') as f:
+            docs.update(pickle.load(f))
+    return docs
+
@@ -0,0 +1,121 @@
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Optional
+import sqlite3
+import threading
+import time
+
+
+class CompletionLedger:
+    """Keeps track of the documents whose annotations have been written, in a SQLite file.
+
+    For every document the part of the output its annotations were written to is kept (if the
+    sink writes parts), so an interrupted run can skip the completed documents on restart.
+
+    When documents are annotated again (e.g in incremental runs), only the documents completed
+    since the start of the current run should be skipped, which is what `since` is for.
+
+    Args:
+        path (str): The path of the SQLite file.
+        since (Optional[float]): Only count documents completed at or after this time (as in `time.time()`)
+            as completed. Defaults to None (i.e all documents).
+    """
+
+    def __init__(self, path: str, since: Optional[float] = None):
+        self.path = path
+        self.since = since
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS completed "
+                           "(doc_id TEXT PRIMARY KEY, part INTEGER, completed_at REAL)")
+        self._conn.commit()
+
+    def _where(self) -> Tuple[str, Tuple[Any, ...]]:
+        if self.since is None:
+            return "", ()
+        return " WHERE completed_at >= ?", (self.since,)
+
+    def mark_done(self, doc_ids: Iterable[str], part: Optional[int] = None) -> None:
+        """Record documents as completed.
+
+        Args:
+            doc_ids (Iterable[str]): The IDs of the documents.
+            part (Optional[int]): The output part their annotations were written to. Defaults to None.
+        """
+        completed_at = time.time()
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO completed (doc_id, part, completed_at) VALUES (?, ?, ?)",
+                                   ((str(doc_id), part, completed_at) for doc_id in doc_ids))
+            self._conn.commit()
+
+    def __contains__(self, doc_id: str) -> bool:
+        where, params = self._where()
+        where = f"{where} AND doc_id = ?" if where else " WHERE doc_id = ?"
+        with self._lock:
+            return self._conn.execute(f"SELECT 1 FROM completed{where}",
+                                      params + (str(doc_id),)).fetchone() is not None
+
+    def __len__(self) -> int:
+        where, params = self._where()
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM completed{where}", params).fetchone()[0]
+
+    def done_ids(self) -> List[str]:
+        """Get the IDs of the completed documents.
+
+        Returns:
+            List[str]: The document IDs.
+        """
+        where, params = self._where()
+        with self._lock:
+            return [row[0] for row in self._conn.execute(f"SELECT doc_id FROM completed{where}", params)]
+
+    def parts(self) -> Dict[Optional[int], int]:
+        """Count the completed documents per output part (the latest part of documents annotated again).
+
+        Returns:
+            Dict[Optional[int], int]: The number of documents of each part.
+        """
+        where, params = self._where()
+        with self._lock:
+            return dict(self._conn.execute(f"SELECT part, COUNT(*) FROM completed{where} GROUP BY part",
+                                           params).fetchall())
+
+    def filter(self, data: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+        """Skip the documents that were completed before the filtering started.
+
+        The completed IDs are read into memory once, so documents completed while
+        filtering are not skipped.
+
+        Args:
+            data (Iterable[Tuple[str, str]]): The documents (doc_id, text).
+
+        Yields:
+            Tuple[str, str]: The documents that have not been completed.
+        """
+        done = set(self.done_ids())
+        for doc_id, text in data:
+            if str(doc_id) not in done:
+                yield doc_id, text
+
+    def exclude_done(self, query: Dict, max_ids: int = 65536) -> Dict:
+        """Exclude the completed documents from a search query on the server side.
+
+        The IDs are excluded with a terms query on `_id`, which Elasticsearch limits to
+        `index.max_terms_count` (65536 by default) terms. With more completed documents than `max_ids`
+        the query is returned unchanged, and the documents need to be skipped with `filter` instead.
+
+        Args:
+            query (Dict): A dictionary containing the search query parameters.
+            max_ids (int): The maximum number of IDs to exclude on the server side. Defaults to 65536.
+
+        Returns:
+            Dict: The search query excluding the completed documents.
+        """
+        if not 0 < len(self) <= max_ids:
+            return query
+        return dict(query, query={'bool': {'must': [query.get('query', {'match_all': {}})],
+                                           'must_not': [{'terms': {'_id': self.done_ids()}}]}})
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,103 @@
+from typing import Any, Dict, Optional, Tuple
+import sqlite3
+import time
+
+
+class HighWaterMarks:
+    """Keeps the high-water mark of incremental annotation runs in a SQLite file.
+
+    A mark is kept per index, model pack (hash) and field (e.g an updated-at field), so that
+    annotating with a different model starts from the beginning again. A run is started with the
+    current maximum of the field and only becomes the new mark once it's finished. If a run is
+    interrupted, the next run resumes it (with the same range) instead of starting a new one.
+
+    Args:
+        path (str): The path of the SQLite file (it can be shared with the `CompletionLedger`).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS high_water_marks "
+                           "(index_name TEXT, model_hash TEXT, field TEXT, value TEXT, "
+                           "pending_value TEXT, pending_since REAL, "
+                           "PRIMARY KEY (index_name, model_hash, field))")
+        self._conn.commit()
+
+    def get(self, index: str, model_hash: str, field: str) -> Optional[Any]:
+        """Get the high-water mark of the last finished run.
+
+        Args:
+            index (str): The index annotated.
+            model_hash (str): The hash of the model pack annotated with.
+            field (str): The field the mark is on.
+
+        Returns:
+            Optional[Any]: The mark, or None if no run has finished yet.
+        """
+        row = self._conn.execute("SELECT value FROM high_water_marks WHERE index_name = ? AND model_hash = ? "
+                                 "AND field = ?", (index, model_hash, field)).fetchone()
+        return row[0] if row is not None else None
+
+    def start(self, index: str, model_hash: str, field: str, up_to: Any) -> Tuple[Optional[Any], Any, float]:
+        """Start a run (or resume the interrupted one).
+
+        Args:
+            index (str): The index to annotate.
+            model_hash (str): The hash of the model pack to annotate with.
+            field (str): The field the mark is on.
+            up_to (Any): The current maximum of the field.
+
+        Returns:
+            Tuple[Optional[Any], Any, float]: The mark of the last finished run (None if there is none),
+                the mark to annotate up to and the time the run started (for `CompletionLedger.since`).
+        """
+        row = self._conn.execute("SELECT value, pending_value, pending_since FROM high_water_marks "
+                                 "WHERE index_name = ? AND model_hash = ? AND field = ?",
+                                 (index, model_hash, field)).fetchone()
+        if row is not None and row[1] is not None:
+            # an interrupted run
+            return row[0], row[1], row[2]
+        since = time.time()
+        self._conn.execute("INSERT INTO high_water_marks (index_name, model_hash, field, pending_value, pending_since) "
+                           "VALUES (?, ?, ?, ?, ?) ON CONFLICT (index_name, model_hash, field) "
+                           "DO UPDATE SET pending_value = excluded.pending_value, "
+                           "pending_since = excluded.pending_since",
+                           (index, model_hash, field, up_to, since))
+        self._conn.commit()
+        return (row[0] if row is not None else None), up_to, since
+
+    def finish(self, index: str, model_hash: str, field: str) -> None:
+        """Finish the current run, making the mark it annotated up to the new high-water mark.
+
+        Args:
+            index (str): The index annotated.
+            model_hash (str): The hash of the model pack annotated with.
+            field (str): The field the mark is on.
+        """
+        self._conn.execute("UPDATE high_water_marks SET value = pending_value, pending_value = NULL, "
+                           "pending_since = NULL WHERE index_name = ? AND model_hash = ? AND field = ? "
+                           "AND pending_value IS NOT NULL", (index, model_hash, field))
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def incremental_query(query: Dict, field: str, after: Optional[Any], up_to: Any) -> Dict:
+    """Restrict a search query to the documents past a high-water mark.
+
+    Args:
+        query (Dict): A dictionary containing the search query parameters.
+        field (str): The field the mark is on.
+        after (Optional[Any]): The mark of the last finished run, None to start from the beginning.
+        up_to (Any): The mark to annotate up to (included).
+
+    Returns:
+        Dict: The restricted search query.
+    """
+    field_range: Dict[str, Any] = {'lte': up_to}
+    if after is not None:
+        field_range['gt'] = after
+    return dict(query, query={'bool': {'must': [query.get('query', {'match_all': {}})],
+                                       'filter': [{'range': {field: field_range}}]}})
@@ -12,6 +12,10 @@ import sys
 sys.path.append(os.path.join('..', '..'))
 from credentials import *
 from cogstack import CogStack
+from annotation_sinks import ElasticAnnotationSink, PickleAnnotationSink, ParquetAnnotationSink
+from annotation_pipeline import AnnotationPipeline
+from completion_ledger import CompletionLedger
+from incremental import HighWaterMarks, incremental_query
 
 
 # relative to file path
@@ -47,7 +51,17 @@ ann_folder_path = os.path.join(base_path, data_dir, f'annotated_docs')
 if not os.path.exists(ann_folder_path):
     os.makedirs(ann_folder_path)
 
-medcat_logger.warning(f'Anntotations will be saved here: {ann_folder_path}')
+# Set to the name of an index to write the annotations back into CogStack
+# instead of saving them to ann_folder_path
+annotations_index = None
+# The format to save the annotations in: 'pickle' (per document dicts, as MedCAT does)
+# or 'parquet' (one row per entity)
+annotations_format = 'pickle'
+
+if annotations_index:
+    medcat_logger.warning(f'Anntotations will be written to index: {annotations_index}')
+else:
+    medcat_logger.warning(f'Anntotations will be saved here: {ann_folder_path}')
 
 # Load CAT - the main class from medcat used fro concept annotation
 cat = CAT.load_model_pack(model_pack_path)
@@ -63,33 +77,74 @@ cat.config.linking['filters']['cuis'] = snomed_filter
 del snomed_filter
 
 # build query, change as appropriate
-query = {
+query: dict = {
     "query": {
     "match_all": {}
-    },
-    "_source":["_id", "body_analysed"]
+    }
 }
+text_col = 'body_analysed'
 
-search_gen = cs.get_docs_generator(index=cogstack_indices, query=query, request_timeout=None)
-
-def relevant_text_gen(generator, doc_id = '_id', text_col='body_analysed'):
-    for i in generator:
-        try:
-            yield (i[doc_id], i['_source'][text_col])
-        except KeyError:
-            # medcat_logger.warning(f'KeyError {text_col} not found')
-            continue
+# Set to a field that is updated whenever a document changes (e.g an updated-at date) to only
+# annotate the documents that are new or changed since the last run with the same model
+incremental_field = None
 
 batch_char_size = 500000  # Batch size (BS) in number of characters
 
-cat.multiprocessing_batch_char_size(relevant_text_gen(search_gen),
-                                    batch_size_chars=batch_char_size,
-                                    only_cui=False,
-                                    nproc=8, # Number of processors
-                                    out_split_size_chars=20*batch_char_size,
-                                    save_dir_path=ann_folder_path,
-                                    min_free_memory=0.1,
-                                    )
+if annotations_index:
+    sink = ElasticAnnotationSink(cs, index=annotations_index,
+                                 chunk_size=1000,  # Number of annotations per bulk request
+                                 thread_count=4,  # Number of bulk requests in flight
+                                 replace_existing=bool(incremental_field),  # Replace annotations of changed docs
+                                 )
+elif annotations_format == 'parquet':
+    # one row per entity, partitioned by part
+    sink = ParquetAnnotationSink(ann_folder_path)
+else:
+    # re-annotated documents are saved in new parts, see annotation_sinks.load_annotations
+    sink = PickleAnnotationSink(ann_folder_path)
+
+# Keeps the IDs of the documents already annotated, so that a restarted run skips them
+ledger_path = os.path.join(ann_folder_path, 'completed_docs.sqlite')
+ledger = CompletionLedger(ledger_path)
+
+
+def annotate(index_query: dict, indices: list) -> None:
+    medcat_logger.warning(f'{len(ledger)} documents were annotated by previous (or interrupted) runs')
+    # skip them in Elasticsearch already when there are not too many
+    index_query = ledger.exclude_done(index_query)
+    # (doc_id, text) tuples, only the text field is retrieved
+    text_gen = cs.get_text_generator(index=indices, text_fields=text_col, query=index_query, request_timeout=None)
+    # Documents are retrieved, annotated and written at the same time
+    pipeline = AnnotationPipeline(cat, sink,
+                                  nproc=8,  # Number of processors
+                                  batch_size_chars=batch_char_size,
+                                  chunk_size_chars=20*batch_char_size,
+                                  prefetch_batches=16,  # Number of retrieved batches waiting to be annotated
+                                  only_cui=False,
+                                  ledger=ledger,
+                                  metrics_path=os.path.join(base_path, data_dir, 'annotation_metrics.jsonl'),
+                                  profile_every=None,  # e.g 1000 to profile every 1000th batch
+                                  )
+    pipeline.run(text_gen)
+    medcat_logger.warning(pipeline.stats.report())
+    medcat_logger.warning(sink.report())
+
+
+if incremental_field:
+    marks = HighWaterMarks(ledger_path)
+    model_hash = cat.config.version.id or cat.get_hash()
+    for index in cogstack_indices:
+        up_to = cs.max_value(index, incremental_field, query=query)
+        if up_to is None:
+            continue
+        after, up_to, since = marks.start(index, model_hash, incremental_field, up_to)
+        medcat_logger.warning(f'Annotating {index} documents with {incremental_field} after {after} up to {up_to}')
+        # only skip the documents completed by this (possibly interrupted) run
+        ledger.since = since
+        annotate(incremental_query(query, incremental_field, after, up_to), [index])
+        marks.finish(index, model_hash, incremental_field)
+else:
+    annotate(query, cogstack_indices)
 
 medcat_logger.warning(f'Annotation process complete!')
 
@@ -1,62 +1,305 @@
-from typing import Type, TypeVar, Generic, Iterable, Callable, Optional
+from typing import Type, TypeVar, Generic, Iterator, Callable, Optional, List, Tuple, Dict, ClassVar, Any
 
+import abc
 import sqlite3
-import re
+import msgpack
 from pydantic import BaseModel
 
 
-T = TypeVar('T', bound=BaseModel)
+R = TypeVar('R', bound='RowModel')
 
 
-def sanitize_table_name(name, max_length=64):
-    # Replace any characters not allowed in table names with underscores
-    name = re.sub(r'[^a-zA-Z0-9_$]', '_', name)
-    # Truncate the name if it's too long
-    name = name[:max_length]
-    return name
+class RowModel(BaseModel):
+    """A model that is stored as a row of fixed columns.
+
+    The columns are defined by `ROW_COLUMNS` (name and SQLite type).
+    Subclasses must implement `to_row` and `from_rows`.
+    """
+    ROW_COLUMNS: ClassVar[Tuple[Tuple[str, str], ...]] = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        missing = [name for name in ('to_row', 'from_rows')
+                   if getattr(getattr(cls, name), '__isabstractmethod__', False)]
+        if missing:
+            raise TypeError(f"{cls.__name__} does not implement {', '.join(missing)}")
+
+    @abc.abstractmethod
+    def to_row(self) -> Tuple[Any, ...]:
+        """Encode the model as a row.
+
+        Returns:
+            Tuple[Any, ...]: The values of the columns.
+        """
+
+    @classmethod
+    @abc.abstractmethod
+    def from_rows(cls: Type[R], rows: List[Tuple[Any, ...]]) -> List[R]:
+        """Decode a batch of rows (without validation).
+
+        Args:
+            rows (List[Tuple[Any, ...]]): The values of the columns of each row.
+
+        Returns:
+            List[R]: The models.
+        """
+
+
+T = TypeVar('T', bound=RowModel)
 
 
 class SaveOptions(BaseModel):
     use_db: bool = False
     db_file_name: Optional[str] = None
     clean_callback: Optional[Callable[[], None]] = None
+    # also keep the raw text and entities of the documents in the database (requires use_db)
+    out_of_core: bool = False
 
 
 class DifferenceDatabase(Generic[T]):
+    """Stores the differences of all documents in a single SQLite table.
+
+    The differences are keyed by document ID and their sequence number within the document,
+    with the columns of the difference type (see `RowModel`). They are inserted in batches
+    (`executemany` in a single transaction) and the pending ones are written before anything is read.
+
+    The raw text and entities of the documents can be kept in the same file (see `add_document`).
 
-    def __init__(self, db_file: str, part: str, model_type: Type[T],
-                 batch_size: int = 100):
+    Args:
+        db_file (str): The SQLite file.
+        model_type (Type[T]): The type of the differences.
+        batch_size (int): The number of differences to insert (and fetch) at once. Defaults to 1000.
+    """
+
+    def __init__(self, db_file: str, model_type: Type[T],
+                 batch_size: int = 1000):
         self.db_file = db_file
-        self.part = sanitize_table_name(part)
         self.model_type = model_type
         self.conn = sqlite3.connect(self.db_file)
-        self.cursor = self.conn.cursor()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._columns = [name for name, _ in model_type.ROW_COLUMNS]
         self._create_table()
-        self._len = 0
         self._batch_size = batch_size
+        self._pending: List[Tuple[Any, ...]] = []
+        self._pending_docs: List[Tuple[str, str, bytes, bytes, bytes]] = []
+        # differences are usually appended one document at a time,
+        # so only the sequence of the current document is kept
+        self._cur_doc: Optional[str] = None
+        self._cur_seq = 0
+        self._len = self.conn.execute("SELECT COUNT(*) FROM differences").fetchone()[0]
 
     def _create_table(self):
-        self.cursor.execute(f'''CREATE TABLE IF NOT EXISTS differences_{self.part}
-                              (id INTEGER PRIMARY KEY, data TEXT)''')
-        self.conn.commit()
-
-    def append(self, difference: T):
-        data = difference.json()
-        self.cursor.execute(f"INSERT INTO differences_{self.part} (data) VALUES (?)", (data,))
-        self.conn.commit()
+        with self.conn:
+            columns = "".join(f", {name} {col_type}" for name, col_type in self.model_type.ROW_COLUMNS)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS differences "
+                              f"(doc_id TEXT NOT NULL, seq INTEGER NOT NULL{columns})")
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS differences_doc_seq "
+                              "ON differences (doc_id, seq)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS documents "
+                              "(doc_id TEXT PRIMARY KEY, raw_text TEXT, raw1 BLOB, raw2 BLOB, counts BLOB)")
+
+    def append(self, doc_id: str, difference: T) -> None:
+        if doc_id != self._cur_doc:
+            # the count of the new document (including pending rows) before it becomes the current one
+            self._cur_seq = self.doc_len(doc_id)
+            self._cur_doc = doc_id
+        self._pending.append((doc_id, self._cur_seq) + difference.to_row())
+        self._cur_seq += 1
         self._len += 1
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+
+    def add_document(self, doc_id: str, raw_text: str, raw1: Dict, raw2: Dict,
+                     counts: Dict[int, int]) -> None:
+        """Keep the raw text and entities of a document.
 
-    def __iter__(self) -> Iterable[T]:
-        self.cursor.execute(f"SELECT data FROM differences_{self.part}")
+        Args:
+            doc_id (str): The document ID.
+            raw_text (str): The text of the document.
+            raw1 (Dict): The entities of the 1st model.
+            raw2 (Dict): The entities of the 2nd model.
+            counts (Dict[int, int]): The number of differences per type.
+        """
+        self._pending_docs.append((doc_id, raw_text, msgpack.packb(raw1), msgpack.packb(raw2),
+                                   msgpack.packb(counts)))
+        if len(self._pending_docs) >= self._batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the pending differences (and documents)."""
+        if not self._pending and not self._pending_docs:
+            return
+        with self.conn:
+            if self._pending:
+                self.conn.executemany(f"INSERT INTO differences (doc_id, seq, {', '.join(self._columns)}) "
+                                      f"VALUES (?, ?{', ?' * len(self._columns)})", self._pending)
+            if self._pending_docs:
+                self.conn.executemany("INSERT OR REPLACE INTO documents (doc_id, raw_text, raw1, raw2, counts) "
+                                      "VALUES (?, ?, ?, ?, ?)", self._pending_docs)
+        self._pending = []
+        self._pending_docs = []
+
+    def _iter_rows(self, where: str = "", params: Tuple = (), order_by: str = "rowid") -> Iterator[Tuple[str, T]]:
+        self.flush()
+        cursor = self.conn.execute(f"SELECT doc_id, {', '.join(self._columns)} FROM differences{where} "
+                                   f"ORDER BY {order_by}", params)
         while True:
-            rows = self.cursor.fetchmany(self._batch_size)
+            rows = cursor.fetchmany(self._batch_size)
+            if not rows:
+                break
+            # decoded a batch at a time
+            differences = self.model_type.from_rows([row[1:] for row in rows])
+            yield from zip((row[0] for row in rows), differences)
+
+    def iter_doc(self, doc_id: str) -> Iterator[T]:
+        """Iterate over the differences of a document.
+
+        Args:
+            doc_id (str): The document ID.
+
+        Yields:
+            T: The differences, in the order they were appended.
+        """
+        for _, difference in self._iter_rows(" WHERE doc_id = ?", (doc_id,), order_by="seq"):
+            yield difference
+
+    def __iter__(self) -> Iterator[Tuple[str, T]]:
+        """Iterate over the differences of all documents.
+
+        Yields:
+            Tuple[str, T]: The document ID and the difference, in the order they were appended.
+        """
+        yield from self._iter_rows()
+
+    def doc_len(self, doc_id: str) -> int:
+        if doc_id == self._cur_doc:
+            return self._cur_seq
+        self.flush()
+        return self.conn.execute("SELECT COUNT(*) FROM differences WHERE doc_id = ?", (doc_id,)).fetchone()[0]
+
+    def _decode_document(self, raw1: bytes, raw2: bytes, counts: bytes) -> Tuple[Dict, Dict, Dict[int, int]]:
+        # MedCAT's entities are keyed by integers
+        return (msgpack.unpackb(raw1, strict_map_key=False), msgpack.unpackb(raw2, strict_map_key=False),
+                msgpack.unpackb(counts, strict_map_key=False))
+
+    def get_document(self, doc_id: str) -> Tuple[Dict, Dict, Dict[int, int]]:
+        """Get the entities of a document (without the text).
+
+        Args:
+            doc_id (str): The document ID.
+
+        Raises:
+            KeyError: If the document has not been added.
+
+        Returns:
+            Tuple[Dict, Dict, Dict[int, int]]: The entities of the 1st and 2nd model and
+                the number of differences per type.
+        """
+        self.flush()
+        row = self.conn.execute("SELECT raw1, raw2, counts FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+        if row is None:
+            raise KeyError(doc_id)
+        return self._decode_document(*row)
+
+    def get_text(self, doc_id: str) -> str:
+        """Get the raw text of a document.
+
+        Args:
+            doc_id (str): The document ID.
+
+        Raises:
+            KeyError: If the document has not been added.
+
+        Returns:
+            str: The text.
+        """
+        self.flush()
+        row = self.conn.execute("SELECT raw_text FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+        if row is None:
+            raise KeyError(doc_id)
+        return row[0]
+
+    def has_document(self, doc_id: str) -> bool:
+        self.flush()
+        return self.conn.execute("SELECT 1 FROM documents WHERE doc_id = ?", (doc_id,)).fetchone() is not None
+
+    def iter_documents(self) -> Iterator[Tuple[str, Dict, Dict, Dict[int, int]]]:
+        """Iterate over the entities of all documents (without the text).
+
+        Yields:
+            Tuple[str, Dict, Dict, Dict[int, int]]: The document ID, the entities of the 1st and 2nd model
+                and the number of differences per type, in the order the documents were added.
+        """
+        self.flush()
+        cursor = self.conn.execute("SELECT doc_id, raw1, raw2, counts FROM documents ORDER BY rowid")
+        while True:
+            rows = cursor.fetchmany(self._batch_size)
+            if not rows:
+                break
+            for doc_id, *document in rows:
+                yield (doc_id, ) + self._decode_document(*document)
+
+    def iter_doc_ids(self) -> Iterator[str]:
+        """Iterate over the IDs of the documents added, in order.
+
+        Yields:
+            str: The document IDs.
+        """
+        self.flush()
+        cursor = self.conn.execute("SELECT doc_id FROM documents ORDER BY rowid")
+        while True:
+            rows = cursor.fetchmany(self._batch_size)
             if not rows:
                 break
             for row in rows:
-                yield self.model_type.parse_raw(row[0])
+                yield row[0]
+
+    def nr_of_documents(self) -> int:
+        self.flush()
+        return self.conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def part(self, doc_id: str) -> 'DocumentDifferences[T]':
+        """Get the differences of a single document.
+
+        Args:
+            doc_id (str): The document ID.
+
+        Returns:
+            DocumentDifferences[T]: The differences of the document.
+        """
+        return DocumentDifferences(self, doc_id)
 
     def __len__(self) -> int:
         return self._len
 
+    def close(self) -> None:
+        if getattr(self, 'conn', None) is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None  # type: ignore
+
     def __del__(self):
-        self.conn.close()
+        self.close()
+
+
+class DocumentDifferences(Generic[T]):
+    """The differences of a single document in a `DifferenceDatabase`.
+
+    Args:
+        db (DifferenceDatabase[T]): The database.
+        doc_id (str): The document ID.
+    """
+
+    def __init__(self, db: DifferenceDatabase[T], doc_id: str):
+        self.db = db
+        self.doc_id = doc_id
+
+    def append(self, difference: T) -> None:
+        self.db.append(self.doc_id, difference)
+
+    def __iter__(self) -> Iterator[T]:
+        return self.db.iter_doc(self.doc_id)
+
+    def __len__(self) -> int:
+        return self.db.doc_len(self.doc_id)
@@ -1,5 +1,8 @@
-from typing import List, Tuple, Dict, Set, Optional, Union, Iterator
+from typing import List, Tuple, Dict, Set, Optional, Union, Iterator, Deque
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from functools import partial
+import multiprocessing
 import glob
 
 from medcat.cat import CAT
@@ -44,9 +47,9 @@ def do_counting(cat1: CAT, cat2: CAT,
     res2 = ResultsTally(pt2ch=_get_pt2ch(cat2), cat_data=cat2.cdb.make_stats(),
                         cui2name=partial(cui2name, cat2))
     total = doc_limit if doc_limit != -1 else None
-    for per_doc in tqdm.tqdm(ann_diffs.per_doc_results.values(), total=total):
-        res1.count(per_doc.raw1)
-        res2.count(per_doc.raw2)
+    for _, raw1, raw2 in tqdm.tqdm(ann_diffs.iter_raw_entities(), total=total):
+        res1.count(raw1)
+        res2.count(raw2)
     return res1, res2
 
 
@@ -54,24 +57,115 @@ def _get_pt2ch(cat: CAT) -> Optional[Dict]:
     return cat.cdb.addl_info.get("pt2ch", None)
 
 
+_worker_cats: Tuple[Optional[CAT], Optional[CAT]] = (None, None)
+
+
+def _init_worker(cat1: CAT, cat2: CAT) -> None:
+    global _worker_cats
+    _worker_cats = (cat1, cat2)
+
+
+def _compact(out: Dict) -> Dict:
+    # only the entities are compared (i.e no tokens)
+    return {'entities': out.get('entities', {})}
+
+
+def _annotate_batch(batch: List[Tuple[str, str]], addl_info: List[str]) -> List[Tuple[Dict, Dict]]:
+    cat1, cat2 = _worker_cats
+    texts = [doc for _, doc in batch]
+    out1 = cat1.get_entities_multi_texts(texts, addl_info=addl_info)  # type: ignore
+    out2 = cat2.get_entities_multi_texts(texts, addl_info=addl_info)  # type: ignore
+    return [(_compact(o1), _compact(o2)) for o1, o2 in zip(out1, out2)]
+
+
+def _get_executor(cat1: CAT, cat2: CAT, nproc: int) -> ProcessPoolExecutor:
+    # forked workers share the (filtered and/or trained) models instead of loading them again
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    return ProcessPoolExecutor(max_workers=nproc, mp_context=context,
+                               initializer=_init_worker, initargs=(cat1, cat2))
+
+
+def _iter_batches(documents: Iterator[Tuple[str, str]], batch_size: int) -> Iterator[List[Tuple[str, str]]]:
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _batch_results(future: Future, batch: List[Tuple[str, str]]) -> Iterator[Tuple[str, str, Dict, Dict]]:
+    for (doc_id, doc), (ents1, ents2) in zip(batch, future.result()):
+        yield doc_id, doc, ents1, ents2
+
+
+def _get_entities_parallel(cat1: CAT, cat2: CAT, documents: Iterator[Tuple[str, str]],
+                           nproc: int, batch_size: int, addl_info: List[str]
+                           ) -> Iterator[Tuple[str, str, Dict, Dict]]:
+    in_flight: Deque[Tuple[Future, List[Tuple[str, str]]]] = deque()
+    with _get_executor(cat1, cat2, nproc) as executor:
+        for batch in _iter_batches(iter(documents), batch_size):
+            in_flight.append((executor.submit(_annotate_batch, batch, addl_info), batch))
+            # keep a couple of batches per worker going
+            if len(in_flight) >= 2 * nproc:
+                yield from _batch_results(*in_flight.popleft())
+        while in_flight:
+            yield from _batch_results(*in_flight.popleft())
+
+
 def get_per_annotation_diffs(cat1: CAT, cat2: CAT, documents: Iterator[Tuple[str, str]],
                              show_progress: bool = True,
                              keep_raw: bool = True,
-                             doc_limit: int = -1
+                             doc_limit: int = -1,
+                             nproc: int = 1,
+                             batch_size: int = 100,
+                             out_of_core: bool = False,
+                             addl_info: List[str] = ['cui2icd10', 'cui2ontologies', 'cui2snomed'],
                              ) -> PerAnnotationDifferences:
+    """Find the differences between the annotations of two models.
+
+    With `nproc` > 1 the documents are annotated by a pool of worker processes in batches of
+    `batch_size` documents. Each worker has both of the models (forked from this process)
+    and annotates each batch with both of them. Only the entities (i.e no tokens) are sent back.
+
+    Args:
+        cat1 (CAT): The first model.
+        cat2 (CAT): The second model.
+        documents (Iterator[Tuple[str, str]]): The documents (doc_id, text).
+        show_progress (bool): Whether to show progress. Defaults to True.
+        keep_raw (bool): Whether to keep the raw text. Defaults to True.
+        doc_limit (int): The number of documents (for the progress bar), or -1. Defaults to -1.
+        nproc (int): The number of worker processes. Defaults to 1 (i.e annotate in this process).
+        batch_size (int): The number of documents per batch of a worker. Defaults to 100.
+        out_of_core (bool): Whether to keep the raw text and entities of the documents on disk
+            instead of in memory (see `PerAnnotationDifferences`). Defaults to False.
+        addl_info (List[str]): The additional info added to the entities (as in `CAT.get_entities`).
+            Defaults to ['cui2icd10', 'cui2ontologies', 'cui2snomed'].
+
+    Returns:
+        PerAnnotationDifferences: The differences.
+    """
     pt2ch1: Optional[Dict] = _get_pt2ch(cat1)
     pt2ch2: Optional[Dict] = _get_pt2ch(cat2)
     temp_file = tempfile.NamedTemporaryFile()
     save_opts = SaveOptions(use_db=True, db_file_name=temp_file.name,
-                            clean_callback=temp_file.close)
+                            clean_callback=temp_file.close, out_of_core=out_of_core)
     pad = PerAnnotationDifferences(pt2ch1=pt2ch1, pt2ch2=pt2ch2,
                                    model1_cuis=set(cat1.cdb.cui2names),
                                    model2_cuis=set(cat2.cdb.cui2names),
                                    keep_raw=keep_raw,
                                    save_options=save_opts)
     total = doc_limit if doc_limit != -1 else None
-    for doc_id, doc in tqdm.tqdm(documents, disable=not show_progress, total=total):
-        pad.look_at_doc(cat1.get_entities(doc), cat2.get_entities(doc), doc_id, doc)
+    if nproc > 1:
+        annotated = _get_entities_parallel(cat1, cat2, documents, nproc, batch_size, addl_info)
+        for doc_id, doc, ents1, ents2 in tqdm.tqdm(annotated, disable=not show_progress, total=total):
+            pad.look_at_doc(ents1, ents2, doc_id, doc)
+    else:
+        for doc_id, doc in tqdm.tqdm(documents, disable=not show_progress, total=total):
+            pad.look_at_doc(cat1.get_entities(doc, addl_info=addl_info),
+                            cat2.get_entities(doc, addl_info=addl_info), doc_id, doc)
     pad.finalise()
     return pad
 
@@ -115,6 +209,8 @@ def get_diffs_for(model_pack_path_1: str,
                   supervised_train_comparison_model: bool = False,
                   keep_raw: bool = True,
                   doc_limit: int = -1,
+                  nproc: int = 1,
+                  out_of_core: bool = False,
                   ) -> Tuple[CDBCompareResults, ResultsTally, ResultsTally, PerAnnotationDifferences]:
     validate_input(model_pack_path_1, model_pack_path_2, documents_file, cui_filter, supervised_train_comparison_model)
     documents = load_documents(documents_file, doc_limit=doc_limit)
@@ -154,7 +250,7 @@ def get_diffs_for(model_pack_path_1: str,
         cat1.config.linking.filters.cuis = cui_filter
         cat2.config.linking.filters.cuis = cui_filter
     ann_diffs = get_per_annotation_diffs(cat1, cat2, documents, keep_raw=keep_raw,
-                                         doc_limit=doc_limit)
+                                         doc_limit=doc_limit, nproc=nproc, out_of_core=out_of_core)
     if show_progress:
         print("Counting [1&2]")
     res1, res2 = do_counting(cat1, cat2, ann_diffs, doc_limit=doc_limit)
@@ -1,13 +1,14 @@
-from typing import List, Tuple, Dict, Set, Callable, Optional, Union, Iterator, Iterable
+from typing import List, Tuple, Dict, Set, Callable, Optional, Union, Iterator, Iterable, Any, Mapping
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, PrivateAttr
 from enum import Enum, auto
-from copy import deepcopy
 
 import pandas as pd
 import json
+import msgpack
+from itertools import islice
 
-from cmp_utils import SaveOptions, DifferenceDatabase
+from cmp_utils import SaveOptions, DifferenceDatabase, DocumentDifferences, RowModel
 
 
 class ResultsTally(BaseModel):
@@ -120,6 +121,10 @@ def _check_overlap_internal(start1: int, end1: int, start2: int, end2: int) -> b
     return True
 
 
+def _sort_by_span(raw: Dict) -> List[Tuple[str, Dict]]:
+    return sorted(raw.items(), key=lambda item: (item[1]['start'], item[1]['end']))
+
+
 class AnnotationComparisonType(Enum):
     """Options as I see them
     - 1st has annotation, 2nd doesn't
@@ -279,79 +284,110 @@ class AnnotationComparisonType(Enum):
         return cls.PARTIAL_OVERLAP_DIFF_CONCEPT
 
 
-class AnnotationPair(BaseModel):
+# rows of a CSV written at once
+_CSV_CHUNK_SIZE = 10000
+# entity keys stored in their own columns
+_FIXED_KEYS = ('cui', 'start', 'end', 'acc')
+_COMPARISON_TYPES = {comp.value: comp for comp in AnnotationComparisonType}
+
+
+def _entity_columns(nr: int) -> Tuple[Tuple[str, str], ...]:
+    return ((f'cui{nr}', 'TEXT'), (f'start{nr}', 'INTEGER'), (f'end{nr}', 'INTEGER'), (f'acc{nr}', 'REAL'))
+
+
+class AnnotationPair(RowModel):
     one: Optional[Dict]
     two: Optional[Dict]
     comparison_type: AnnotationComparisonType
 
+    # the rest of the entities is packed with msgpack (as {'one': {...}, 'two': {...}})
+    ROW_COLUMNS = (('comparison_type', 'INTEGER'),) + _entity_columns(1) + _entity_columns(2) + (('rest', 'BLOB'),)
+
+    def to_row(self) -> Tuple[Any, ...]:
+        row: List[Any] = [self.comparison_type.value]
+        rest: Dict[str, Dict] = {}
+        for name, entity in (('one', self.one), ('two', self.two)):
+            if entity is None:
+                row.extend((None, ) * len(_FIXED_KEYS))
+                continue
+            # missing (or None) values are kept with the rest
+            row.extend(entity.get(key) for key in _FIXED_KEYS)
+            rest[name] = {key: value for key, value in entity.items()
+                          if key not in _FIXED_KEYS or value is None}
+        row.append(msgpack.packb(rest))
+        return tuple(row)
+
+    @classmethod
+    def from_rows(cls, rows: List[Tuple[Any, ...]]) -> List['AnnotationPair']:
+        pairs = []
+        nr_of_keys = len(_FIXED_KEYS)
+        for row in rows:
+            rest = msgpack.unpackb(row[-1])
+            entities: List[Optional[Dict]] = []
+            for nr, name in enumerate(('one', 'two')):
+                if name not in rest:
+                    entities.append(None)
+                    continue
+                values = row[1 + nr * nr_of_keys: 1 + (nr + 1) * nr_of_keys]
+                entity = {key: value for key, value in zip(_FIXED_KEYS, values) if value is not None}
+                entity.update(rest[name])
+                entities.append(entity)
+            pairs.append(cls.model_construct(one=entities[0], two=entities[1],
+                                             comparison_type=_COMPARISON_TYPES[row[0]]))
+        return pairs
+
     @classmethod
     def iterate_over(cls, raw1: dict, raw2: dict,
                      pt2ch1: Optional[dict], pt2ch2: Optional[dict],
                      model1_cuis: Set[str], model2_cuis: Set[str],
                      ) -> Iterator['AnnotationPair']:
-        # keep originals
-        _raw1 = raw1
-        _raw2 = raw2
-        raw1 = deepcopy(raw1)
-        raw2 = deepcopy(raw2)
-        while len(raw1) or len(raw2):
-            # first key in either dict of entities
-            if raw1:
-                k1 = sorted(raw1.keys())[0]
-                v1 = raw1[k1]
-            else:
-                k1 = None
-                v1 = None
-            if raw2:
-                k2 = sorted(raw2.keys())[0]
-                v2 = raw2[k2]
-            else:
-                k2 = None
-                v2 = None
-            # corresponding value in either dict of entities
+        # sort once by span and sweep both lists with a cursor each
+        ents1 = _sort_by_span(raw1)
+        ents2 = _sort_by_span(raw2)
+        i1 = i2 = 0
+        while i1 < len(ents1) or i2 < len(ents2):
+            # first (remaining) entity in either list
+            k1, v1 = ents1[i1] if i1 < len(ents1) else (None, None)
+            k2, v2 = ents2[i2] if i2 < len(ents2) else (None, None)
             comp = AnnotationComparisonType.determine(v1, v2, pt2ch1, pt2ch2,
                                                       model1_cuis, model2_cuis)
             rem_1st = comp.in_first()
             rem_2nd = comp.in_second()
+            if not rem_1st and not rem_2nd:
+                # can't move forward, would be stuck in infinte loop
+                raise ValueError("Unknown comparison that leaves us"
+                                 "in an infinite loop. Happened while"
+                                 f"comparing '{k1}' ({v1})"
+                                 f"to '{k2}' ({v2})")
             if rem_1st:
-                del raw1[k1]
+                i1 += 1
             else:
-                # now overlap with 1st
+                # no overlap with 1st
                 v1 = None
             if rem_2nd:
-                del raw2[k2]
+                i2 += 1
             else:
                 # no overlap with 2nd
                 v2 = None
-            if not rem_1st and not rem_2nd:
-                # can't move forward, would be stuck in infinte loop
-                raise ValueError("Unknown comparison that leaves us"
-                                 "in an infinite loop. Happened while"
-                                 f"comparing '{k1}' ({v1})"
-                                 f"to '{k2}' ({v2})")
-            # using parts from the original dict instead of
-            # the copied one for better memory management
-            # (since the original raw is also being kept in PerDocAnnotationDifferences)
-            if k1 is not None and v1 is not None:
-                v1 = _raw1[k1]
-            if k2 is not None and v2 is not None:
-                v2 = _raw2[k2]
             yield cls(one=v1, two=v2, comparison_type=comp)
 
 
 class PerDocAnnotationDifferences(BaseModel):
     nr_of_comparisons: Dict[AnnotationComparisonType, int] = {}
-    all_annotation_pairs: Union[List[AnnotationPair], Iterable[AnnotationPair]]
+    all_annotation_pairs: Union[List[AnnotationPair], DocumentDifferences]
     raw_text: str
     raw1: Dict
     raw2: Dict
 
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     @classmethod
     def get(cls, doc_id: str, raw_text: str, d1: dict, d2: dict,
             pt2ch1: Optional[dict], pt2ch2: Optional[dict],
             model1_cuis: Set[str], model2_cuis: Set[str],
             save_options: SaveOptions = SaveOptions(),
             keep_raw: bool = True,
+            db: Optional[DifferenceDatabase] = None,
             ) -> 'PerDocAnnotationDifferences':
         # creating copies so I can ditch the entries
         # that I've already dealt with
@@ -364,9 +400,9 @@ class PerDocAnnotationDifferences(BaseModel):
         #   'snomed', 'id', 'meta_anns']
         comparisons: Dict[AnnotationComparisonType, int] = {}
         if save_options.use_db:
-            all_annotation_pairs: DifferenceDatabase = DifferenceDatabase(db_file=save_options.db_file_name,
-                                                                          part=doc_id,
-                                                                          model_type=AnnotationPair)
+            if db is None:
+                db = DifferenceDatabase(db_file=save_options.db_file_name, model_type=AnnotationPair)
+            all_annotation_pairs: DocumentDifferences = db.part(doc_id)
         else:
             all_annotation_pairs = []
         for pair in AnnotationPair.iterate_over(raw1, raw2, pt2ch1, pt2ch2,
@@ -382,25 +418,92 @@ class PerDocAnnotationDifferences(BaseModel):
                    raw1=raw1, raw2=raw2, raw_text=raw_text)
 
 
+class StoredDocResults(Mapping[str, PerDocAnnotationDifferences]):
+    """The per document results of an out-of-core comparison.
+
+    The results are loaded from the database when accessed.
+
+    Args:
+        db (DifferenceDatabase[AnnotationPair]): The database the documents were added to.
+    """
+
+    def __init__(self, db: DifferenceDatabase[AnnotationPair]):
+        self.db = db
+
+    def __getitem__(self, doc_id: str) -> PerDocAnnotationDifferences:
+        raw1, raw2, counts = self.db.get_document(doc_id)
+        return PerDocAnnotationDifferences(
+            nr_of_comparisons={_COMPARISON_TYPES[comp]: cnt for comp, cnt in counts.items()},
+            all_annotation_pairs=self.db.part(doc_id), raw_text=self.db.get_text(doc_id),
+            raw1=raw1, raw2=raw2)
+
+    def __contains__(self, doc_id: object) -> bool:
+        return isinstance(doc_id, str) and self.db.has_document(doc_id)
+
+    def __iter__(self) -> Iterator[str]:
+        return self.db.iter_doc_ids()
+
+    def __len__(self) -> int:
+        return self.db.nr_of_documents()
+
+
 class PerAnnotationDifferences(BaseModel):
+    """The differences between the annotations of two models.
+
+    With `save_options.out_of_core` (and `use_db`) only the totals are kept in memory.
+    The annotation pairs as well as the raw text and entities of each document are
+    written to the database and `per_doc_results` loads them from there when accessed.
+    """
     model1_cuis: Set[str]
     model2_cuis: Set[str]
     pt2ch1: Optional[Dict]
     pt2ch2: Optional[Dict]
     save_options: SaveOptions = SaveOptions()
-    per_doc_results: Dict[str, PerDocAnnotationDifferences] = {}
+    per_doc_results: Union[Dict[str, PerDocAnnotationDifferences], StoredDocResults] = {}
     totals: Optional[Dict[AnnotationComparisonType, int]] = None
     keep_raw: bool = True
+    _db: Optional[DifferenceDatabase] = PrivateAttr(default=None)
+    _running_totals: Dict[AnnotationComparisonType, int] = PrivateAttr(default_factory=dict)
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    def model_post_init(self, __context: Any) -> None:
+        if self._is_out_of_core():
+            self.per_doc_results = StoredDocResults(self._get_db())  # type: ignore
+
+    def _is_out_of_core(self) -> bool:
+        return self.save_options.use_db and self.save_options.out_of_core
+
+    def _get_db(self) -> Optional[DifferenceDatabase]:
+        # all documents share the one database (and connection)
+        if self.save_options.use_db and self._db is None:
+            self._db = DifferenceDatabase(db_file=self.save_options.db_file_name,  # type: ignore
+                                          model_type=AnnotationPair)
+        return self._db
 
     def look_at_doc(self, d1: dict, d2: dict, doc_id: str, raw_text: str):
-        self.per_doc_results[doc_id] = PerDocAnnotationDifferences.get(doc_id, raw_text, d1, d2,
-                                                                       self.pt2ch1, self.pt2ch2,
-                                                                       self.model1_cuis,
-                                                                       self.model2_cuis,
-                                                                       self.save_options,
-                                                                       self.keep_raw)
+        per_doc = PerDocAnnotationDifferences.get(doc_id, raw_text, d1, d2,
+                                                  self.pt2ch1, self.pt2ch2,
+                                                  self.model1_cuis,
+                                                  self.model2_cuis,
+                                                  self.save_options,
+                                                  self.keep_raw,
+                                                  db=self._get_db())
+        if not self._is_out_of_core():
+            self.per_doc_results[doc_id] = per_doc  # type: ignore
+            return
+        self._get_db().add_document(  # type: ignore
+            doc_id, per_doc.raw_text, per_doc.raw1, per_doc.raw2,
+            {comp.value: cnt for comp, cnt in per_doc.nr_of_comparisons.items()})
+        for comp, cnt in per_doc.nr_of_comparisons.items():
+            self._running_totals[comp] = self._running_totals.get(comp, 0) + cnt
 
     def finalise(self):
+        if self._db is not None:
+            self._db.flush()
+        if self._is_out_of_core():
+            self.totals = dict(self._running_totals)
+            return
         totals: Dict[AnnotationComparisonType, int] = {}
         for value in self.per_doc_results.values():
             for k, v in value.nr_of_comparisons.items():
@@ -409,6 +512,35 @@ class PerAnnotationDifferences(BaseModel):
                 totals[k] += v
         self.totals = totals
 
+    def iter_raw_entities(self) -> Iterator[Tuple[str, Dict, Dict]]:
+        """Iterate over the raw entities of each document (without loading the text).
+
+        Yields:
+            Iterator[Tuple[str, Dict, Dict]]: The document ID, the entities of model 1 and the entities of model 2.
+        """
+        if self._is_out_of_core():
+            for doc_id, raw1, raw2, _ in self._get_db().iter_documents():  # type: ignore
+                yield doc_id, raw1, raw2
+            return
+        for doc_id, per_doc in self.per_doc_results.items():
+            yield doc_id, per_doc.raw1, per_doc.raw2
+
+    def _iter_doc_pairs(self, docs: Optional[Iterable[str]]) -> Iterator[Tuple[str, Iterable[AnnotationPair]]]:
+        if not self._is_out_of_core():
+            for doc, per_doc in self.per_doc_results.items():
+                if docs is None or doc in docs:
+                    yield doc, per_doc.all_annotation_pairs
+            return
+        db: DifferenceDatabase = self._get_db()  # type: ignore
+        for doc in db.iter_doc_ids():
+            if docs is None or doc in docs:
+                yield doc, db.part(doc)
+
+    def _get_raw_text(self, doc_id: str) -> str:
+        if self._is_out_of_core():
+            return self._get_db().get_text(doc_id)  # type: ignore
+        return self.per_doc_results[doc_id].raw_text
+
     def iter_ann_pairs(self,
                        docs: Optional[Iterable[str]] = None,
                        omit_identical: bool = True) -> Iterator[Tuple[str, AnnotationPair]]:
@@ -427,13 +559,15 @@ class PerAnnotationDifferences(BaseModel):
         Yields:
             Iterator[Tuple[str, AnnotationPair]]: An iteration of document name and annotation pair.
         """
-        targets = [(doc, self.per_doc_results[doc]) for doc in self.per_doc_results
-                    if docs is None or doc in docs]
-        for doc, pdad in targets:
-            for pair in pdad.all_annotation_pairs:
-                if omit_identical and pair.comparison_type == AnnotationComparisonType.IDENTICAL:
-                    continue
-                yield doc, pair
+        if docs is None and self._is_out_of_core():
+            # all the pairs in a single pass
+            doc_pairs: Iterable[Tuple[str, AnnotationPair]] = self._get_db()  # type: ignore
+        else:
+            doc_pairs = ((doc, pair) for doc, pairs in self._iter_doc_pairs(docs) for pair in pairs)
+        for doc, pair in doc_pairs:
+            if omit_identical and pair.comparison_type == AnnotationComparisonType.IDENTICAL:
+                continue
+            yield doc, pair
 
     def iter_document_annotations(self, docs: Optional[Iterable[str]] = None,
                                   types_filter: Optional[Set[AnnotationComparisonType]] = None,
@@ -448,15 +582,17 @@ class PerAnnotationDifferences(BaseModel):
             Iterator[Tuple[str, str, Dict, Dict]]:
                 The document ID, the raw text, the annotations for model 1, the annotaitons for model 2
         """
-        targets = [(doc, self.per_doc_results[doc]) for doc in self.per_doc_results
-                    if docs is None or doc in docs]
         if types_filter is None:
             types_filter = set(AnnotationComparisonType)
-        for doc, pdad in targets:
-            for pair in pdad.all_annotation_pairs:
+        for doc, pairs in self._iter_doc_pairs(docs):
+            # only loaded for documents with matching pairs
+            raw_text: Optional[str] = None
+            for pair in pairs:
                 if pair.comparison_type not in types_filter:
                     continue
-                yield doc, pdad.raw_text, pair.one, pair.two
+                if raw_text is None:
+                    raw_text = self._get_raw_text(doc)
+                yield doc, raw_text, pair.one, pair.two
 
     def _get_text(self, raw_text: str, span_char_limit: Optional[int],
                   ann1: Optional[dict], ann2: Optional[dict],
@@ -486,16 +622,14 @@ class PerAnnotationDifferences(BaseModel):
                 ann2['start-raw'], ann2['end-raw'] = start2, end2
         return text
 
-    def _to_raw(self, docs: Set[str],
+    def _to_raw(self, docs: Optional[Set[str]],
                 types_filter: Set[AnnotationComparisonType],
                 span_char_limit: Optional[int] = 200,
-                ) -> List[Tuple[str, str, str, str]]:
-        data: List[Tuple[str, str, str, str]] = []
+                ) -> Iterator[Tuple[str, str, str, str]]:
         for doc_id, raw_text, ann1, ann2 in self.iter_document_annotations(docs, types_filter):
             text = self._get_text(raw_text, span_char_limit=span_char_limit, ann1=ann1, ann2=ann2)
             # convert annotation dicts to json
-            data.append((doc_id, text, json.dumps(ann1), json.dumps(ann2)))
-        return data
+            yield doc_id, text, json.dumps(ann1), json.dumps(ann2)
 
     def to_csv(self, csv_file: str,
                docs: Optional[Iterable[str]] = None,
@@ -519,17 +653,24 @@ class PerAnnotationDifferences(BaseModel):
             docs (Optional[Iterable[str]], optional): The documents to include (or all). Defaults to None.
             span_char_limit (Optional[int], optional): The char span limit either side (or all if None). Defaults to 200.
         """
-        if docs is None:
-            docs = set(self.per_doc_results)
-        else:
+        if docs is not None:
             docs = set(docs)
         if types_filter is None:
             types_filter = set(AnnotationComparisonType)
-        data = self._to_raw(docs, types_filter=types_filter, span_char_limit=span_char_limit)
-        df = pd.DataFrame(data, columns=["doc_id", "text", "ann1", "ann2"])
-        df.to_csv(csv_file, index=False)
+        rows = self._to_raw(docs, types_filter=types_filter, span_char_limit=span_char_limit)
+        # written in chunks so that all the rows don't need to be in memory
+        chunk_nr = 0
+        while True:
+            chunk = list(islice(rows, _CSV_CHUNK_SIZE))
+            if chunk_nr and not chunk:
+                break
+            df = pd.DataFrame(chunk, columns=["doc_id", "text", "ann1", "ann2"])
+            df.to_csv(csv_file, index=False, mode='w' if chunk_nr == 0 else 'a', header=chunk_nr == 0)
+            chunk_nr += 1
 
 
     def __del__(self):
+        if self._db is not None:
+            self._db.close()
         if self.save_options.use_db:
             self.save_options.clean_callback()
@@ -0,0 +1,143 @@
+from cmp_utils import DifferenceDatabase, RowModel
+
+import unittest
+import tempfile
+import os
+
+
+class FakeDifference(RowModel):
+    nr: int
+
+    ROW_COLUMNS = (('nr', 'INTEGER'),)
+
+    def to_row(self) -> tuple:
+        return (self.nr,)
+
+    @classmethod
+    def from_rows(cls, rows: list) -> list:
+        return [cls.model_construct(nr=row[0]) for row in rows]
+
+
+class RowModelTests(unittest.TestCase):
+
+    def test_subclass_without_to_row_fails(self):
+        with self.assertRaises(TypeError):
+            class NoToRow(RowModel):
+                nr: int
+
+                @classmethod
+                def from_rows(cls, rows: list) -> list:
+                    return []
+
+    def test_subclass_without_from_rows_fails(self):
+        with self.assertRaises(TypeError):
+            class NoFromRows(RowModel):
+                nr: int
+
+                def to_row(self) -> tuple:
+                    return (self.nr,)
+
+
+class DifferenceDatabaseTests(unittest.TestCase):
+    docs = {"doc1": 5, "doc2": 0, "doc3": 12}
+
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self._temp_dir.name, "diffs.sqlite")
+        self.db = DifferenceDatabase(self.db_file, FakeDifference, batch_size=4)
+        for doc_id, nr_of_diffs in self.docs.items():
+            for nr in range(nr_of_diffs):
+                self.db.append(doc_id, FakeDifference(nr=nr))
+
+    def tearDown(self) -> None:
+        self.db.close()
+        self._temp_dir.cleanup()
+
+    def test_has_length(self):
+        self.assertEqual(len(self.db), sum(self.docs.values()))
+
+    def test_no_table_per_document(self):
+        tables = self.db.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        self.assertEqual(sorted(tables), [("differences",), ("documents",)])
+
+    def test_iterates_doc(self):
+        for doc_id, nr_of_diffs in self.docs.items():
+            with self.subTest(doc_id):
+                self.assertEqual([diff.nr for diff in self.db.iter_doc(doc_id)], list(range(nr_of_diffs)))
+
+    def test_iterates_all_in_order(self):
+        expected = [(doc_id, nr) for doc_id, nr_of_diffs in self.docs.items() for nr in range(nr_of_diffs)]
+        self.assertEqual([(doc_id, diff.nr) for doc_id, diff in self.db], expected)
+
+    def test_appends_to_earlier_doc(self):
+        self.db.append("doc1", FakeDifference(nr=5))
+        self.assertEqual([diff.nr for diff in self.db.iter_doc("doc1")], list(range(6)))
+
+    def test_part_has_length_of_doc(self):
+        for doc_id, nr_of_diffs in self.docs.items():
+            with self.subTest(doc_id):
+                self.assertEqual(len(self.db.part(doc_id)), nr_of_diffs)
+
+    def test_seq_per_doc(self):
+        expected = [(doc_id, nr) for doc_id, nr_of_diffs in self.docs.items() for nr in range(nr_of_diffs)]
+        self.db.flush()
+        rows = self.db.conn.execute("SELECT doc_id, seq FROM differences ORDER BY rowid").fetchall()
+        self.assertEqual(rows, expected)
+
+    def test_part_can_be_iterated_again(self):
+        part = self.db.part("doc1")
+        self.assertEqual(len(part), 5)
+        self.assertEqual(list(part), list(part))
+
+    def test_written_on_close(self):
+        self.db.close()
+        db = DifferenceDatabase(self.db_file, FakeDifference)
+        self.assertEqual(len(db), sum(self.docs.values()))
+        self.assertEqual(len(list(db)), sum(self.docs.values()))
+        db.close()
+
+    def test_appends_after_reopen(self):
+        self.db.close()
+        db = DifferenceDatabase(self.db_file, FakeDifference, batch_size=4)
+        db.append("doc3", FakeDifference(nr=12))
+        db.append("doc1", FakeDifference(nr=5))
+        db.append("doc4", FakeDifference(nr=0))
+        self.assertEqual([diff.nr for diff in db.iter_doc("doc3")], list(range(13)))
+        self.assertEqual([diff.nr for diff in db.iter_doc("doc1")], list(range(6)))
+        self.assertEqual(len(db.part("doc4")), 1)
+        db.close()
+
+
+class DocumentStoreTests(unittest.TestCase):
+    docs = {f"doc{nr}": (f"Text of document {nr}", {0: {"cui": "C1", "start": nr}}, {}, {1: nr})
+            for nr in range(7)}
+
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.db = DifferenceDatabase(os.path.join(self._temp_dir.name, "diffs.sqlite"), FakeDifference,
+                                     batch_size=3)
+        for doc_id, (text, raw1, raw2, counts) in self.docs.items():
+            self.db.add_document(doc_id, text, raw1, raw2, counts)
+
+    def tearDown(self) -> None:
+        self.db.close()
+        self._temp_dir.cleanup()
+
+    def test_has_documents(self):
+        self.assertEqual(self.db.nr_of_documents(), len(self.docs))
+        self.assertTrue(self.db.has_document("doc3"))
+        self.assertFalse(self.db.has_document("doc30"))
+
+    def test_gets_document(self):
+        text, raw1, raw2, counts = self.docs["doc2"]
+        self.assertEqual(self.db.get_document("doc2"), (raw1, raw2, counts))
+        self.assertEqual(self.db.get_text("doc2"), text)
+
+    def test_unknown_document(self):
+        with self.assertRaises(KeyError):
+            self.db.get_document("doc30")
+
+    def test_iterates_documents_in_order(self):
+        self.assertEqual(list(self.db.iter_doc_ids()), list(self.docs))
+        self.assertEqual([(doc_id, raw1, raw2, counts) for doc_id, raw1, raw2, counts in self.db.iter_documents()],
+                         [(doc_id, raw1, raw2, counts) for doc_id, (_, raw1, raw2, counts) in self.docs.items()])
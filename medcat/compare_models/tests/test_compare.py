@@ -1,6 +1,7 @@
 import unittest.mock
 from compare import _add_all_children
 from compare import get_diffs_for
+from compare import get_per_annotation_diffs
 from compare import (CDBCompareResults, ResultsTally,
                      ResultsTally, PerAnnotationDifferences)
 import unittest
@@ -67,6 +68,78 @@ class AddAllChildrenTests(unittest.TestCase):
         self.assertEqual(f, self.cui_filter | self.children_1st_order | self.children_2nd_order)
 
 
+class FakeCDB:
+
+    def __init__(self, cuis: list) -> None:
+        self.cui2names = {cui: {cui.lower()} for cui in cuis}
+        self.addl_info: dict = {}
+
+
+class FakeAnnotatingCAT:
+    """Annotates every word in the CDB (lower case) with its CUI."""
+
+    def __init__(self, cuis: list) -> None:
+        self.cdb = FakeCDB(cuis)
+
+    def get_entities(self, text: str, addl_info: list = ['cui2icd10', 'cui2ontologies', 'cui2snomed']) -> dict:
+        entities = {}
+        start = 0
+        for word in text.split():
+            start = text.index(word, start)
+            if word.upper() in self.cdb.cui2names:
+                entity = {"cui": word.upper(), "start": start, "end": start + len(word),
+                          "acc": 1.0, "type_ids": [], "detected_name": word}
+                # e.g cui2icd10 -> icd10
+                entity.update({info[len("cui2"):]: [f"{word.upper()}-{info}"] for info in addl_info})
+                entities[len(entities)] = entity
+            start += len(word)
+        return {"entities": entities, "tokens": []}
+
+    def get_entities_multi_texts(self, texts: list,
+                                 addl_info: list = ['cui2icd10', 'cui2ontologies', 'cui2snomed']) -> list:
+        return [self.get_entities(text, addl_info) for text in texts]
+
+
+class ParallelPerAnnotationDiffsTests(unittest.TestCase):
+    cat1 = FakeAnnotatingCAT(["C1", "C2"])
+    cat2 = FakeAnnotatingCAT(["C2", "C3"])
+    docs = [(f"doc{nr}", "c1 and c2 or c3 " * (nr % 4)) for nr in range(25)]
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.sequential = get_per_annotation_diffs(cls.cat1, cls.cat2, iter(cls.docs), show_progress=False)
+        cls.parallel = get_per_annotation_diffs(cls.cat1, cls.cat2, iter(cls.docs), show_progress=False,
+                                                nproc=2, batch_size=3)
+        cls.out_of_core = get_per_annotation_diffs(cls.cat1, cls.cat2, iter(cls.docs), show_progress=False,
+                                                   nproc=2, batch_size=3, out_of_core=True)
+
+    def test_has_all_docs(self):
+        self.assertEqual(list(self.parallel.per_doc_results), [doc_id for doc_id, _ in self.docs])
+
+    def test_same_as_sequential(self):
+        self.assertEqual(self.parallel.totals, self.sequential.totals)
+        self.assertEqual(list(self.parallel.iter_ann_pairs()), list(self.sequential.iter_ann_pairs()))
+
+    def test_same_raw_entities_as_sequential(self):
+        for doc_id, _ in self.docs:
+            with self.subTest(doc_id):
+                parallel, sequential = self.parallel.per_doc_results[doc_id], self.sequential.per_doc_results[doc_id]
+                self.assertEqual(parallel.raw1, sequential.raw1)
+                self.assertEqual(parallel.raw2, sequential.raw2)
+        self.assertIn("icd10", self.parallel.per_doc_results["doc1"].raw1[0])
+
+    def test_passes_addl_info(self):
+        pad = get_per_annotation_diffs(self.cat1, self.cat2, iter(self.docs[:3]), show_progress=False,
+                                       nproc=2, addl_info=["cui2snomed"])
+        self.assertEqual(set(pad.per_doc_results["doc1"].raw1[0]) & {"icd10", "ontologies", "snomed"},
+                         {"snomed"})
+
+    def test_out_of_core_same_as_in_memory(self):
+        self.assertEqual(self.out_of_core.totals, self.sequential.totals)
+        self.assertEqual(list(self.out_of_core.iter_ann_pairs()), list(self.sequential.iter_ann_pairs()))
+        self.assertEqual(list(self.out_of_core.iter_raw_entities()), list(self.sequential.iter_raw_entities()))
+
+
 class TrainAndCompareTests(unittest.TestCase):
     _file_dir = os.path.dirname(__file__)
     _resources_path = os.path.join(_file_dir, "resources")
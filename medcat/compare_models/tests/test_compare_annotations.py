@@ -1,4 +1,5 @@
 import compare_annotations
+from cmp_utils import SaveOptions
 
 import unittest
 import tempfile
@@ -6,6 +7,14 @@ import os
 import pandas as pd
 
 
+def _get_save_options(out_of_core: bool) -> SaveOptions:
+    if not out_of_core:
+        return SaveOptions()
+    temp_file = tempfile.NamedTemporaryFile()
+    return SaveOptions(use_db=True, db_file_name=temp_file.name, clean_callback=temp_file.close,
+                       out_of_core=True)
+
+
 # helper class for substituting @classmethod and @property
 # this is needed because this functionality is deprecated
 # in python3.11 and will be removed in 3.13
@@ -305,6 +314,32 @@ class OverLapOneLargerDiffConceptTests(OverLapOneLargerSameConceptTests):
 # per document tests
 
 
+class AnnotationPairRowTests(unittest.TestCase):
+    full = {"pretty_name": "Concept 1", "cui": "C1", "type_ids": ["T1"], "start": 10, "end": 15,
+            "acc": 0.75, "context_similarity": 0.75, "meta_anns": {"Presence": {"value": "True",
+                                                                               "confidence": 0.9}}}
+    # no accuracy
+    partial = {"start": 12, "end": 20, "cui": "C2"}
+    pairs = [
+        compare_annotations.AnnotationPair(one=full, two=partial, comparison_type=(
+            compare_annotations.AnnotationComparisonType.PARTIAL_OVERLAP_DIFF_CONCEPT)),
+        compare_annotations.AnnotationPair(one=None, two=full, comparison_type=(
+            compare_annotations.AnnotationComparisonType.SECOND_HAS)),
+        compare_annotations.AnnotationPair(one=dict(partial, acc=None), two=None, comparison_type=(
+            compare_annotations.AnnotationComparisonType.FIRST_HAS)),
+    ]
+
+    def setUp(self) -> None:
+        self.rows = [pair.to_row() for pair in self.pairs]
+
+    def test_has_fixed_columns(self):
+        self.assertEqual(len(self.rows[0]), len(compare_annotations.AnnotationPair.ROW_COLUMNS))
+        self.assertEqual(self.rows[0][1:5], ("C1", 10, 15, 0.75))
+
+    def test_round_trip(self):
+        self.assertEqual(compare_annotations.AnnotationPair.from_rows(self.rows), self.pairs)
+
+
 class PerDocAnnotationSameTests(unittest.TestCase):
     entities = {"0": {"start": 10, "end": 25, "cui": 'C1'},
                 "1": {"start": 40, "end": 55, "cui": 'C2'}}
@@ -458,6 +493,32 @@ class PerDocAnnotatingUnevenLengthsComplicatedTests(unittest.TestCase):
         self.assertEqual(pdad.nr_of_comparisons, self.expected21)
 
 
+class IterateOverKeyOrderTests(unittest.TestCase):
+    # keys that don't follow the character offsets
+    entities1 = {"2": {"start": 10, "end": 25, "cui": 'C1'},
+                 "10": {"start": 40, "end": 55, "cui": 'C2'}}
+    entities2 = {"1": {"start": 40, "end": 55, "cui": 'C2'},
+                 "0": {"start": 10, "end": 25, "cui": 'C1'},
+                 "5": {"start": 30, "end": 35, "cui": 'C3'}}
+    cuis = {'C1', 'C2', 'C3'}
+
+    def setUp(self) -> None:
+        self.pairs = list(compare_annotations.AnnotationPair.iterate_over(self.entities1, self.entities2,
+                                                                          None, None, self.cuis, self.cuis))
+
+    def test_matches_by_offset(self):
+        self.assertEqual([pair.comparison_type for pair in self.pairs],
+                         [compare_annotations.AnnotationComparisonType.IDENTICAL,
+                          compare_annotations.AnnotationComparisonType.SECOND_HAS,
+                          compare_annotations.AnnotationComparisonType.IDENTICAL])
+
+    def test_leaves_entities_unchanged(self):
+        self.assertEqual(self.pairs[0].one, self.entities1["2"])
+        self.assertEqual(self.pairs[1].two, self.entities2["5"])
+        self.assertEqual(len(self.entities1), 2)
+        self.assertEqual(len(self.entities2), 3)
+
+
 # now for PerAnnotationDifferences
 
 
@@ -542,10 +603,13 @@ class PerAnnotationSomeDifferencesIdenticalTests(unittest.TestCase):
     def cuis(cls) -> set:
         return _get_cuis(cls, start_char="annotations")
 
+    out_of_core = False
+
     def setUp(self):
         self.pad = compare_annotations.PerAnnotationDifferences(pt2ch1=None, pt2ch2=None,
                                                                 model1_cuis=self.cuis,
-                                                                model2_cuis=self.cuis)
+                                                                model2_cuis=self.cuis,
+                                                                save_options=_get_save_options(self.out_of_core))
         for nr, (ann1, ann2) in enumerate(zip(self.annotations1, self.annotations2)):
             self.pad.look_at_doc(ann1, ann2, f"{nr}", "")
         self.pad.finalise()
@@ -706,6 +770,23 @@ class FindsParentsTest(unittest.TestCase):
                                       compare_annotations.AnnotationComparisonType.SAME_SPAN_CONCEPT_NOT_IN_2ND)
 
 
+class OutOfCorePerAnnotationSomeDifferencesTests(PerAnnotationSomeDifferencesIdenticalTests):
+    out_of_core = True
+
+    def test_keeps_docs_in_db(self):
+        self.assertIsInstance(self.pad.per_doc_results, compare_annotations.StoredDocResults)
+        self.assertEqual(list(self.pad.per_doc_results), ["0", "1"])
+        self.assertEqual(self.pad.per_doc_results["1"].raw1, self.annotations1[1]["entities"])
+        self.assertEqual(self.pad.per_doc_results["1"].nr_of_comparisons,
+                         {compare_annotations.AnnotationComparisonType.FIRST_HAS: 2,
+                          compare_annotations.AnnotationComparisonType.SECOND_HAS: 1})
+
+    def test_iterates_raw_entities(self):
+        self.assertEqual(list(self.pad.iter_raw_entities()),
+                         [(f"{nr}", ann1["entities"], ann2["entities"])
+                          for nr, (ann1, ann2) in enumerate(zip(self.annotations1, self.annotations2))])
+
+
 class PerAnnotationCSVTests(unittest.TestCase):
     docs = [
         # doc1    10 ...        25
@@ -750,12 +831,15 @@ class PerAnnotationCSVTests(unittest.TestCase):
     def cuis(cls) -> set:
         return _get_cuis(cls, start_char="annotations")
 
+    out_of_core = False
+
     @classmethod
     def setUpClass(cls) -> None:
         cls.pad = compare_annotations.PerAnnotationDifferences(pt2ch1=None,
                                                                pt2ch2=None,
                                                                model1_cuis=cls.cuis,
-                                                               model2_cuis=cls.cuis)
+                                                               model2_cuis=cls.cuis,
+                                                               save_options=_get_save_options(cls.out_of_core))
         for doc_nr, (doc, ents1, ents2) in enumerate(zip(cls.docs, cls.annotations1, cls.annotations2)):
             cls.pad.look_at_doc(ents1, ents2, f"doc_{doc_nr}", doc)
         cls.pad.finalise()
@@ -829,6 +913,12 @@ class PerAnnotationCSVTests(unittest.TestCase):
         self.assert_annotations_remain_same(df, 'ann2', self.annotations2)
 
 
+class OutOfCorePerAnnotationCSVTests(PerAnnotationCSVTests):
+    out_of_core = True
+    temp_folder = tempfile.TemporaryDirectory()
+    file = os.path.join(temp_folder.name, PerAnnotationCSVTests.file_name)
+
+
 class DocumentIterationTests(unittest.TestCase):
     docs = PerAnnotationCSVTests.docs
     annotations1 = PerAnnotationCSVTests.annotations1
@@ -843,12 +933,15 @@ class DocumentIterationTests(unittest.TestCase):
     def cuis(cls) -> set:
         return _get_cuis(cls, start_char="annotations")
 
+    out_of_core = False
+
     @classmethod
     def setUpClass(cls) -> None:
         cls.pad = compare_annotations.PerAnnotationDifferences(pt2ch1=None,
                                                                pt2ch2=None,
                                                                model1_cuis=cls.cuis,
-                                                               model2_cuis=cls.cuis)
+                                                               model2_cuis=cls.cuis,
+                                                               save_options=_get_save_options(cls.out_of_core))
         for doc_nr, (doc, ents1, ents2) in enumerate(zip(cls.docs, cls.annotations1, cls.annotations2)):
             cls.pad.look_at_doc(ents1, ents2, f"doc_{doc_nr}", doc)
         cls.pad.finalise()
@@ -881,3 +974,12 @@ class DocumentIterationTests(unittest.TestCase):
     def test_filters_problematic(self):
         self.assert_filters_many(compare_annotations.AnnotationComparisonType.FIRST_HAS,
                                  compare_annotations.AnnotationComparisonType.SECOND_HAS)
+
+
+class OutOfCoreDocumentIterationTests(DocumentIterationTests):
+    out_of_core = True
+
+    def test_has_raw_text(self):
+        for doc_id, raw_text, _, _ in self.pad.iter_document_annotations():
+            with self.subTest(doc_id):
+                self.assertEqual(raw_text, self.docs[int(doc_id[-1])])
@@ -0,0 +1,349 @@
+import os
+import sys
+import json
+import multiprocessing
+import pickle
+import tempfile
+import threading
+
+import unittest
+
+
+_FILE_DIR = os.path.dirname(__file__)
+
+# because this project isn't (at least of of writing this)
+# set up as a python project, there are no __init__.py
+# files in each folder
+# as such, in order to gain access to the relevant module,
+# I'll need to add the path manually
+_WWC_BASE_FOLDER = os.path.join(_FILE_DIR, "..", "..", "..")
+MEDCAT_RUN_MODEL_FOLDER = os.path.abspath(os.path.join(_WWC_BASE_FOLDER, "medcat", "3_run_model"))
+sys.path.append(MEDCAT_RUN_MODEL_FOLDER)
+# and the base folder for cogstack
+sys.path.append(os.path.abspath(_WWC_BASE_FOLDER))
+# now we are able to import annotation_pipeline
+
+import annotation_pipeline
+import annotation_sinks
+import completion_ledger
+
+
+class FakeCAT:
+
+    def get_entities(self, text, only_cui=False, addl_info=[]):
+        if text == "fail":
+            raise ValueError("Can not annotate")
+        return {"entities": {0: {"cui": "C1", "start": 0, "end": len(text)}}, "tokens": []}
+
+
+class NeedleCAT:
+    """Annotates every occurrence of 'needle'."""
+
+    def get_entities(self, text, only_cui=False, addl_info=[]):
+        entities = {}
+        start = text.find("needle")
+        while start != -1:
+            entities[len(entities)] = {"id": len(entities), "cui": "C1", "start": start, "end": start + 6}
+            start = text.find("needle", start + 1)
+        return {"entities": entities, "tokens": []}
+
+
+class NNCAT(NeedleCAT):
+    """Has a neural network component that can be separated, as MedCAT's MetaCAT."""
+
+    def __init__(self):
+        self.nn_enabled = True
+        self.nn_texts = {}
+        self.pipe = self
+        self.spacy_nlp = self
+
+    def get_entities(self, text, only_cui=False, addl_info=[]):
+        doc = super().get_entities(text, only_cui=only_cui, addl_info=addl_info)
+        doc["nn_in_worker"] = self.nn_enabled
+        return doc
+
+    def _separate_nn_components(self):
+        self.nn_enabled = False
+        return [("meta_cat", None)]
+
+    def enable_pipe(self, name):
+        self.nn_enabled = True
+
+    def _run_nn_components(self, docs, nn_components, id2text):
+        self.nn_texts.update(id2text)
+        for doc in docs.values():
+            doc["meta"] = True
+
+
+class ListSink:
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, docs):
+        self.writes.append(dict(docs))
+
+
+def get_data(nr_of_docs: int = 50, consumed: list = None):
+    for nr in range(nr_of_docs):
+        if consumed is not None:
+            consumed.append(nr)
+        yield str(nr), "text " * 10
+
+
+class AnnotationPipelineTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.sink = ListSink()
+        self.pipeline = annotation_pipeline.AnnotationPipeline(FakeCAT(), self.sink, nproc=2,
+                                                               batch_size_chars=100, chunk_size_chars=500)
+
+    def test_annotates_all_docs(self):
+        self.pipeline.run(get_data())
+        docs = {doc_id: doc for write in self.sink.writes for doc_id, doc in write.items()}
+        self.assertEqual(sorted(docs, key=int), [str(nr) for nr in range(50)])
+        self.assertEqual(docs["3"]["entities"][0]["end"], 50)
+
+    def test_writes_in_chunks(self):
+        self.pipeline.run(get_data())
+        self.assertEqual(len(self.sink.writes), 5)
+
+    def test_reports_stats(self):
+        stats = self.pipeline.run(get_data())
+        for stage in ("retrieve", "annotate", "write"):
+            self.assertEqual(stats["stages"][stage]["docs"], 50)
+        self.assertLessEqual(stats["max_queue_depth"], self.pipeline.prefetch_batches)
+
+    def test_skips_failed_docs(self):
+        data = [("0", "text"), ("1", "fail"), ("2", "text")]
+        stats = self.pipeline.run(data)
+        self.assertEqual(sorted(self.sink.writes[0]), ["0", "2"])
+        self.assertEqual(stats["failed"], 1)
+
+    def test_retrieval_is_bounded(self):
+        consumed: list = []
+        started = threading.Event()
+
+        class BlockingSink(ListSink):
+            def write(self, docs):
+                started.set()
+                raise RuntimeError("Sink failed")
+
+        self.pipeline.sink = BlockingSink()
+        with self.assertRaises(RuntimeError):
+            self.pipeline.run(get_data(10000, consumed))
+        self.assertTrue(started.is_set())
+        self.assertLess(len(consumed), 1000)
+
+    def test_raises_retrieval_errors(self):
+        def _failing_data():
+            yield "0", "text"
+            raise ConnectionError("Lost connection")
+
+        with self.assertRaises(ConnectionError):
+            self.pipeline.run(_failing_data())
+
+    def test_skips_and_records_completed_docs(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ledger = completion_ledger.CompletionLedger(os.path.join(temp_dir, "ledger.sqlite"))
+            ledger.mark_done([str(nr) for nr in range(20)])
+            self.pipeline.ledger = ledger
+            self.pipeline.run(get_data())
+            docs = {doc_id for write in self.sink.writes for doc_id in write}
+            self.assertEqual(sorted(docs, key=int), [str(nr) for nr in range(20, 50)])
+            self.assertEqual(len(ledger), 50)
+            ledger.close()
+
+    def test_does_not_record_docs_that_failed_to_write(self):
+        class FailingSink(ListSink):
+            def write(self, docs):
+                super().write(docs)
+                raise annotation_sinks.AnnotationWriteError({"3", "7"}, [{}, {}])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ledger = completion_ledger.CompletionLedger(os.path.join(temp_dir, "ledger.sqlite"))
+            self.pipeline.sink = FailingSink()
+            self.pipeline.ledger = ledger
+            stats = self.pipeline.run(get_data())
+            self.assertEqual(len(ledger), 48)
+            self.assertNotIn("3", ledger)
+            self.assertNotIn("7", ledger)
+            self.assertEqual(stats['failed'], 2 * len(self.pipeline.sink.writes))
+            ledger.close()
+
+    def test_merges_split_docs(self):
+        text = "\n".join(f"line {nr} needle" for nr in range(100))
+        pipeline = annotation_pipeline.AnnotationPipeline(NeedleCAT(), self.sink, nproc=2, batch_size_chars=1000,
+                                                          max_doc_chars=200)
+        stats = pipeline.run([("short", "a needle"), ("long", text)])
+        docs = {doc_id: doc for write in self.sink.writes for doc_id, doc in write.items()}
+        self.assertEqual(sorted(docs), ["long", "short"])
+        entities = docs["long"]["entities"]
+        self.assertEqual(len(entities), 100)
+        for ent_id, entity in entities.items():
+            self.assertEqual(entity["id"], ent_id)
+            self.assertEqual(text[entity["start"]:entity["end"]], "needle")
+        self.assertEqual(stats["stages"]["annotate"]["docs"], 2)
+
+
+class WorkerProcessTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.sink = ListSink()
+
+    def test_starts_workers_before_retrieval(self):
+        children = []
+
+        def _data():
+            children.append(len(multiprocessing.active_children()))
+            yield from get_data()
+
+        pipeline = annotation_pipeline.AnnotationPipeline(FakeCAT(), self.sink, nproc=2, batch_size_chars=100)
+        pipeline.run(_data())
+        self.assertGreaterEqual(children[0], 2)
+
+    def test_runs_nn_components_in_main_process(self):
+        cat = NNCAT()
+        text = "\n".join(f"line {nr} needle" for nr in range(100))
+        data = [("short", "a needle"), ("long", text)] + [(str(nr), "needle " * 10) for nr in range(20)]
+        pipeline = annotation_pipeline.AnnotationPipeline(cat, self.sink, nproc=2, batch_size_chars=200,
+                                                          chunk_size_chars=500)
+        pipeline.run(data)
+        docs = {doc_id: doc for write in self.sink.writes for doc_id, doc in write.items()}
+        self.assertEqual(len(docs), len(data))
+        self.assertTrue(all(doc["meta"] for doc in docs.values()))
+        self.assertFalse(any(doc.get("nn_in_worker") for doc in docs.values()))
+        self.assertEqual(cat.nn_texts, dict(data))
+        self.assertTrue(cat.nn_enabled)
+
+    def test_can_run_nn_components_in_workers(self):
+        cat = NNCAT()
+        pipeline = annotation_pipeline.AnnotationPipeline(cat, self.sink, nproc=2, batch_size_chars=100,
+                                                          separate_nn_components=False)
+        pipeline.run([("doc", "a needle")])
+        self.assertTrue(self.sink.writes[0]["doc"]["nn_in_worker"])
+        self.assertEqual(cat.nn_texts, {})
+
+
+class FakeNLP:
+    """A spaCy-like pipeline of a tokenizer and a list of components."""
+
+    def __init__(self):
+        self.tokenizer = str.split
+        self._components = [("ner", lambda doc: doc), ("linker", lambda doc: doc)]
+
+    def __call__(self, text):
+        doc = self.tokenizer(text)
+        for _, component in self._components:
+            doc = component(doc)
+        return doc
+
+
+class FakePipe:
+
+    def __init__(self):
+        self._nlp = FakeNLP()
+
+
+class PipeCAT(FakeCAT):
+
+    def __init__(self):
+        self.pipe = FakePipe()
+
+    def get_entities(self, text, only_cui=False, addl_info=[]):
+        self.pipe._nlp(text)
+        return super().get_entities(text, only_cui=only_cui, addl_info=addl_info)
+
+
+class InstrumentationTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.metrics_path = os.path.join(self._temp_dir.name, "metrics.jsonl")
+        self.sink = ListSink()
+
+    def tearDown(self) -> None:
+        self._temp_dir.cleanup()
+
+    def _read_metrics(self) -> list:
+        with open(self.metrics_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_writes_stats(self):
+        pipeline = annotation_pipeline.AnnotationPipeline(FakeCAT(), self.sink, nproc=2, batch_size_chars=100,
+                                                          metrics_path=self.metrics_path)
+        pipeline.run(get_data())
+        stats = self._read_metrics()[-1]
+        self.assertEqual(stats["event"], "stats")
+        self.assertEqual(stats["entities"], 50)
+        self.assertEqual(stats["stages"]["annotate"]["chars"], 2500)
+        self.assertGreater(stats["worker_utilisation"], 0)
+        self.assertIn("chars/s", stats["stages"]["retrieve"])
+        self.assertIsNotNone(stats["max_rss_mb"]["worker"])
+
+    def test_times_components(self):
+        pipeline = annotation_pipeline.AnnotationPipeline(PipeCAT(), self.sink, nproc=2, batch_size_chars=100)
+        stats = pipeline.run(get_data())
+        self.assertEqual(sorted(stats["components"]), ["linker", "ner", "tokenizer"])
+
+    def test_profiles_sampled_batches(self):
+        pipeline = annotation_pipeline.AnnotationPipeline(FakeCAT(), self.sink, nproc=2, batch_size_chars=100,
+                                                          metrics_path=self.metrics_path, profile_every=10)
+        pipeline.run(get_data())
+        profiles = [metrics for metrics in self._read_metrics() if metrics["event"] == "profile"]
+        self.assertEqual(len(profiles), 3)
+        self.assertIn("get_entities", profiles[0]["profile"])
+
+
+class LengthAwareBatchesTests(unittest.TestCase):
+
+    def test_balances_batches(self):
+        lengths = [1000, 10, 10, 10, 500, 500, 10, 10, 10, 10, 10, 10]
+        data = [(str(nr), "x" * length) for nr, length in enumerate(lengths)]
+        batches = list(annotation_pipeline.length_aware_batches(data, batch_size_chars=1000, window_chars=3000,
+                                                                max_doc_chars=1000))
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(sorted(sum(len(text) for _, text in batch) for batch in batches), [1040, 1050])
+        self.assertEqual(sorted(doc_id for batch in batches for doc_id, _ in batch),
+                         sorted(doc_id for doc_id, _ in data))
+
+    def test_packs_per_window(self):
+        data = [(str(nr), "x" * 100) for nr in range(25)]
+        batches = list(annotation_pipeline.length_aware_batches(data, batch_size_chars=500, window_chars=1000))
+        self.assertEqual([len(batch) for batch in batches], [5, 5, 5, 5, 5])
+
+    def test_splits_long_docs(self):
+        text = " ".join(["word"] * 100)
+        batches = list(annotation_pipeline.length_aware_batches([("doc", text)], batch_size_chars=100,
+                                                                window_chars=1000, max_doc_chars=100))
+        pieces = sorted((key for batch in batches for key, _ in batch), key=lambda piece: piece.offset)
+        self.assertEqual(len(batches), 5)
+        self.assertEqual([piece.nr for piece in pieces], list(range(len(pieces))))
+        texts = {key: piece_text for batch in batches for key, piece_text in batch}
+        self.assertEqual("".join(texts[piece] for piece in pieces), text)
+        for piece in pieces:
+            self.assertLessEqual(len(texts[piece]), 100)
+            self.assertEqual(text[piece.offset:piece.offset + len(texts[piece])], texts[piece])
+            self.assertTrue(texts[piece].endswith(" ") or piece.nr == len(pieces) - 1)
+
+
+class PickleAnnotationSinkTests(unittest.TestCase):
+
+    def test_saves_parts_like_medcat(self):
+        with tempfile.TemporaryDirectory() as save_dir:
+            sink = annotation_sinks.PickleAnnotationSink(save_dir)
+            sink.write({"doc1": {"entities": {}}})
+            sink.write({"doc2": {"entities": {}}})
+            with open(os.path.join(save_dir, "part_1.pickle"), "rb") as f:
+                self.assertEqual(pickle.load(f), {"doc2": {"entities": {}}})
+            with open(os.path.join(save_dir, "annotated_ids.pickle"), "rb") as f:
+                self.assertEqual(pickle.load(f), (["doc1", "doc2"], 2))
+
+    def test_continues_previous_parts(self):
+        with tempfile.TemporaryDirectory() as save_dir:
+            annotation_sinks.PickleAnnotationSink(save_dir).write({"doc1": {"entities": {}}})
+            sink = annotation_sinks.PickleAnnotationSink(save_dir)
+            self.assertEqual(sink.annotated_ids, ["doc1"])
+            sink.write({"doc2": {"entities": {}}})
+            self.assertTrue(os.path.exists(os.path.join(save_dir, "part_1.pickle")))
+
@@ -0,0 +1,204 @@
+import os
+import sys
+import tempfile
+
+import unittest
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+_FILE_DIR = os.path.dirname(__file__)
+
+# because this project isn't (at least of of writing this)
+# set up as a python project, there are no __init__.py
+# files in each folder
+# as such, in order to gain access to the relevant module,
+# I'll need to add the path manually
+_WWC_BASE_FOLDER = os.path.join(_FILE_DIR, "..", "..", "..")
+MEDCAT_RUN_MODEL_FOLDER = os.path.abspath(os.path.join(_WWC_BASE_FOLDER, "medcat", "3_run_model"))
+sys.path.append(MEDCAT_RUN_MODEL_FOLDER)
+# and the base folder for cogstack
+sys.path.append(os.path.abspath(_WWC_BASE_FOLDER))
+# now we are able to import annotation_sinks
+
+import annotation_sinks
+import completion_ledger
+
+
+DOCS = {
+    "doc1": {"entities": {0: {"cui": "C1", "start": 0, "end": 4},
+                          1: {"cui": "C2", "start": 10, "end": 14}}},
+    "doc2": {"entities": {0: {"cui": "C1", "start": 5, "end": 9}}},
+}
+
+
+class FakeElastic:
+
+    def __init__(self):
+        self.deleted = []
+
+    def delete_by_query(self, index, query, **kwargs):
+        self.deleted.append(query)
+
+
+class FakeCogStack:
+
+    def __init__(self):
+        self.actions = []
+        self.elastic = FakeElastic()
+
+        self.rejected_ids = set()
+
+    def bulk_index(self, actions, **kwargs):
+        actions = list(actions)
+        self.actions.extend(actions)
+        errors = [{'index': {'_index': action['_index'], '_id': action['_id'], 'status': 400}}
+                  for action in actions if action['_id'] in self.rejected_ids]
+        return {'indexed': len(actions) - len(errors), 'failed': len(errors), 'retried': 0, 'elapsed': 1.0,
+                'errors': errors}
+
+
+class AnnotationActionsTests(unittest.TestCase):
+
+    def test_one_action_per_entity(self):
+        actions = list(annotation_sinks.annotation_actions(DOCS, "annotations"))
+        self.assertEqual(len(actions), 3)
+
+    def test_ids_are_unique(self):
+        actions = list(annotation_sinks.annotation_actions(DOCS, "annotations"))
+        self.assertEqual(len({action["_id"] for action in actions}), len(actions))
+
+    def test_keeps_doc_id(self):
+        for action in annotation_sinks.annotation_actions(DOCS, "annotations"):
+            with self.subTest(action["_id"]):
+                self.assertTrue(action["_id"].startswith(action["_source"]["doc_id"]))
+                self.assertEqual(action["_index"], "annotations")
+
+    def test_only_cui(self):
+        docs = {"doc1": {"entities": {0: "C1"}}}
+        action, = annotation_sinks.annotation_actions(docs, "annotations")
+        self.assertEqual(action["_source"], {"cui": "C1", "doc_id": "doc1"})
+
+
+class ElasticAnnotationSinkTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.cs = FakeCogStack()
+        self.sink = annotation_sinks.ElasticAnnotationSink(self.cs, "annotations")
+
+    def test_writes_all(self):
+        self.sink.write(DOCS)
+        self.assertEqual(len(self.cs.actions), 3)
+
+    def test_keeps_totals(self):
+        self.sink.write(DOCS)
+        self.sink.write(DOCS)
+        self.assertEqual(self.sink.totals['docs'], 2 * len(DOCS))
+        self.assertEqual(self.sink.totals['indexed'], 6)
+        self.assertIn("6 annotations", self.sink.report())
+
+    def test_raises_failed_docs(self):
+        self.cs.rejected_ids = {"doc1_1"}
+        with self.assertRaises(annotation_sinks.AnnotationWriteError) as context:
+            self.sink.write(DOCS)
+        self.assertEqual(context.exception.doc_ids, {"doc1"})
+        self.assertEqual(self.sink.totals['failed'], 1)
+
+    def test_all_docs_failed_if_not_traceable(self):
+        self.cs.bulk_index = lambda actions, **kwargs: {'indexed': 0, 'failed': 1, 'retried': 0, 'elapsed': 1.0,
+                                                        'errors': [{'index': {'error': 'Timeout'}}]}
+        with self.assertRaises(annotation_sinks.AnnotationWriteError) as context:
+            self.sink.write(DOCS)
+        self.assertEqual(context.exception.doc_ids, {"doc1", "doc2"})
+
+    def test_does_not_delete_by_default(self):
+        self.sink.write(DOCS)
+        self.assertEqual(self.cs.elastic.deleted, [])
+
+    def test_replaces_existing(self):
+        self.sink.replace_existing = True
+        self.sink.write(DOCS)
+        self.assertEqual(self.cs.elastic.deleted, [{"terms": {"doc_id.keyword": ["doc1", "doc2"]}}])
+        self.assertEqual(len(self.cs.actions), 3)
+
+    def test_replaces_existing_in_chunks(self):
+        self.sink.replace_existing = True
+        self.sink.max_terms_count = 2
+        docs = {f"doc{nr}": {"entities": {}} for nr in range(5)}
+        self.sink.write(docs)
+        self.assertEqual([query["terms"]["doc_id.keyword"] for query in self.cs.elastic.deleted],
+                         [["doc0", "doc1"], ["doc2", "doc3"], ["doc4"]])
+
+
+class LoadAnnotationsTests(unittest.TestCase):
+
+    def test_latest_part_wins(self):
+        with tempfile.TemporaryDirectory() as save_dir:
+            sink = annotation_sinks.PickleAnnotationSink(save_dir)
+            for nr in range(11):
+                sink.write({"doc1": {"entities": {}, "part": nr}, f"doc{nr + 2}": {"entities": {}}})
+            docs = annotation_sinks.load_annotations(save_dir)
+        self.assertEqual(len(docs), 12)
+        self.assertEqual(docs["doc1"]["part"], 10)
+
+
+class ParquetAnnotationSinkTests(unittest.TestCase):
+    docs = {
+        "doc1": {"entities": {
+            0: {"cui": "C1", "start": 0, "end": 4, "acc": 0.9, "context_similarity": 0.8,
+                "meta_anns": {"Presence": {"value": "True", "confidence": 0.99, "name": "Presence"}}},
+            1: {"cui": "C2", "start": 10, "end": 14, "acc": 0.5, "context_similarity": 0.4, "meta_anns": {}}}},
+        "doc2": {"entities": {0: {"cui": "C1", "start": 5, "end": 9, "acc": 1.0, "context_similarity": 1.0,
+                                  "meta_anns": {"Presence": {"value": "False", "confidence": 0.7,
+                                                             "name": "Presence"}}}}},
+    }
+
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.save_dir = self._temp_dir.name
+        self.sink = annotation_sinks.ParquetAnnotationSink(self.save_dir)
+
+    def tearDown(self) -> None:
+        self._temp_dir.cleanup()
+
+    def test_one_row_per_entity(self):
+        self.sink.write(self.docs)
+        df = pd.read_parquet(self.sink.dataset_path)
+        self.assertEqual(len(df), 3)
+        self.assertEqual(list(df["doc_id"]), ["doc1", "doc1", "doc2"])
+        self.assertEqual(list(df["meta_Presence"].isna()), [False, True, False])
+        self.assertEqual(df["meta_Presence"][2], "False")
+
+    def test_dictionary_encodes_cuis(self):
+        self.sink.write(self.docs)
+        schema = pq.read_schema(os.path.join(self.sink.dataset_path, "part=0", "annotations.parquet"))
+        self.assertTrue(pa.types.is_dictionary(schema.field("cui").type))
+
+    def test_partitioned_by_part(self):
+        self.assertEqual(self.sink.write(self.docs), 0)
+        self.assertEqual(self.sink.write({"doc3": {"entities": {0: "C3"}}}), 1)
+        df = pd.read_parquet(self.sink.dataset_path, columns=["doc_id", "cui", "part"])
+        self.assertEqual(list(df.columns), ["doc_id", "cui", "part"])
+        self.assertEqual(list(df[df["doc_id"] == "doc3"]["part"].astype(int)), [1])
+
+    def test_continues_previous_parts(self):
+        self.sink.write(self.docs)
+        sink = annotation_sinks.ParquetAnnotationSink(self.save_dir)
+        self.assertEqual(sink.write(self.docs), 1)
+
+    def test_reads_next_to_ledger(self):
+        # as laid out by run_model
+        ledger = completion_ledger.CompletionLedger(os.path.join(self.save_dir, "completed_docs.sqlite"))
+        ledger.mark_done(self.docs, self.sink.write(self.docs))
+        df = pd.read_parquet(os.path.join(self.save_dir, "annotations"), columns=["doc_id", "cui"])
+        ledger.close()
+        self.assertEqual(len(df), 3)
+
+    def test_loads_latest_part(self):
+        self.sink.write(self.docs)
+        self.sink.write({"doc1": {"entities": {0: {"cui": "C3", "start": 0, "end": 4}}}})
+        df = annotation_sinks.load_parquet_annotations(self.save_dir, columns=["doc_id", "cui"])
+        self.assertEqual(list(df.columns), ["doc_id", "cui"])
+        self.assertEqual(sorted(zip(df["doc_id"], df["cui"])), [("doc1", "C3"), ("doc2", "C1")])
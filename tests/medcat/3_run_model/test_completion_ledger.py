@@ -0,0 +1,77 @@
+import os
+import sys
+import tempfile
+import time
+
+import unittest
+
+
+_FILE_DIR = os.path.dirname(__file__)
+
+# because this project isn't (at least of of writing this)
+# set up as a python project, there are no __init__.py
+# files in each folder
+# as such, in order to gain access to the relevant module,
+# I'll need to add the path manually
+_WWC_BASE_FOLDER = os.path.join(_FILE_DIR, "..", "..", "..")
+MEDCAT_RUN_MODEL_FOLDER = os.path.abspath(os.path.join(_WWC_BASE_FOLDER, "medcat", "3_run_model"))
+sys.path.append(MEDCAT_RUN_MODEL_FOLDER)
+# now we are able to import completion_ledger
+
+import completion_ledger
+
+
+class CompletionLedgerTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._temp_dir.name, "ledger.sqlite")
+        self.ledger = completion_ledger.CompletionLedger(self.path)
+
+    def tearDown(self) -> None:
+        self.ledger.close()
+        self._temp_dir.cleanup()
+
+    def test_marks_done(self):
+        self.ledger.mark_done(["doc1", "doc2"], part=0)
+        self.assertIn("doc1", self.ledger)
+        self.assertNotIn("doc3", self.ledger)
+        self.assertEqual(len(self.ledger), 2)
+
+    def test_keeps_parts(self):
+        self.ledger.mark_done(["doc1", "doc2"], part=0)
+        self.ledger.mark_done(["doc3"], part=1)
+        self.assertEqual(self.ledger.parts(), {0: 2, 1: 1})
+
+    def test_persists(self):
+        self.ledger.mark_done(["doc1"])
+        self.ledger.close()
+        self.ledger = completion_ledger.CompletionLedger(self.path)
+        self.assertEqual(self.ledger.done_ids(), ["doc1"])
+
+    def test_only_since(self):
+        self.ledger.mark_done(["doc1", "doc2"], part=0)
+        self.ledger.since = time.time() + 1
+        self.assertNotIn("doc1", self.ledger)
+        self.assertEqual(len(self.ledger), 0)
+        self.ledger.since = time.time() - 1
+        self.assertEqual(sorted(self.ledger.done_ids()), ["doc1", "doc2"])
+
+    def test_filters_done(self):
+        self.ledger.mark_done(["doc1", "doc3"])
+        data = [(f"doc{nr}", "text") for nr in range(5)]
+        self.assertEqual([doc_id for doc_id, _ in self.ledger.filter(data)], ["doc0", "doc2", "doc4"])
+
+    def test_excludes_done_on_server(self):
+        query = {"query": {"match": {"body": "x"}}, "_source": ["body"]}
+        self.assertEqual(self.ledger.exclude_done(query), query)
+        self.ledger.mark_done(["doc1"])
+        excluded = self.ledger.exclude_done(query)
+        self.assertEqual(excluded["_source"], ["body"])
+        self.assertEqual(excluded["query"]["bool"]["must"], [query["query"]])
+        self.assertEqual(excluded["query"]["bool"]["must_not"], [{"terms": {"_id": ["doc1"]}}])
+
+    def test_too_many_to_exclude_on_server(self):
+        query = {"query": {"match_all": {}}}
+        self.ledger.mark_done(["doc1", "doc2"])
+        self.assertEqual(self.ledger.exclude_done(query, max_ids=1), query)
@@ -0,0 +1,81 @@
+import os
+import sys
+import tempfile
+
+import unittest
+
+
+_FILE_DIR = os.path.dirname(__file__)
+
+# because this project isn't (at least of of writing this)
+# set up as a python project, there are no __init__.py
+# files in each folder
+# as such, in order to gain access to the relevant module,
+# I'll need to add the path manually
+_WWC_BASE_FOLDER = os.path.join(_FILE_DIR, "..", "..", "..")
+MEDCAT_RUN_MODEL_FOLDER = os.path.abspath(os.path.join(_WWC_BASE_FOLDER, "medcat", "3_run_model"))
+sys.path.append(MEDCAT_RUN_MODEL_FOLDER)
+# now we are able to import incremental
+
+import incremental
+import completion_ledger
+
+
+class HighWaterMarksTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._temp_dir.name, "state.sqlite")
+        self.marks = incremental.HighWaterMarks(self.path)
+
+    def tearDown(self) -> None:
+        self.marks.close()
+        self._temp_dir.cleanup()
+
+    def test_first_run_from_beginning(self):
+        after, up_to, _ = self.marks.start("idx", "model1", "updated", "2024-01-01")
+        self.assertIsNone(after)
+        self.assertEqual(up_to, "2024-01-01")
+        self.assertIsNone(self.marks.get("idx", "model1", "updated"))
+
+    def test_finished_run_sets_mark(self):
+        self.marks.start("idx", "model1", "updated", "2024-01-01")
+        self.marks.finish("idx", "model1", "updated")
+        self.assertEqual(self.marks.get("idx", "model1", "updated"), "2024-01-01")
+        after, up_to, _ = self.marks.start("idx", "model1", "updated", "2024-02-01")
+        self.assertEqual((after, up_to), ("2024-01-01", "2024-02-01"))
+
+    def test_resumes_interrupted_run(self):
+        _, _, since = self.marks.start("idx", "model1", "updated", "2024-01-01")
+        self.marks.close()
+        self.marks = incremental.HighWaterMarks(self.path)
+        after, up_to, resumed_since = self.marks.start("idx", "model1", "updated", "2024-02-01")
+        self.assertEqual((after, up_to, resumed_since), (None, "2024-01-01", since))
+
+    def test_mark_per_model_and_index(self):
+        self.marks.start("idx", "model1", "updated", "2024-01-01")
+        self.marks.finish("idx", "model1", "updated")
+        self.assertIsNone(self.marks.start("idx", "model2", "updated", "2024-01-01")[0])
+        self.assertIsNone(self.marks.start("idx2", "model1", "updated", "2024-01-01")[0])
+
+    def test_shares_file_with_ledger(self):
+        ledger = completion_ledger.CompletionLedger(self.path)
+        ledger.mark_done(["doc1"])
+        self.marks.start("idx", "model1", "updated", "2024-01-01")
+        self.assertEqual(len(ledger), 1)
+        ledger.close()
+
+
+class IncrementalQueryTests(unittest.TestCase):
+    query = {"query": {"match": {"body": "x"}}, "_source": ["body"]}
+
+    def test_from_beginning(self):
+        query = incremental.incremental_query(self.query, "updated", None, "2024-01-01")
+        self.assertEqual(query["query"]["bool"]["filter"], [{"range": {"updated": {"lte": "2024-01-01"}}}])
+
+    def test_after_mark(self):
+        query = incremental.incremental_query(self.query, "updated", "2023-01-01", "2024-01-01")
+        self.assertEqual(query["query"]["bool"]["must"], [self.query["query"]])
+        self.assertEqual(query["query"]["bool"]["filter"],
+                         [{"range": {"updated": {"gt": "2023-01-01", "lte": "2024-01-01"}}}])
+        self.assertEqual(query["_source"], ["body"])
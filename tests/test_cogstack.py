@@ -0,0 +1,779 @@
+import unittest
+import asyncio
+from unittest.mock import patch, MagicMock
+import tempfile
+import json
+import os
+import time
+
+import pandas as pd
+import pyarrow.parquet as pq
+import elasticsearch
+
+import cogstack
+
+
+class FakeElastic:
+    """An in-memory stand-in for the parts of the Elasticsearch client
+    that are used by the retrieval methods."""
+
+    def __init__(self, nr_of_docs: int = 100):
+        self.docs = [{"_index": "idx", "_id": str(i), "_score": 1.0,
+                      "_source": {"body_analysed": f"text {i}", "num": i}}
+                     for i in range(nr_of_docs)]
+        self._scrolls: dict = {}
+        self.cleared_scrolls: list = []
+        self.open_pits: set = set()
+        self.pits_opened = 0
+        self.fail_next = 0
+        self.timeout_next = 0
+        self.page_sizes: list = []
+        self.count_requests = 0
+        self.msearch_requests = 0
+        self.msearch_bodies: list = []
+        self.scroll_searches: list = []
+        self.cluster_uuid = "cluster-1"
+
+    def options(self, **kwargs):
+        return self
+
+    def info(self, **kwargs):
+        return {"cluster_name": "test", "cluster_uuid": self.cluster_uuid}
+
+    def _get_docs(self, kwargs: dict) -> list:
+        docs = self.docs
+        if "slice" in kwargs:
+            slice_id, slices = kwargs["slice"]["id"], kwargs["slice"]["max"]
+            if slices <= 1:
+                raise ValueError("max must be greater than 1")
+            docs = [doc for nr, doc in enumerate(docs) if nr % slices == slice_id]
+        return docs
+
+    def _scroll_resp(self, scroll_id: str) -> dict:
+        docs, size = self._scrolls[scroll_id]
+        self._scrolls[scroll_id] = (docs[size:], size)
+        return {"_scroll_id": scroll_id,
+                "_shards": {"successful": 1, "skipped": 0, "total": 1},
+                "hits": {"total": {"value": len(docs)}, "hits": docs[:size]}}
+
+    def open_point_in_time(self, index, keep_alive: str, **kwargs):
+        pit_id = f"pit{self.pits_opened}"
+        self.pits_opened += 1
+        self.open_pits.add(pit_id)
+        return {"id": pit_id}
+
+    def close_point_in_time(self, id: str, **kwargs):
+        self.open_pits.discard(id)
+
+    def _pit_search(self, kwargs: dict) -> dict:
+        self.page_sizes.append(kwargs["size"])
+        if self.timeout_next:
+            self.timeout_next -= 1
+            raise elasticsearch.ConnectionTimeout("Timed out")
+        if self.fail_next:
+            self.fail_next -= 1
+            raise elasticsearch.ConnectionError("Connection failed")
+        after = kwargs.get("search_after", [-1])[0]
+        docs = [dict(doc, sort=[doc["_source"]["num"]]) for doc in self._get_docs(kwargs)
+                if doc["_source"]["num"] > after]
+        return {"pit_id": kwargs["pit"]["id"], "hits": {"hits": docs[:kwargs["size"]]}}
+
+    def search(self, **kwargs):
+        if "pit" in kwargs:
+            return self._pit_search(kwargs)
+        self.scroll_searches.append(kwargs)
+        scroll_id = f"scroll{len(self._scrolls)}"
+        self._scrolls[scroll_id] = (self._get_docs(kwargs), kwargs["size"])
+        return self._scroll_resp(scroll_id)
+
+    def scroll(self, scroll_id: str, **kwargs):
+        return self._scroll_resp(scroll_id)
+
+    def clear_scroll(self, scroll_id: str, **kwargs):
+        self.cleared_scrolls.append(scroll_id)
+
+    def msearch(self, searches: list, **kwargs):
+        self.msearch_requests += 1
+        self.msearch_bodies.extend(searches[1::2])
+        responses = []
+        for header, body in zip(searches[::2], searches[1::2]):
+            terms = body.get("query", {}).get("terms", {}).get("num")
+            if terms is None:
+                responses.append({"error": {"type": "parsing_exception"}})
+                continue
+            hits = [doc for doc in self.docs if doc["_source"]["num"] in terms]
+            responses.append({"hits": {"total": {"value": len(hits), "relation": "eq"},
+                                       "hits": hits[:body.get("size", 10)]}})
+        return {"responses": responses}
+
+    def count(self, **kwargs):
+        self.count_requests += 1
+        return {"count": len(self.docs)}
+
+
+class CogStackTestBase(unittest.TestCase):
+    nr_of_docs = 100
+    query = {"query": {"match_all": {}}}
+
+    def setUp(self) -> None:
+        self.cs = cogstack.CogStack(hosts=["http://localhost:9200"], username="user", password="pass")
+        self.cs.elastic = FakeElastic(self.nr_of_docs)  # type: ignore
+
+
+class SharedClientTests(unittest.TestCase):
+    hosts = ["http://localhost:9200"]
+
+    def tearDown(self) -> None:
+        cogstack.close_shared_clients()
+
+    def test_reuses_client(self):
+        cs1 = cogstack.CogStack(hosts=self.hosts, username="user", password="pass")
+        cs2 = cogstack.CogStack(hosts=self.hosts, username="user", password="pass")
+        self.assertIs(cs1.elastic, cs2.elastic)
+
+    def test_different_credentials_different_client(self):
+        cs1 = cogstack.CogStack(hosts=self.hosts, username="user", password="pass")
+        cs2 = cogstack.CogStack(hosts=self.hosts, username="user2", password="pass")
+        self.assertIsNot(cs1.elastic, cs2.elastic)
+
+    def test_different_settings_different_client(self):
+        cs1 = cogstack.CogStack(hosts=self.hosts, username="user", password="pass")
+        cs2 = cogstack.CogStack(hosts=self.hosts, username="user", password="pass", http_compress=True)
+        self.assertIsNot(cs1.elastic, cs2.elastic)
+
+    def test_can_use_own_client(self):
+        cs1 = cogstack.CogStack(hosts=self.hosts, username="user", password="pass")
+        cs2 = cogstack.CogStack(hosts=self.hosts, username="user", password="pass", reuse_client=False)
+        self.assertIsNot(cs1.elastic, cs2.elastic)
+
+    def test_applies_pool_size(self, connections_per_node: int = 25):
+        cs = cogstack.CogStack(hosts=self.hosts, username="user", password="pass",
+                               connections_per_node=connections_per_node, reuse_client=False)
+        node, = cs.elastic.transport.node_pool.all()
+        self.assertEqual(node.config.connections_per_node, connections_per_node)
+
+
+class SlicedDocsGeneratorTests(CogStackTestBase):
+    slices = 4
+
+    def test_unsliced_gets_all_docs(self):
+        docs = list(self.cs.get_docs_generator(index=["idx"], query=self.query, es_gen_size=7))
+        self.assertEqual(len(docs), self.nr_of_docs)
+
+    def test_sliced_gets_all_docs(self):
+        docs = list(self.cs.get_docs_generator(index=["idx"], query=self.query, es_gen_size=7,
+                                               slices=self.slices))
+        self.assertEqual(len(docs), self.nr_of_docs)
+        self.assertEqual({doc["_id"] for doc in docs}, {doc["_id"] for doc in self.cs.elastic.docs})
+
+    def test_sliced_does_not_change_query(self):
+        list(self.cs.get_docs_generator(index=["idx"], query=self.query, slices=self.slices))
+        self.assertNotIn("slice", self.query)
+
+    def test_sliced_clears_scrolls_when_stopped_early(self):
+        gen = self.cs.get_docs_generator(index=["idx"], query=self.query, es_gen_size=5,
+                                         slices=self.slices, max_buffered_pages=1)
+        next(gen)
+        gen.close()
+        self.assertEqual(len(self.cs.elastic.cleared_scrolls), self.slices)
+
+
+class ColumnarCogStack2DFTests(CogStackTestBase):
+
+    def test_same_as_row_based(self):
+        expected = self.cs.cogstack2df(self.query, "idx", show_progress=False)
+        got = self.cs.cogstack2df(self.query, "idx", show_progress=False, columnar=True, chunk_size=7)
+        pd.testing.assert_frame_equal(got, expected)
+
+    def test_same_as_row_based_with_headers(self):
+        headers = ["num", "missing"]
+        expected = self.cs.cogstack2df(self.query, "idx", column_headers=headers, show_progress=False)
+        got = self.cs.cogstack2df(self.query, "idx", column_headers=headers, show_progress=False,
+                                  columnar=True, chunk_size=7)
+        self.assertEqual(list(got.columns), list(expected.columns))
+        pd.testing.assert_frame_equal(got[["_id", "num"]], expected[["_id", "num"]])
+
+    def test_spills_to_disk(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            got = self.cs.cogstack2df(self.query, "idx", show_progress=False, columnar=True, chunk_size=10,
+                                      memory_budget_mb=0, spill_dir=spill_dir)
+            self.assertEqual(len(os.listdir(spill_dir)), self.nr_of_docs // 10)
+        self.assertEqual(len(got), self.nr_of_docs)
+        self.assertEqual(list(got["num"]), list(range(self.nr_of_docs)))
+
+    def test_spills_mixed_types(self):
+        for doc in self.cs.elastic.docs:
+            num = doc["_source"]["num"]
+            doc["_source"]["mixed"] = str(num) if num % 2 else num
+        expected = self.cs.cogstack2df(self.query, "idx", show_progress=False)
+        with tempfile.TemporaryDirectory() as spill_dir:
+            got = self.cs.cogstack2df(self.query, "idx", show_progress=False, columnar=True, chunk_size=10,
+                                      memory_budget_mb=0, spill_dir=spill_dir)
+            self.assertEqual(len(os.listdir(spill_dir)), self.nr_of_docs // 10)
+        self.assertEqual(list(got.columns), list(expected.columns))
+        self.assertEqual(list(got["mixed"]), list(expected["mixed"]))
+        self.assertEqual(list(got["num"]), list(range(self.nr_of_docs)))
+
+
+class CogStack2DFProgressTests(CogStackTestBase):
+
+    def test_does_not_count_by_default(self):
+        df = self.cs.cogstack2df(self.query, "idx", show_progress=False)
+        self.assertEqual(len(df), self.nr_of_docs)
+        self.assertEqual(self.cs.elastic.count_requests, 0)
+
+    def test_can_count(self):
+        self.cs.cogstack2df(self.query, "idx", show_progress=False, count=True)
+        self.assertEqual(self.cs.elastic.count_requests, 1)
+
+    def test_total_from_first_response(self):
+        progress = cogstack._RetrievalProgress()
+        pages = self.cs._scroll_pages(["idx"], self.query, es_gen_size=7, request_timeout=None,
+                                      on_response=progress.update)
+        next(pages)
+        self.assertEqual(progress.total, self.nr_of_docs)
+        pages.close()
+
+    def test_clears_scroll(self):
+        list(self.cs._scroll_pages(["idx"], self.query, es_gen_size=7, request_timeout=None))
+        self.assertEqual(len(self.cs.elastic.cleared_scrolls), 1)
+
+    def test_scrolls_in_doc_order(self):
+        self.cs.cogstack2df(self.query, "idx", show_progress=False)
+        self.assertEqual(self.cs.elastic.scroll_searches[0]["sort"], "_doc")
+
+    def test_keeps_own_sort(self):
+        query = dict(self.query, sort=[{"num": "desc"}])
+        list(self.cs._scroll_pages(["idx"], query, es_gen_size=7, request_timeout=None))
+        self.assertEqual(self.cs.elastic.scroll_searches[0]["sort"], [{"num": "desc"}])
+
+    def test_resets_progress_bar_with_total(self):
+        progress = cogstack._RetrievalProgress()
+        progress_bar = MagicMock(total=None)
+        progress_bar.reset.side_effect = lambda total: setattr(progress_bar, "total", total)
+        pages = self.cs._scroll_pages(["idx"], self.query, es_gen_size=7, request_timeout=None,
+                                      on_response=progress.update)
+        self.assertEqual(len(list(progress.iter_hits(pages, progress_bar))), self.nr_of_docs)
+        progress_bar.reset.assert_called_once_with(total=self.nr_of_docs)
+
+
+class ResultCacheTests(CogStackTestBase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.cache = cogstack.ResultCache(self._temp_dir.name)
+
+    def tearDown(self) -> None:
+        self._temp_dir.cleanup()
+
+    def test_hit_does_not_search(self):
+        expected = self.cs.cogstack2df(self.query, "idx", show_progress=False, cache=self.cache)
+        self.cs.elastic = None  # type: ignore
+        got = self.cs.cogstack2df(self.query, "idx", show_progress=False, cache=self.cache)
+        pd.testing.assert_frame_equal(got, expected)
+
+    def test_different_cluster_miss(self):
+        self.cs.cogstack2df(self.query, "idx", show_progress=False, cache=self.cache)
+        other = cogstack.CogStack(hosts=["http://localhost:9200"], username="user", password="pass")
+        other.elastic = FakeElastic(10)  # type: ignore
+        other.elastic.cluster_uuid = "cluster-2"  # type: ignore
+        self.assertEqual(len(other.cogstack2df(self.query, "idx", show_progress=False, cache=self.cache)), 10)
+
+    def test_cluster_id_falls_back_to_hosts(self):
+        def info(**kwargs):
+            raise elasticsearch.TransportError("no monitor privilege")
+        self.cs.elastic.info = info  # type: ignore
+        self.assertIn("http://localhost:9200", self.cs.get_cluster_id())
+
+    def test_different_columns_miss(self):
+        self.cs.cogstack2df(self.query, "idx", show_progress=False, cache=self.cache)
+        self.assertIsNone(self.cache.get("idx", self.query, ["num"]))
+
+    def test_expired_miss(self):
+        self.cache.ttl = 0
+        self.cs.cogstack2df(self.query, "idx", show_progress=False, cache=self.cache)
+        time.sleep(0.01)
+        self.assertIsNone(self.cache.get("idx", self.query))
+        self.assertEqual(os.listdir(self._temp_dir.name), [])
+
+    def test_evicts_least_recently_used(self):
+        df = pd.DataFrame({"num": range(1000)})
+        self.cache.put("idx1", self.query, None, df)
+        self.cache.put("idx2", self.query, None, df)
+        self.cache.get("idx1", self.query)
+        entry_size = os.path.getsize(self.cache._get_path(self.cache.get_key("idx1", self.query)))
+        # make sure the access times differ
+        path2 = self.cache._get_path(self.cache.get_key("idx2", self.query))
+        os.utime(path2, (0, os.path.getmtime(path2)))
+        self.cache.max_size = 2.5 * entry_size
+        self.cache.put("idx3", self.query, None, df)
+        self.assertIsNotNone(self.cache.get("idx1", self.query))
+        self.assertIsNone(self.cache.get("idx2", self.query))
+        self.assertIsNotNone(self.cache.get("idx3", self.query))
+
+    def test_invalidate(self):
+        df = pd.DataFrame({"num": range(10)})
+        self.cache.put("idx1", self.query, None, df)
+        self.cache.put("idx2", self.query, None, df)
+        self.cache.invalidate("idx1", self.query)
+        self.assertIsNone(self.cache.get("idx1", self.query))
+        self.assertIsNotNone(self.cache.get("idx2", self.query))
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.get("idx2", self.query))
+
+
+class DatasetExportTests(CogStackTestBase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.output_dir = self._temp_dir.name
+
+    def tearDown(self) -> None:
+        self._temp_dir.cleanup()
+
+    def test_parquet_same_as_df(self):
+        expected = self.cs.cogstack2df(self.query, "idx", show_progress=False)
+        dataset = self.cs.cogstack2parquet(self.query, "idx", self.output_dir, show_progress=False,
+                                           row_group_size=7, rows_per_file=30)
+        pd.testing.assert_frame_equal(dataset.to_table().to_pandas(), expected)
+
+    def test_arrow_same_as_df(self):
+        expected = self.cs.cogstack2df(self.query, "idx", show_progress=False)
+        dataset = self.cs.cogstack2arrow(self.query, "idx", self.output_dir, show_progress=False,
+                                         row_group_size=7, rows_per_file=30)
+        pd.testing.assert_frame_equal(dataset.to_table().to_pandas(), expected)
+
+    def test_splits_files(self):
+        self.cs.cogstack2parquet(self.query, "idx", self.output_dir, show_progress=False,
+                                 row_group_size=10, rows_per_file=30)
+        self.assertEqual(len(os.listdir(self.output_dir)), 4)
+
+    def test_writes_row_groups(self):
+        self.cs.cogstack2parquet(self.query, "idx", self.output_dir, show_progress=False,
+                                 row_group_size=10, rows_per_file=self.nr_of_docs)
+        self.assertEqual(pq.ParquetFile(os.path.join(self.output_dir, "part-00000.parquet")).num_row_groups, 10)
+
+    def test_new_field_starts_new_file(self):
+        for doc in self.cs.elastic.docs[50:]:  # type: ignore
+            doc["_source"]["extra"] = "value"
+        dataset = self.cs.cogstack2arrow(self.query, "idx", self.output_dir, show_progress=False,
+                                         row_group_size=10)
+        self.assertEqual(len(dataset.files), 2)
+        df = dataset.to_table().to_pandas()
+        self.assertEqual(df["extra"].isna().sum(), 50)
+
+    def test_ints_then_floats_widened(self):
+        for nr, doc in enumerate(self.cs.elastic.docs[50:]):  # type: ignore
+            doc["_source"]["num"] = nr + 0.7
+        expected = self.cs.cogstack2df(self.query, "idx", show_progress=False)
+        for export in (self.cs.cogstack2parquet, self.cs.cogstack2arrow):
+            with self.subTest(export.__name__):
+                output_dir = os.path.join(self.output_dir, export.__name__)
+                dataset = export(self.query, "idx", output_dir, show_progress=False, row_group_size=10)
+                self.assertEqual(len(dataset.files), 2)
+                df = dataset.to_table().to_pandas()
+                self.assertEqual(df["num"].tolist(), expected["num"].astype(float).tolist())
+                self.assertEqual(df["num"].iloc[-1], 49.7)
+
+    def test_incompatible_types_fail(self):
+        self.cs.elastic.docs[50]["_source"]["num"] = "fifty"  # type: ignore
+        with self.assertRaises(ValueError):
+            self.cs.cogstack2parquet(self.query, "idx", self.output_dir, show_progress=False, row_group_size=10)
+
+
+class MultiSearchTests(CogStackTestBase):
+
+    def test_results_keyed_per_query(self):
+        queries = {f"patient{i}": {"query": {"terms": {"num": [i, i + 50]}}} for i in range(10)}
+        results = self.cs.multi_search("idx", queries, chunk_size=3, show_progress=False)
+        self.assertEqual(list(results), list(queries))
+        self.assertEqual(list(results["patient4"]["num"]), [4, 54])
+        self.assertEqual(self.cs.elastic.msearch_requests, 4)  # type: ignore
+
+    def test_list_of_queries(self):
+        queries = cogstack.terms_queries("num", list(range(30)), terms_per_query=7)
+        results = self.cs.multi_search("idx", queries, chunk_size=2, show_progress=False)
+        self.assertEqual(list(results), list(range(5)))
+        self.assertEqual(list(pd.concat(results.values())["num"]), list(range(30)))
+
+    def test_with_headers(self):
+        results = self.cs.multi_search("idx", [{"query": {"terms": {"num": [1]}}}], column_headers=["num"],
+                                       show_progress=False)
+        self.assertEqual(list(results[0].columns), ["_index", "_id", "_score", "num"])
+
+    def test_sends_headers_as_source(self):
+        self.cs.multi_search("idx", [{"query": {"terms": {"num": [1]}}}], column_headers=["num"],
+                             show_progress=False)
+        self.assertEqual(self.cs.elastic.msearch_bodies[0]["_source"], ["num"])  # type: ignore
+
+    def test_truncated_query_raises(self):
+        queries = {"few": {"query": {"terms": {"num": [1, 2]}}}, "many": {"query": {"terms": {"num": list(range(20))}}}}
+        with self.assertRaisesRegex(RuntimeError, "'many' is missing 10 hits"):
+            self.cs.multi_search("idx", queries, show_progress=False)
+
+    def test_truncated_query_warns_if_not_strict(self):
+        queries = {"many": {"query": {"terms": {"num": list(range(20))}}}}
+        with self.assertLogs(cogstack.logger, level="WARNING") as logs:
+            results = self.cs.multi_search("idx", queries, show_progress=False, strict=False)
+        self.assertIn("'many'", logs.output[0])
+        self.assertEqual(len(results["many"]), 10)
+
+    def test_query_with_all_hits_does_not_raise(self):
+        queries = {"many": {"query": {"terms": {"num": list(range(20))}}, "size": 20}}
+        results = self.cs.multi_search("idx", queries, show_progress=False)
+        self.assertEqual(len(results["many"]), 20)
+
+    def test_failed_query_raises(self):
+        queries = [{"query": {"terms": {"num": [1]}}}, {"query": {"match_all": {}}}]
+        with self.assertRaises(RuntimeError):
+            self.cs.multi_search("idx", queries, show_progress=False)
+
+
+class FakeAggregationElastic:
+    """Returns the queued aggregation responses and keeps the search requests."""
+
+    def __init__(self, *responses: dict):
+        self.responses = list(responses)
+        self.requests: list = []
+
+    def options(self, **kwargs):
+        return self
+
+    def search(self, **kwargs):
+        self.requests.append(kwargs)
+        return {"aggregations": self.responses.pop(0)}
+
+
+class AggregationTests(CogStackTestBase):
+
+    def _set_responses(self, *responses: dict) -> None:
+        self.cs.elastic = FakeAggregationElastic(*responses)  # type: ignore
+
+    def test_terms_counts(self):
+        self._set_responses({"counts": {"buckets": [{"key": "M", "doc_count": 7}, {"key": "F", "doc_count": 5}]}})
+        df = self.cs.terms_counts("idx", "gender", query=self.query, size=2)
+        self.assertEqual(df.to_dict("records"), [{"gender": "M", "doc_count": 7}, {"gender": "F", "doc_count": 5}])
+        request = self.cs.elastic.requests[0]  # type: ignore
+        self.assertEqual(request["size"], 0)
+        self.assertEqual(request["query"], self.query["query"])
+        self.assertEqual(request["aggs"]["counts"]["terms"], {"field": "gender", "size": 2})
+
+    def test_date_histogram(self):
+        self._set_responses({"histogram": {"buckets": [{"key": 1704067200000, "doc_count": 3},
+                                                       {"key": 1706745600000, "doc_count": 0}]}})
+        df = self.cs.date_histogram("idx", "date")
+        self.assertEqual(list(df["date"].dt.month), [1, 2])
+        self.assertEqual(list(df["doc_count"]), [3, 0])
+
+    def test_cardinality(self):
+        self._set_responses({"field_0": {"value": 10}, "field_1": {"value": 20}})
+        df = self.cs.cardinality("idx", ["patient_id", "doc_type"])
+        self.assertEqual(df.to_dict("records"), [{"field": "patient_id", "cardinality": 10},
+                                                 {"field": "doc_type", "cardinality": 20}])
+
+    def test_max_value(self):
+        self._set_responses({"max_value": {"value": 1704067200000, "value_as_string": "2024-01-01"}},
+                            {"max_value": {"value": 12.0}},
+                            {"max_value": {"value": None}})
+        self.assertEqual(self.cs.max_value("idx", "updated_at"), "2024-01-01")
+        self.assertEqual(self.cs.max_value("idx", "num"), 12.0)
+        self.assertIsNone(self.cs.max_value("idx", "num"))
+
+    def test_composite_pages_through_all(self):
+        self._set_responses(
+            {"groups": {"after_key": {"a": 1, "b": "y"}, "buckets": [{"key": {"a": 1, "b": "x"}, "doc_count": 2},
+                                                                      {"key": {"a": 1, "b": "y"}, "doc_count": 3}]}},
+            {"groups": {"after_key": {"a": 2, "b": "x"}, "buckets": [{"key": {"a": 2, "b": "x"}, "doc_count": 4}]}},
+            {"groups": {"buckets": []}})
+        df = self.cs.composite_counts("idx", ["a", "b"], page_size=2, show_progress=False)
+        self.assertEqual(list(df.columns), ["a", "b", "doc_count"])
+        self.assertEqual(list(df["doc_count"]), [2, 3, 4])
+        requests = self.cs.elastic.requests  # type: ignore
+        self.assertEqual(len(requests), 3)
+        self.assertNotIn("after", requests[0]["aggs"]["groups"]["composite"])
+        self.assertEqual(requests[2]["aggs"]["groups"]["composite"]["after"], {"a": 2, "b": "x"})
+
+
+class SearchAfterGeneratorTests(CogStackTestBase):
+
+    def test_gets_all_docs_in_order(self):
+        docs = list(self.cs.search_after_generator(["idx"], self.query, es_gen_size=7))
+        self.assertEqual([doc["_id"] for doc in docs], [doc["_id"] for doc in self.cs.elastic.docs])
+
+    def test_closes_pit(self):
+        list(self.cs.search_after_generator(["idx"], self.query, es_gen_size=7))
+        self.assertFalse(self.cs.elastic.open_pits)
+
+    def test_can_resume_from_sort_key(self, after: int = 41):
+        docs = list(self.cs.search_after_generator(["idx"], self.query, search_after=[after]))
+        self.assertEqual(len(docs), self.nr_of_docs - after - 1)
+        self.assertEqual(docs[0]["_source"]["num"], after + 1)
+
+    @patch("time.sleep")
+    def test_retries_from_last_sort_key(self, _sleep):
+        gen = self.cs.search_after_generator(["idx"], self.query, es_gen_size=7)
+        docs = [next(gen) for _ in range(10)]
+        self.cs.elastic.fail_next = 2
+        docs.extend(gen)
+        self.assertEqual([doc["_id"] for doc in docs], [doc["_id"] for doc in self.cs.elastic.docs])
+
+    @patch("time.sleep")
+    def test_raises_after_max_retries(self, _sleep):
+        self.cs.elastic.fail_next = 3
+        with self.assertRaises(elasticsearch.ConnectionError):
+            list(self.cs.search_after_generator(["idx"], self.query, max_retries=2))
+
+    def test_sliced_pit_gets_all_docs(self):
+        docs = list(self.cs.get_docs_generator(index=["idx"], query=self.query, es_gen_size=7,
+                                               slices=4, engine="pit"))
+        self.assertEqual(sorted(doc["_id"] for doc in docs), sorted(doc["_id"] for doc in self.cs.elastic.docs))
+        self.assertFalse(self.cs.elastic.open_pits)
+
+    def test_cogstack2df_with_pit(self):
+        expected = self.cs.cogstack2df(self.query, "idx", show_progress=False)
+        got = self.cs.cogstack2df(self.query, "idx", show_progress=False, engine="pit")
+        pd.testing.assert_frame_equal(got, expected)
+
+    def test_unknown_engine_fails(self):
+        with self.assertRaises(ValueError):
+            self.cs.get_docs_generator(index=["idx"], query=self.query, engine="unknown")
+
+
+class PageSizeControllerTests(CogStackTestBase):
+
+    def test_grows_when_fast(self):
+        controller = cogstack.PageSizeController(initial_size=100, target_latency=2)
+        self.assertEqual(controller.update(100, 0.5), 200)
+
+    def test_shrinks_when_slow(self):
+        controller = cogstack.PageSizeController(initial_size=100, target_latency=2)
+        self.assertEqual(controller.update(100, 2.5), 80)
+
+    def test_respects_byte_budget(self):
+        controller = cogstack.PageSizeController(initial_size=100, target_latency=2, target_mb=1)
+        self.assertEqual(controller.update(100, 1, nr_of_bytes=2 * 1024 ** 2), 50)
+
+    def test_respects_bounds(self):
+        controller = cogstack.PageSizeController(initial_size=100, min_size=60, max_size=150)
+        self.assertEqual(controller.update(100, 0.01), 150)
+        self.assertEqual(controller.update(150, 100), 75)
+        self.assertEqual(controller.update(75, 100), 60)
+
+    def test_ignores_empty_page(self):
+        controller = cogstack.PageSizeController(initial_size=100)
+        self.assertEqual(controller.update(0, 0.01), 100)
+
+    def test_adapts_pit_pages(self):
+        controller = cogstack.PageSizeController(initial_size=10, target_latency=60)
+        docs = list(self.cs.get_docs_generator(["idx"], self.query, es_gen_size=controller, engine="pit"))
+        self.assertEqual([doc["_id"] for doc in docs], [str(i) for i in range(self.nr_of_docs)])
+        self.assertEqual(self.cs.elastic.page_sizes[:3], [10, 20, 40])  # type: ignore
+
+    @patch("time.sleep")
+    def test_shrinks_on_timeout(self, _sleep):
+        self.cs.elastic.timeout_next = 1  # type: ignore
+        controller = cogstack.PageSizeController(initial_size=40, target_latency=60, max_size=40)
+        docs = list(self.cs.get_docs_generator(["idx"], self.query, es_gen_size=controller, engine="pit"))
+        self.assertEqual(len(docs), self.nr_of_docs)
+        self.assertEqual(self.cs.elastic.page_sizes[:2], [40, 20])  # type: ignore
+
+    def test_scroll_fails(self):
+        with self.assertRaises(ValueError):
+            self.cs.cogstack2df(self.query, "idx", es_gen_size=cogstack.PageSizeController(), show_progress=False)
+
+
+class ResumableDocsGeneratorTests(CogStackTestBase):
+    sort = [{"num": "asc"}]
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.checkpoint_file = os.path.join(self.temp_dir.name, "checkpoint.json")
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def _get_gen(self, **kwargs):
+        return self.cs.resumable_docs_generator(["idx"], self.query, self.checkpoint_file, self.sort,
+                                                es_gen_size=5, checkpoint_interval=10, **kwargs)
+
+    def _interrupt_after(self, nr_of_docs: int, **kwargs) -> list:
+        gen = self._get_gen(**kwargs)
+        docs = [next(gen) for _ in range(nr_of_docs)]
+        gen.close()
+        return docs
+
+    def test_gets_all_docs(self):
+        docs = list(self._get_gen())
+        self.assertEqual(len(docs), self.nr_of_docs)
+
+    def test_removes_checkpoint_when_done(self):
+        list(self._get_gen())
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
+    def test_keeps_checkpoint_when_interrupted(self):
+        self._interrupt_after(33)
+        with open(self.checkpoint_file) as f:
+            state = json.load(f)
+        # only fully consumed batches are checkpointed
+        self.assertEqual(state["emitted"], 30)
+        self.assertEqual(state["slices"]["0"]["search_after"], [29])
+
+    def test_resumes_from_checkpoint(self):
+        first = self._interrupt_after(33)
+        second = list(self._get_gen())
+        self.assertEqual(len(second), self.nr_of_docs - 30)
+        all_ids = {doc["_id"] for doc in first + second}
+        self.assertEqual(all_ids, {doc["_id"] for doc in self.cs.elastic.docs})
+
+    def test_single_slice_is_unsliced(self):
+        docs = list(self._get_gen(slices=1))
+        self.assertEqual(len(docs), self.nr_of_docs)
+
+    @patch("time.sleep")
+    def test_keeps_checkpoint_when_failed(self, _sleep):
+        gen = self.cs.resumable_docs_generator(["idx"], self.query, self.checkpoint_file, self.sort,
+                                               es_gen_size=5, checkpoint_interval=1000)
+        docs = [next(gen) for _ in range(33)]
+        self.cs.elastic.fail_next = 100
+        with self.assertRaises(elasticsearch.ConnectionError):
+            docs.extend(gen)
+        with open(self.checkpoint_file) as f:
+            state = json.load(f)
+        # failed between batches, so none are emitted again
+        self.assertGreater(len(docs), 33)
+        self.assertEqual(state["emitted"], len(docs))
+
+    def test_resumes_sliced_from_checkpoint(self):
+        first = self._interrupt_after(33, slices=3)
+        second = list(self._get_gen(slices=3))
+        all_ids = {doc["_id"] for doc in first + second}
+        self.assertEqual(all_ids, {doc["_id"] for doc in self.cs.elastic.docs})
+        self.assertLess(len(second), self.nr_of_docs)
+
+    def test_fails_for_different_query(self):
+        self._interrupt_after(33)
+        with self.assertRaises(ValueError):
+            list(self.cs.resumable_docs_generator(["idx"], {"query": {"term": {"num": 1}}},
+                                                  self.checkpoint_file, self.sort))
+
+
+class TextGeneratorTests(CogStackTestBase):
+
+    def test_yields_id_text_tuples(self):
+        texts = list(self.cs.get_text_generator(["idx"], "body_analysed"))
+        self.assertEqual(texts, [(doc["_id"], doc["_source"]["body_analysed"]) for doc in self.cs.elastic.docs])
+
+    def test_skips_missing_text(self):
+        self.cs.elastic.docs[0]["_source"]["body_analysed"] = ""
+        del self.cs.elastic.docs[1]["_source"]["body_analysed"]
+        texts = list(self.cs.get_text_generator(["idx"], "body_analysed"))
+        self.assertEqual(len(texts), self.nr_of_docs - 2)
+
+    def test_gets_nested_field(self):
+        for doc in self.cs.elastic.docs:
+            doc["_source"]["nested"] = {"text": "nested text"}
+        texts = list(self.cs.get_text_generator(["idx"], "nested.text"))
+        self.assertEqual({text for _, text in texts}, {"nested text"})
+
+
+def fake_parallel_bulk(rejected_ids: set):
+    """Creates a stand-in for parallel_bulk that rejects each of the specified IDs once."""
+    def parallel_bulk(client, actions, **kwargs):
+        for action in actions:
+            if action["_id"] in rejected_ids:
+                rejected_ids.discard(action["_id"])
+                yield False, {"index": {"_id": action["_id"], "status": 429}}
+            elif action["_id"] == "bad":
+                yield False, {"index": {"_id": action["_id"], "status": 400}}
+            else:
+                yield True, {"index": {"_id": action["_id"], "status": 201}}
+    return parallel_bulk
+
+
+class BulkIndexTests(CogStackTestBase):
+    actions = [{"_index": "idx", "_id": str(i), "_source": {"num": i}} for i in range(20)]
+
+    @patch("time.sleep")
+    def test_retries_rejected(self, _sleep):
+        with patch("elasticsearch.helpers.parallel_bulk", fake_parallel_bulk({"3", "7"})):
+            stats = self.cs.bulk_index(self.actions, show_progress=False)
+        self.assertEqual(stats["indexed"], len(self.actions))
+        self.assertEqual(stats["retried"], 2)
+        self.assertEqual(stats["failed"], 0)
+
+    @patch("time.sleep")
+    def test_does_not_retry_other_errors(self, _sleep):
+        actions = self.actions + [{"_index": "idx", "_id": "bad", "_source": {}}]
+        with patch("elasticsearch.helpers.parallel_bulk", fake_parallel_bulk(set())):
+            stats = self.cs.bulk_index(actions, show_progress=False)
+        self.assertEqual(stats["indexed"], len(self.actions))
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["retried"], 0)
+
+    @patch("time.sleep")
+    def test_gives_up_after_max_retries(self, _sleep):
+        with patch("elasticsearch.helpers.parallel_bulk", fake_parallel_bulk({"3"})):
+            stats = self.cs.bulk_index(self.actions, max_retries=0, show_progress=False)
+        self.assertEqual(stats["failed"], 1)
+
+
+class AsyncFakeElastic:
+    """Exposes the scroll and count methods of FakeElastic as coroutines."""
+
+    def __init__(self, fake: FakeElastic):
+        self.fake = fake
+        self.scroll_requests = 0
+
+    def options(self, **kwargs):
+        return self
+
+    async def search(self, **kwargs):
+        return self.fake.search(**kwargs)
+
+    async def scroll(self, **kwargs):
+        self.scroll_requests += 1
+        return self.fake.scroll(**kwargs)
+
+    async def clear_scroll(self, **kwargs):
+        self.fake.clear_scroll(**kwargs)
+
+    async def count(self, **kwargs):
+        return self.fake.count(**kwargs)
+
+
+class AsyncCogStackTests(unittest.IsolatedAsyncioTestCase):
+    nr_of_docs = 100
+    query = {"query": {"match_all": {}}}
+
+    def setUp(self) -> None:
+        self.cs = cogstack.AsyncCogStack(hosts=["http://localhost:9200"], username="user", password="pass")
+        self.cs.elastic = AsyncFakeElastic(FakeElastic(self.nr_of_docs))  # type: ignore
+
+    async def test_count(self):
+        self.assertEqual(await self.cs.count(["idx"], self.query), self.nr_of_docs)
+
+    async def test_gets_all_docs(self):
+        docs = [doc async for doc in self.cs.get_docs_generator(["idx"], self.query, es_gen_size=7)]
+        self.assertEqual([doc["_id"] for doc in docs], [doc["_id"] for doc in self.cs.elastic.fake.docs])
+        self.assertEqual(len(self.cs.elastic.fake.cleared_scrolls), 1)
+
+    async def test_scrolls_in_doc_order(self):
+        [doc async for doc in self.cs.get_docs_generator(["idx"], self.query, es_gen_size=7)]
+        self.assertEqual(self.cs.elastic.fake.scroll_searches[0]["sort"], "_doc")
+
+    async def test_prefetches_next_batch(self):
+        gen = self.cs.get_docs_generator(["idx"], self.query, es_gen_size=7)
+        await gen.__anext__()
+        # allow the prefetch to run
+        await asyncio.sleep(0)
+        self.assertEqual(self.cs.elastic.scroll_requests, 1)
+        await gen.aclose()
+
+    async def test_clears_scroll_when_stopped_early(self):
+        gen = self.cs.get_docs_generator(["idx"], self.query, es_gen_size=7)
+        await gen.__anext__()
+        await gen.aclose()
+        self.assertEqual(len(self.cs.elastic.fake.cleared_scrolls), 1)